@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers for running the stimela 1gc/2gc GMRT recipes.
+"""
+
+from gcpipe.recipe import Recipe, Step, StimelaBackend
+from gcpipe.scheduler import StepFailed
+from gcpipe.cache import StepCache
+from gcpipe.snapshot import MSSnapshots
+from gcpipe.columns import copycol
+from gcpipe.plotcal import plotcal
+from gcpipe.visstats import visplots
+from gcpipe.instrument import StepProfiler
+from gcpipe.journal import Journal
+from gcpipe.selfcal import SelfcalLoop
+from gcpipe.cleanmask import cleanmask
+from gcpipe.skymodel import SkyModel, merge_lsm
+from gcpipe.predict import predict
+from gcpipe.average import average_ms, route_steps
+from gcpipe.applycal import applycal
+from gcpipe.autoflag import autoflag
+from gcpipe.flagplan import flag_plan
+from gcpipe.flagversions import FlagVersions, flagmanager
+from gcpipe.flagstats import FlagStats
+from gcpipe.pool import ContainerPool
+from gcpipe.mock import MockBackend
+from gcpipe.synthms import make_gmrt_ms
+from gcpipe.config import RecipeConfig
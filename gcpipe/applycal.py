@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process applycal of K (delay), B (bandpass) and G/T (gain) tables,
+replacing one `cab/casa_applycal` run per field.
+
+Every entry of `fields` selects MS fields and says which solutions apply to
+them (gainfield, interp per table, as in applycal). The solutions of every
+table are interpolated once per (field, data description) onto the times of
+its visibilities, in the calling process. The MS is then cut into partitions
+of rows by field and scan (split further into blocks of about chunk_bytes,
+and into channel_blocks channel ranges), which a pool of workers corrects
+independently: each worker receives the interpolated solutions once, reads
+DATA and FLAG of its rows under a shared read lock and writes CORRECTED_DATA
+and FLAG under the write lock.
+
+Corrected visibilities are V / (g1[p] conj(g2[q])) with the product of the
+gains of all tables for the receptors p, q of each correlation. Data with a
+flagged or missing solution are flagged (applymode 'calflag'). Time
+interpolation is 'nearest' or 'linear' (amplitude and phase), clamped to
+the first and last solution; bandpasses with other channels than the data
+are interpolated linearly in frequency. Delays are referenced to the
+REF_FREQUENCY of the table's spectral window, as in CASA.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from gcpipe import columns, flagstats, graph
+from gcpipe.scheduler import forks
+from gcpipe.visstats import MSInfo, parse_fields
+
+INTERP = ("", "nearest", "linear")
+
+# Receptors (p, q) of each CASA correlation type
+RECEPTORS = {
+    5  : (0, 0),    # RR
+    6  : (0, 1),    # RL
+    7  : (1, 0),    # LR
+    8  : (1, 1),    # LL
+    9  : (0, 0),    # XX
+    10 : (0, 1),    # XY
+    11 : (1, 0),    # YX
+    12 : (1, 1),    # YY
+}
+
+# Set in the workers (and the calling process) by _init_worker
+_state = {}
+_worker_table = {}
+
+
+def _wrap(phase):
+    return (phase + np.pi) % (2 * np.pi) - np.pi
+
+
+def interpolate_times(times, values, flags, targets, mode="linear",
+                      delay=False):
+    """
+    Interpolate solutions values (ntime, ncol) at times onto targets, per
+    column and over its unflagged samples only. Complex values are
+    interpolated in amplitude and phase, delays (real) as they are. Returns
+    (values, flags) of shape (len(targets), ncol).
+    """
+    out = np.zeros((len(targets), values.shape[1]), values.dtype)
+    bad = np.ones(out.shape, bool)
+    # Columns sharing a flag pattern share the interpolation weights
+    patterns, inverse = np.unique(flags.T, axis=0, return_inverse=True)
+    for index, pattern in enumerate(patterns):
+        cols = np.nonzero(inverse.ravel() == index)[0]
+        good = np.nonzero(~pattern)[0]
+        if not good.size:
+            continue
+        t = times[good]
+        v = values[good][:, cols]
+        after = np.clip(np.searchsorted(t, targets), 0, len(t) - 1)
+        before = np.clip(after - 1, 0, len(t) - 1)
+        if mode == "nearest":
+            pick = np.where(np.abs(t[before] - targets) <=
+                            np.abs(t[after] - targets), before, after)
+            out[:, cols] = v[pick]
+        else:
+            span = t[after] - t[before]
+            weight = np.where(span > 0, (targets - t[before]) /
+                              np.where(span > 0, span, 1), 0.0)
+            weight = np.clip(weight, 0, 1)[:, None]
+            v0, v1 = v[before], v[after]
+            if delay:
+                out[:, cols] = v0 + weight * (v1 - v0)
+            else:
+                amp = np.abs(v0) + weight * (np.abs(v1) - np.abs(v0))
+                phase = np.angle(v0) + weight * _wrap(np.angle(v1) -
+                                                      np.angle(v0))
+                out[:, cols] = amp * np.exp(1j * phase)
+        bad[:, cols] = False
+    return out, bad
+
+
+def _interpolate_freqs(gains, flags, freqs, targets):
+    """Bandpass (..., nchan, npol) on freqs onto target frequencies"""
+    if len(freqs) == len(targets) and np.allclose(freqs, targets):
+        return gains, flags
+    shape = gains.shape[:-2] + (len(targets), gains.shape[-1])
+    flat = gains.reshape((-1,) + gains.shape[-2:])
+    flat_flags = flags.reshape(flat.shape)
+    out = np.zeros((len(flat), len(targets), gains.shape[-1]), gains.dtype)
+    bad = np.ones(out.shape, bool)
+    for i in range(len(flat)):
+        for pol in range(gains.shape[-1]):
+            good = ~flat_flags[i, :, pol]
+            if not good.any():
+                continue
+            amp = np.interp(targets, freqs[good], np.abs(flat[i, good, pol]))
+            phase = np.interp(targets, freqs[good],
+                              np.unwrap(np.angle(flat[i, good, pol])))
+            out[i, :, pol] = amp * np.exp(1j * phase)
+            bad[i, :, pol] = False
+    return out.reshape(shape), bad.reshape(shape)
+
+
+class Solutions(object):
+    """The solutions of a CASA K, B, G or T calibration table"""
+
+    def __init__(self, path):
+        import pyrap.tables as pt
+        self.path = path
+        tab = pt.table(path, ack=False)
+        try:
+            viscal = tab.getkeywords().get("VisCal", "")
+            self.kind = viscal.split()[0] if viscal else ""
+            if self.kind not in ("K", "B", "G", "T"):
+                raise ValueError("%s: unsupported calibration table type "
+                                 "'%s'" % (path, viscal))
+            self.time = tab.getcol("TIME")
+            self.field = tab.getcol("FIELD_ID")
+            self.spw = tab.getcol("SPECTRAL_WINDOW_ID")
+            self.antenna = tab.getcol("ANTENNA1")
+            column = "FPARAM" if self.kind == "K" else "CPARAM"
+            self.param = tab.getcol(column)
+            self.flag = tab.getcol("FLAG")
+        finally:
+            tab.close()
+        sub = pt.table(os.path.join(path, "FIELD"), ack=False)
+        self.field_names = list(sub.getcol("NAME"))
+        sub.close()
+        sub = pt.table(os.path.join(path, "SPECTRAL_WINDOW"), ack=False)
+        self.freqs = [sub.getcell("CHAN_FREQ", i) for i in range(sub.nrows())]
+        self.ref_freqs = sub.getcol("REF_FREQUENCY")
+        sub.close()
+
+    def interpolate(self, gainfield, spw, nant, times, freqs, mode):
+        """
+        Solutions of spw from the fields in gainfield (all if empty) at
+        times: (values, flags) of shape (ntime, nant, nchan, npol), where
+        nchan is 1 for delays and gains. Solutions constant in time are
+        returned for one time only.
+        """
+        rows = self.spw == spw
+        if gainfield not in (None, ""):
+            fields = parse_fields(gainfield, self.field_names)
+            rows &= np.isin(self.field, sorted(fields))
+        nchan, npol = self.param.shape[1:]
+        if len(np.unique(self.time[rows])) <= 1:
+            times = times[:1]
+        values = np.zeros((len(times), nant, nchan, npol), self.param.dtype)
+        flags = np.ones(values.shape, bool)
+        for ant in range(nant):
+            sel = rows & (self.antenna == ant)
+            if not sel.any():
+                continue
+            order = np.argsort(self.time[sel], kind="mergesort")
+            value, flag = interpolate_times(
+                self.time[sel][order],
+                self.param[sel][order].reshape(-1, nchan * npol),
+                self.flag[sel][order].reshape(-1, nchan * npol),
+                times, mode, delay=self.kind == "K")
+            values[:, ant] = value.reshape(-1, nchan, npol)
+            flags[:, ant] = flag.reshape(-1, nchan, npol)
+        if self.kind == "B":
+            values, flags = _interpolate_freqs(values, flags,
+                                               self.freqs[spw], freqs)
+        return values, flags
+
+
+def _init_worker(state):
+    _state.clear()
+    _state.update(state)
+
+
+def _gains(term, tindex, ant, freqs, ref_freq):
+    """Per row (row, nchan or 1, npol) gains and flags of one table"""
+    kind, values, flags = term
+    index = np.minimum(tindex, len(values) - 1)
+    gains, bad = values[index, ant], flags[index, ant]
+    if kind == "K":
+        # Delays in ns
+        gains = np.exp(2j * np.pi * 1e-9 * gains *
+                       (freqs - ref_freq)[None, :, None])
+        bad = np.repeat(bad, len(freqs), axis=1)
+    return gains, bad
+
+
+def _apply_block(job):
+    msname, rows, key, chans = job
+    terms, times, freqs, ref_freqs, receptors = _state["partitions"][key]
+    freqs = freqs[chans[0]:chans[1]]
+    tab = _worker_table.get(msname)
+    if tab is None:
+        import pyrap.tables as pt
+        tab = _worker_table[msname] = pt.table(msname, readonly=False,
+                                               ack=False, lockoptions="user")
+    blc, trc = [chans[0], 0], [chans[1] - 1, len(receptors) - 1]
+    runs = columns.row_runs(rows)
+
+    def get(name, sliced=False):
+        if sliced:
+            parts = [tab.getcolslice(name, blc, trc, [], start, nrow)
+                     for start, nrow in runs]
+        else:
+            parts = [tab.getcol(name, start, nrow) for start, nrow in runs]
+        return np.concatenate(parts)
+
+    tab.lock(write=False)
+    try:
+        time = get("TIME")
+        meta = dict((name, get(name)) for name in flagstats.META)
+        ant1, ant2 = meta["ANTENNA1"], meta["ANTENNA2"]
+        data = get("DATA", True)
+        flag = get("FLAG", True)
+    finally:
+        tab.unlock()
+
+    tindex = np.searchsorted(times, time)
+    shape = (len(rows), len(freqs), 2)
+    g1, g2 = np.ones(shape, np.complex128), np.ones(shape, np.complex128)
+    bad1, bad2 = np.zeros(shape, bool), np.zeros(shape, bool)
+    for term, ref_freq in zip(terms, ref_freqs):
+        kind, values, flags = term
+        if kind == "B":
+            term = (kind, values[:, :, chans[0]:chans[1]],
+                    flags[:, :, chans[0]:chans[1]])
+        for ant, g, bad in ((ant1, g1, bad1), (ant2, g2, bad2)):
+            gains, gbad = _gains(term, tindex, ant, freqs, ref_freq)
+            # Single receptor solutions apply to both
+            pols = [0, 0] if gains.shape[2] == 1 else [0, 1]
+            g *= gains[:, :, pols]
+            bad |= gbad[:, :, pols]
+
+    p = [receptors[corr][0] for corr in range(len(receptors))]
+    q = [receptors[corr][1] for corr in range(len(receptors))]
+    gain = g1[:, :, p] * np.conj(g2[:, :, q])
+    bad = bad1[:, :, p] | bad2[:, :, q] | (gain == 0)
+    corrected = data / np.where(bad, 1, gain)
+    before, flag = flag, flag | bad
+
+    corrected = corrected.astype(data.dtype)
+    tab.lock(write=True)
+    try:
+        offset = 0
+        for start, nrow in runs:
+            part = slice(offset, offset + nrow)
+            tab.putcolslice("CORRECTED_DATA", corrected[part], blc, trc, [],
+                            start, nrow)
+            tab.putcolslice("FLAG", flag[part], blc, trc, [], start, nrow)
+            offset += nrow
+    finally:
+        tab.unlock()
+    changes = (flagstats.delta(meta, before, flag, chans[0])
+               if _state["stats"] else None)
+    # Rows are counted by the first channel block only
+    return len(rows) if chans[0] == 0 else 0, int(bad.sum()), changes
+
+
+@forks()
+@flagstats.incremental
+def applycal(msname, gaintable, fields, calwt=False, parang=False,
+             workers=4, channel_blocks=1, chunk_bytes=columns.CHUNK_BYTES):
+    """
+    Apply the calibration tables gaintable to msname. fields is a list of
+    dicts with the applycal parameters per field selection: field,
+    gainfield and interp (lists with an entry per table, '' for defaults).
+    """
+    import pyrap.tables as pt
+
+    if any(graph.as_list(calwt)) or parang:
+        raise ValueError("applycal: calwt and parang are not supported")
+    gaintable = graph.as_list(gaintable)
+    tables = [Solutions(path) for path in gaintable]
+    info = MSInfo(msname)
+    tab = pt.table(msname, readonly=False, ack=False)
+    try:
+        if "CORRECTED_DATA" not in tab.colnames():
+            columns.add_column_like(tab, "DATA", "CORRECTED_DATA")
+        sub = pt.table(tab.getkeyword("ANTENNA"), ack=False)
+        nant = sub.nrows()
+        sub.close()
+        meta = dict((name, tab.getcol(name)) for name in
+                    ("FIELD_ID", "DATA_DESC_ID", "SCAN_NUMBER", "TIME"))
+        rows_per_block = columns.rows_per_chunk(tab, "DATA", chunk_bytes)
+    finally:
+        tab.close()
+
+    partitions, jobs = {}, []
+    for spec in fields:
+        gainfield = list(spec.get("gainfield") or []) + [""] * len(tables)
+        interp = list(spec.get("interp") or []) + [""] * len(tables)
+        for fid in sorted(parse_fields(spec.get("field", ""), info.fields) or
+                          range(len(info.fields))):
+            for ddid in np.unique(meta["DATA_DESC_ID"]):
+                rows = (meta["FIELD_ID"] == fid) & (meta["DATA_DESC_ID"] ==
+                                                    ddid)
+                if not rows.any():
+                    continue
+                spw = info.ddid_spw[ddid]
+                freqs = np.asarray(info.freqs[spw], np.float64)
+                times = np.unique(meta["TIME"][rows])
+                terms = []
+                for table, field, mode in zip(tables, gainfield, interp):
+                    mode = mode.split(",")[0]
+                    if mode not in INTERP:
+                        raise ValueError("Unsupported applycal interp '%s'" %
+                                         mode)
+                    values, flags = table.interpolate(
+                        field, spw, nant, times, freqs, mode or "linear")
+                    terms.append((table.kind, values, flags))
+                receptors = [RECEPTORS[corr] for corr in
+                             info.corr_types[ddid]]
+                key = (fid, int(ddid))
+                partitions[key] = (terms, times, freqs,
+                                   [table.ref_freqs[spw] for table in tables],
+                                   receptors)
+                edges = np.linspace(0, len(freqs), max(1, channel_blocks) +
+                                    1).astype(int)
+                scans = meta["SCAN_NUMBER"][rows]
+                for scan in np.unique(scans):
+                    scan_rows = np.nonzero(rows)[0][scans == scan]
+                    for start, nrow in columns.row_blocks(len(scan_rows),
+                                                          rows_per_block):
+                        for first, last in zip(edges[:-1], edges[1:]):
+                            jobs.append((msname,
+                                         scan_rows[start:start + nrow],
+                                         key, (first, last)))
+
+    state = {"partitions": partitions,
+             "stats": flagstats.recording(msname)}
+    if workers <= 1 or len(jobs) <= 1:
+        _init_worker(state)
+        results = [_apply_block(job) for job in jobs]
+    else:
+        pool = Pool(min(workers, len(jobs)), _init_worker, (state,))
+        try:
+            results = pool.map(_apply_block, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for tab in _worker_table.values():
+        tab.close()
+    _worker_table.clear()
+    for result in results:
+        flagstats.record(msname, result[2])
+    print("%s: %d tables applied to %d rows in %d partitions, %d "
+          "visibilities flagged" % (
+              os.path.basename(msname), len(tables),
+              sum(result[0] for result in results), len(jobs),
+              sum(result[1] for result in results)))
+
+
+@graph.register_io(applycal)
+def _applycal_io(step):
+    reads = graph.columns(step, "DATA", "FLAG") | graph.files(step,
+                                                              "gaintable")
+    return reads, graph.ms_writer(step, "CORRECTED_DATA", "FLAG")
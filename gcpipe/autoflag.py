@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process RFI flagging with a SumThreshold strategy, replacing
+`cab/autoflagger`.
+
+The MS is read one scan (or, for long scans, one block of whole time slots
+of about chunk_bytes) at a time. The amplitudes of the block are arranged
+as a time x frequency waterfall per baseline and correlation, and the
+baselines are flagged by a process pool while the next block is read. The
+new flags of a block are written back in bulk; existing flags are kept and
+FLAG_ROW is set for rows that end up fully flagged.
+
+Per baseline and correlation, `iterations` times:
+
+- the smooth background is estimated by a Gaussian high-pass filter over
+  the unflagged samples (sigma `smooth` time slots and channels),
+- SumThreshold runs over the residuals along time and along frequency for
+  every window length in `windows`, with threshold `threshold` times the
+  robust noise for single samples, decreasing by `rho` per doubling of
+  the window. The threshold starts 2**(iterations - 1) times higher and
+  halves every iteration.
+
+The flags of all correlations are then combined and grown with the
+scale-invariant rank operator (aggressiveness `eta`) in both directions.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+
+from gcpipe import columns, flagstats, graph
+from gcpipe.scheduler import forks
+from gcpipe.visstats import parse_fields
+
+WINDOWS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _along(ndim, axis, start=None, stop=None):
+    """Index of [start:stop] along axis of an ndim array"""
+    index = [slice(None)] * ndim
+    index[axis] = slice(start, stop)
+    return tuple(index)
+
+
+def _box(values, half, axis):
+    """Sums over values[i - half:i + half + 1] along axis"""
+    size = values.shape[axis]
+    half = min(half, size - 1)
+    at = lambda start=None, stop=None: _along(values.ndim, axis, start, stop)
+    total = np.cumsum(values, axis=axis)
+    out = np.empty_like(total)
+    out[at(None, size - half)] = total[at(half, None)]
+    out[at(size - half, None)] = total[at(size - 1, size)]
+    out[at(half + 1, None)] -= total[at(None, size - half - 1)]
+    return out
+
+
+def background(values, flags, smooth=(2.5, 5.0)):
+    """
+    Smoothed values (..., time, frequency) over the unflagged samples: a
+    Gaussian of sigma smooth (time slots, channels), approximated by three
+    passes of a box filter.
+    """
+    weights = (~flags).astype(np.float32)
+    data = np.where(flags, 0, values).astype(np.float32)
+    for axis, sigma in zip((-2, -1), smooth):
+        # Three boxes of width 2 half + 1 have variance sigma**2
+        half = int(round((np.sqrt(4 * sigma ** 2 + 1) - 1) / 2))
+        for _ in range(3 if half else 0):
+            data = _box(data, half, axis)
+            weights = _box(weights, half, axis)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weights > 1e-3, data / weights, 0)
+
+
+def sum_threshold(values, flags, chi1, windows=WINDOWS, rho=1.5, axis=-1):
+    """
+    Flags after SumThreshold along axis: a window of M samples is flagged
+    when the mean of its unflagged values exceeds chi1 / rho**log2(M) in
+    absolute value. chi1 broadcasts against values.
+    """
+    flags = flags.copy()
+    size = values.shape[axis]
+    at = lambda start=None, stop=None: _along(values.ndim, axis, start, stop)
+    for window in windows:
+        if window > size:
+            break
+        nwin = size - window + 1
+        chi = chi1 / rho ** np.log2(window)
+        if window == 1:
+            flags |= np.abs(values) > chi
+            continue
+        sums = np.cumsum(np.where(flags, 0, values), axis=axis)
+        counts = np.cumsum(~flags, axis=axis, dtype=np.int32)
+        total = sums[at(window - 1, None)]
+        total[at(1, None)] -= sums[at(None, nwin - 1)]
+        count = counts[at(window - 1, None)]
+        count[at(1, None)] -= counts[at(None, nwin - 1)]
+        hit = (count > 0) & (np.abs(total) > chi * np.maximum(count, 1))
+        # Every sample covered by a hit window
+        hits = np.cumsum(hit, axis=axis, dtype=np.int32)
+        covered = np.empty(flags.shape, np.int32)
+        covered[at(None, nwin)] = hits
+        covered[at(nwin, None)] = hits[at(nwin - 1, nwin)]
+        covered[at(window, None)] -= hits[at(None, nwin - 1)]
+        flags |= covered > 0
+    return flags
+
+
+def sir_operator(flags, eta=0.2, axis=-1):
+    """
+    Scale-invariant rank operator along axis: a sample is flagged if it lies
+    in a window of which at most a fraction eta is unflagged.
+    """
+    at = lambda start=None, stop=None: _along(flags.ndim, axis, start, stop)
+    total = np.cumsum(np.where(flags, eta, eta - 1.0), axis=axis)
+    # Lowest partial sum ending before, highest ending at or after a sample
+    lowest = np.zeros(total.shape)
+    lowest[at(1, None)] = np.minimum(
+        np.minimum.accumulate(total, axis=axis)[at(None, -1)], 0)
+    highest = np.flip(np.maximum.accumulate(np.flip(total, axis), axis=axis),
+                      axis)
+    # Windows with exactly a fraction eta unflagged sum to zero, give or
+    # take rounding
+    return flags | (highest - lowest >= -1e-9)
+
+
+def robust_noise(values, flags):
+    """1.4826 MAD of the unflagged values over the last two axes"""
+    values = np.where(flags, np.nan, values)
+    shape = values.shape[:-2] + (-1,)
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # All-flagged waterfalls give NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(values.reshape(shape), axis=-1)
+        mad = np.nanmedian(np.abs(values.reshape(shape) - median[..., None]),
+                           axis=-1)
+    return np.nan_to_num(1.4826 * mad)
+
+
+def flag_waterfalls(amp, flags, threshold=6.0, windows=WINDOWS, rho=1.5,
+                    iterations=3, smooth=(2.5, 5.0), eta=0.2):
+    """
+    New flags (baseline, time, frequency) for amplitudes and flags of shape
+    (baseline, time, frequency, correlation); see the module description.
+    """
+    # Correlations next to baselines, so the waterfalls are the last axes
+    amp = np.moveaxis(amp, -1, 1)
+    flags = np.moveaxis(flags, -1, 1)
+    mask = flags.copy()
+    for iteration in range(iterations):
+        residual = amp - background(amp, mask, smooth)
+        noise = robust_noise(residual, mask)
+        # Strong RFI first, so that it does not bias the later backgrounds
+        scale = threshold * 2 ** (iterations - 1 - iteration)
+        # Nothing to threshold against in empty or constant waterfalls
+        chi1 = np.where(noise > 0, scale * noise, np.inf)[..., None, None]
+        mask = sum_threshold(residual, mask, chi1, windows, rho, axis=-2)
+        mask = sum_threshold(residual, mask, chi1, windows, rho, axis=-1)
+    new = (mask & ~flags).any(axis=1)
+    return sir_operator(new, eta, axis=-2) | sir_operator(new, eta, axis=-1)
+
+
+def _flag_baselines(job):
+    amp, flags, options = job
+    return flag_waterfalls(amp, flags, **options)
+
+
+class Block(object):
+    """The waterfalls of a block of rows: (baseline, time, chan, corr)"""
+
+    def __init__(self, tab, rows, column, autocorr):
+        self.runs = columns.row_runs(rows)
+
+        def get(name):
+            return np.concatenate([tab.getcol(name, start, nrow)
+                                   for start, nrow in self.runs])
+
+        self.flag = get("FLAG")
+        self.flag_row = get("FLAG_ROW")
+        self.meta = dict((name, get(name)) for name in flagstats.META)
+        ant1, ant2 = self.meta["ANTENNA1"], self.meta["ANTENNA2"]
+        times, self.tindex = np.unique(get("TIME"), return_inverse=True)
+        baselines, self.bindex = np.unique(ant1 * 65536 + ant2,
+                                           return_inverse=True)
+        self.tindex = self.tindex.ravel()
+        self.bindex = self.bindex.ravel()
+        self.skip = (ant1 == ant2) & (not autocorr)
+        shape = (len(baselines), len(times)) + self.flag.shape[1:]
+        self.amp = np.zeros(shape, np.float32)
+        self.flags = np.ones(shape, bool)
+        use = ~self.skip
+        self.amp[self.bindex[use], self.tindex[use]] = np.abs(
+            get(column)[use])
+        self.flags[self.bindex[use], self.tindex[use]] = (
+            self.flag[use] | self.flag_row[use][:, None, None])
+
+    def write(self, tab, new):
+        """
+        OR the (baseline, time, chan) flags new into FLAG and set FLAG_ROW
+        for rows that end up fully flagged; returns FLAG
+        """
+        add = new[self.bindex, self.tindex] & ~self.skip[:, None]
+        flag = self.flag | add[:, :, None]
+        flag_row = self.flag_row | flag.all(axis=(1, 2))
+        offset = 0
+        for start, nrow in self.runs:
+            tab.putcol("FLAG", flag[offset:offset + nrow], start, nrow)
+            tab.putcol("FLAG_ROW", flag_row[offset:offset + nrow], start,
+                       nrow)
+            offset += nrow
+        return flag
+
+
+def _blocks(meta, fields, rows_per_block):
+    """Row numbers per block: whole time slots of one scan"""
+    select = np.isin(meta["FIELD_ID"], sorted(fields))
+    keys = np.stack([meta["DATA_DESC_ID"], meta["SCAN_NUMBER"],
+                     meta["FIELD_ID"]])
+    for key in np.unique(keys[:, select], axis=1).T:
+        rows = np.nonzero(select & (keys == key[:, None]).all(axis=0))[0]
+        times = meta["TIME"][rows]
+        slots = np.unique(times)
+        per_slot = max(1, len(rows) // len(slots))
+        nslots = max(1, rows_per_block // per_slot)
+        for first in range(0, len(slots), nslots):
+            chosen = slots[first:first + nslots]
+            yield rows[(times >= chosen[0]) & (times <= chosen[-1])]
+
+
+@forks()
+@flagstats.incremental
+def autoflag(msname, column="DATA", field="", autocorr=False, threshold=6.0,
+             windows=WINDOWS, rho=1.5, iterations=3, smooth=(2.5, 5.0),
+             eta=0.2, workers=4, chunk_bytes=columns.CHUNK_BYTES):
+    """
+    Flag RFI in column of msname (fields ids or names, all by default); see
+    the module description. Autocorrelations are left alone unless
+    autocorr is set.
+    """
+    import pyrap.tables as pt
+
+    options = {"threshold": threshold, "windows": tuple(windows), "rho": rho,
+               "iterations": iterations, "smooth": tuple(smooth),
+               "eta": eta}
+    tab = pt.table(msname, readonly=False, ack=False)
+    pool = Pool(workers) if workers > 1 else None
+    flagged = total = 0
+    stats = flagstats.recording(msname)
+    try:
+        sub = pt.table(tab.getkeyword("FIELD"), ack=False)
+        names = list(sub.getcol("NAME"))
+        sub.close()
+        fields = (parse_fields(field, names) if field not in (None, "")
+                  else range(len(names)))
+        meta = dict((name, tab.getcol(name)) for name in
+                    ("FIELD_ID", "DATA_DESC_ID", "SCAN_NUMBER", "TIME"))
+        rows_per_block = columns.rows_per_chunk(tab, column,
+                                                chunk_bytes // 2)
+        pending = None
+        for rows in _blocks(meta, fields, rows_per_block):
+            block = Block(tab, rows, column, autocorr)
+            groups = np.array_split(np.arange(len(block.amp)),
+                                    max(1, 4 * workers))
+            jobs = [(block.amp[group], block.flags[group], options)
+                    for group in groups if len(group)]
+            if pool is None:
+                result = [_flag_baselines(job) for job in jobs]
+            else:
+                result = pool.map_async(_flag_baselines, jobs, chunksize=1)
+            # Write the previous block while this one is flagged
+            if pending is not None:
+                flagged += _finish(tab, msname, stats, *pending)
+            pending = (block, result)
+            total += block.flag.size
+        if pending is not None:
+            flagged += _finish(tab, msname, stats, *pending)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        tab.close()
+    print("%s: %s flagged %.2f%% more visibilities" % (
+        os.path.basename(msname), column, 100.0 * flagged / max(total, 1)))
+
+
+def _finish(tab, msname, stats, block, result):
+    """Write the flags of block; returns the number of new flags"""
+    if hasattr(result, "get"):
+        result = result.get()
+    flag = block.write(tab, np.concatenate(result))
+    if stats:
+        flagstats.record(msname, flagstats.delta(block.meta, block.flag, flag))
+    return int((flag & ~block.flag).sum())
+
+
+@graph.register_io(autoflag)
+def _autoflag_io(step):
+    reads = graph.columns(step, step.config.get("column", "DATA"), "FLAG",
+                          "FLAG_ROW")
+    return reads, graph.ms_writer(step, "FLAG", "FLAG_ROW")
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+Baseline-dependent averaged working copies of a measurement set.
+
+Calibration solves on coarse solution intervals do not need every 16 s dump:
+average_ms writes a copy of (some fields of) an MS with the visibilities of
+each baseline averaged over up to `timebin` seconds, and optionally over
+`chanbin` channels. Time smearing grows with baseline length, so baselines
+longer than `full_baseline` metres get proportionally shorter bins (never
+shorter than one integration, i.e. the longest ones are left as they are).
+
+Averages are weighted by WEIGHT (WEIGHT_SPECTRUM if present) times the
+unflagged mask. A cell is flagged only if all of its inputs were; its
+weight is the sum of the unflagged input weights, SIGMA follows from WEIGHT.
+TIME, TIME_CENTROID and UVW are averaged, INTERVAL and EXPOSURE summed.
+
+route_steps points recipe steps (typically the calibration solves) at the
+working copy. Their solution tables apply to the full resolution MS with the
+usual applycal step, since the averaged copy keeps the same spectral
+windows (or the same band, with chanbin > 1) and time range.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+
+import numpy as np
+
+from gcpipe import columns, graph
+from gcpipe.visstats import parse_fields, parse_spw
+
+DATA_COLUMNS = ("DATA", "MODEL_DATA", "CORRECTED_DATA")
+
+# Columns averaged or summed over a bin; all others are taken from its first
+# row
+AVERAGED = ("TIME", "TIME_CENTROID", "UVW")
+SUMMED = ("INTERVAL", "EXPOSURE")
+DERIVED = ("FLAG", "FLAG_ROW", "WEIGHT", "SIGMA", "WEIGHT_SPECTRUM",
+           "SIGMA_SPECTRUM", "FLAG_CATEGORY")
+
+# Sort order that makes every averaging bin a run of consecutive rows
+SORT = "DATA_DESC_ID, SCAN_NUMBER, ANTENNA1, ANTENNA2, TIME"
+
+
+def time_bins(times, interval, lengths, timebin, full_baseline):
+    """
+    Output bin number of every row, for rows sorted so that a baseline's
+    rows of a scan are consecutive and in time order. lengths are the
+    baseline lengths (m) of the rows; interval the integration time (s).
+    """
+    width = np.where(lengths > full_baseline,
+                     timebin * full_baseline / np.maximum(lengths, 1e-9),
+                     timebin)
+    # Whole integrations per bin, at least one
+    ndump = np.maximum(1, np.floor(width / interval + 1e-6))
+    return np.floor((times + 1e-3) / (ndump * interval)).astype(np.int64)
+
+
+def bin_starts(keys):
+    """Indices where any of the keys (equal length arrays) changes"""
+    change = np.zeros(len(keys[0]), bool)
+    change[0:1] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.nonzero(change)[0]
+
+
+def _sigma(weight):
+    """SIGMA for summed weights (0 where nothing was averaged)"""
+    safe = np.where(weight > 0, weight, 1)
+    return np.where(weight > 0, 1 / np.sqrt(safe), 0).astype(np.float32)
+
+
+def _average_block(tab, out, start, nrow, starts, first, names, chanbin,
+                   spectral):
+    """Average rows [start, start + nrow) of tab into out from row first"""
+    rel = starts - start
+    flag = tab.getcol("FLAG", start, nrow)
+    if spectral:
+        weight = tab.getcol("WEIGHT_SPECTRUM", start, nrow)
+    else:
+        weight = np.repeat(tab.getcol("WEIGHT", start, nrow)[:, None, :],
+                           flag.shape[1], axis=1)
+    weight = np.where(flag, 0.0, weight).astype(np.float64)
+    edges = np.arange(0, flag.shape[1], chanbin)
+
+    def reduce(values):
+        # Over the rows of every bin, then over chanbin channels
+        summed = np.add.reduceat(values, rel, axis=0)
+        return np.add.reduceat(summed, edges, axis=1)
+
+    wsum = reduce(weight)
+    count = reduce(np.ones(flag.shape))
+    for name in names:
+        data = tab.getcol(name, start, nrow)
+        weighted = reduce(data * weight)
+        plain = reduce(data) / count
+        out.putcol(name, np.where(wsum > 0, weighted / np.where(
+            wsum > 0, wsum, 1), plain).astype(data.dtype), first, len(rel))
+    out.putcol("FLAG", wsum == 0, first, len(rel))
+    out.putcol("FLAG_ROW", (wsum == 0).all(axis=(1, 2)), first, len(rel))
+    if spectral:
+        out.putcol("WEIGHT_SPECTRUM", wsum.astype(np.float32), first,
+                   len(rel))
+    if "SIGMA_SPECTRUM" in out.colnames():
+        out.putcol("SIGMA_SPECTRUM", _sigma(wsum), first, len(rel))
+    row_weight = wsum.mean(axis=1)
+    out.putcol("WEIGHT", row_weight.astype(np.float32), first, len(rel))
+    out.putcol("SIGMA", _sigma(row_weight), first, len(rel))
+
+
+def _create(tab, output, nchan_out, chanbin, names):
+    """
+    Empty copy of tab's structure (and subtables) at output, without the
+    data columns that are not in names
+    """
+    import pyrap.tables as pt
+
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    desc = tab.getdesc()
+    for name in DATA_COLUMNS:
+        if name not in names:
+            desc.pop(name, None)
+    # Let casacore choose tile shapes for the new data shapes
+    desc["_define_hypercolumn_"] = {}
+    for name, coldesc in desc.items():
+        if (isinstance(coldesc, dict) and coldesc.get("ndim") == 2 and
+                "shape" in coldesc and chanbin > 1):
+            coldesc["shape"] = [nchan_out, coldesc["shape"][1]]
+    out = pt.table(output, desc, nrow=0, ack=False)
+    for key, value in tab.getkeywords().items():
+        if isinstance(value, str) and value.startswith("Table: "):
+            sub = pt.table(value[7:], ack=False)
+            sub.copy(os.path.join(output, key), deep=True, valuecopy=True)
+            sub.close()
+            out.putkeyword(key, "Table: " + os.path.join(output, key))
+    return out
+
+
+def _rebin_spectral_windows(output, chanbin):
+    import pyrap.tables as pt
+
+    spw = pt.table(os.path.join(output, "SPECTRAL_WINDOW"), readonly=False,
+                   ack=False)
+    try:
+        for row in range(spw.nrows()):
+            freqs = spw.getcell("CHAN_FREQ", row)
+            edges = np.arange(0, len(freqs), chanbin)
+            counts = np.diff(np.append(edges, len(freqs)))
+            spw.putcell("CHAN_FREQ", row,
+                        np.add.reduceat(freqs, edges) / counts)
+            for name in ("CHAN_WIDTH", "EFFECTIVE_BW", "RESOLUTION"):
+                spw.putcell(name, row,
+                            np.add.reduceat(spw.getcell(name, row), edges))
+            spw.putcell("NUM_CHAN", row, len(edges))
+    finally:
+        spw.close()
+
+
+def average_ms(msname, outputvis, field="", timebin=60.0, chanbin=1,
+               full_baseline=np.inf, datacolumns=DATA_COLUMNS,
+               chunk_bytes=columns.CHUNK_BYTES):
+    """
+    Write the averaged copy outputvis of the fields (ids or names) of
+    msname; see the module description. datacolumns that are missing from
+    msname are skipped; the other data columns are left out of outputvis.
+    """
+    import pyrap.tables as pt
+
+    tab = pt.table(msname, ack=False)
+    ant = pt.table(os.path.join(msname, "ANTENNA"), ack=False)
+    positions = ant.getcol("POSITION")
+    ant.close()
+    names = [name for name in datacolumns if name in tab.colnames()]
+    spectral = "WEIGHT_SPECTRUM" in tab.colnames()
+    nchan = tab.getcell("FLAG", 0).shape[0] if tab.nrows() else 0
+    nchan_out = -(-nchan // chanbin)
+
+    if field not in (None, ""):
+        sub = pt.table(os.path.join(msname, "FIELD"), ack=False)
+        fnames = sub.getcol("NAME")
+        sub.close()
+        fields = sorted(parse_fields(field, list(fnames)))
+        sel = tab.query("FIELD_ID IN [%s]" % ",".join(map(str, fields)),
+                        sortlist=SORT)
+    else:
+        sel = tab.query(sortlist=SORT)
+
+    out = _create(tab, outputvis, nchan_out, chanbin, names)
+    try:
+        meta = dict((name, sel.getcol(name)) for name in
+                    ("DATA_DESC_ID", "SCAN_NUMBER", "FIELD_ID", "ANTENNA1",
+                     "ANTENNA2", "TIME", "INTERVAL"))
+        lengths = np.linalg.norm(positions[meta["ANTENNA1"]] -
+                                 positions[meta["ANTENNA2"]], axis=1)
+        interval = np.median(meta["INTERVAL"]) if sel.nrows() else 1.0
+        bins = time_bins(meta["TIME"], interval, lengths, timebin,
+                         full_baseline)
+        starts = bin_starts([meta["DATA_DESC_ID"], meta["SCAN_NUMBER"],
+                             meta["FIELD_ID"], meta["ANTENNA1"],
+                             meta["ANTENNA2"], bins])
+        nout = len(starts)
+        out.addrows(nout)
+        stops = np.append(starts[1:], sel.nrows())
+        counts = stops - starts
+
+        # Row metadata; data columns other than names are not copied
+        skip = set(AVERAGED + SUMMED + DERIVED + DATA_COLUMNS)
+        for name in sel.colnames():
+            if name in skip or not nout or not sel.iscelldefined(name, 0):
+                continue
+            out.putcol(name, sel.getcol(name)[starts])
+        for name in AVERAGED + SUMMED:
+            if name not in sel.colnames():
+                continue
+            values = np.add.reduceat(sel.getcol(name), starts, axis=0)
+            if name in AVERAGED:
+                values = values / counts.reshape((-1,) + (1,) *
+                                                 (values.ndim - 1))
+            out.putcol(name, values)
+
+        # Visibilities, in blocks of whole bins
+        per_block = columns.rows_per_chunk(sel, "FLAG", chunk_bytes // max(
+            1, 2 * len(names) + 3))
+        index = 0
+        while index < nout:
+            last = index + 1
+            while last < nout and stops[last] - starts[index] <= per_block:
+                last += 1
+            first_row = starts[index]
+            _average_block(sel, out, first_row, stops[last - 1] - first_row,
+                           starts[index:last], index, names, chanbin,
+                           spectral)
+            index = last
+    finally:
+        out.close()
+        sel.close()
+        tab.close()
+    if chanbin > 1:
+        _rebin_spectral_windows(outputvis, chanbin)
+    print("%s: %d rows averaged to %d (timebin %gs, chanbin %d)" % (
+        os.path.basename(outputvis), len(bins), nout, timebin, chanbin))
+    return outputvis
+
+
+def rebin_spw(spw, chanbin):
+    """CASA spw selection ('0:50~435') for channels averaged by chanbin"""
+    if chanbin <= 1 or not spw:
+        return spw
+    items = []
+    for window, chans in sorted(parse_spw(spw).items()):
+        if chans is None:
+            items.append(str(window))
+        else:
+            items.append("%d:%d~%d" % (window, chans[0] // chanbin,
+                                       chans[1] // chanbin))
+    return ",".join(items)
+
+
+def route_steps(recipe, labels, working, chanbin=1):
+    """
+    Point the steps with the given labels at MS working (a name in the
+    recipe's ms_dir) instead of their own MS, rewriting spw selections for
+    chanbin. Raises KeyError for unknown labels and ValueError for steps
+    without an MS argument.
+    """
+    missing = [label for label in labels if label not in recipe.order]
+    if missing:
+        raise KeyError("route_steps: unknown step label(s) %s" %
+                       ", ".join(missing))
+    for step in recipe.get(labels):
+        keys = [key for key in graph.MS_KEYS if step.config.get(key)]
+        if not keys:
+            raise ValueError("route_steps: step '%s' has no MS argument "
+                             "(%s) to point at %s" % (
+                                 step.label, ", ".join(graph.MS_KEYS),
+                                 working))
+        for key in keys:
+            step.config[key] = working
+        if "spw" in step.config:
+            step.config["spw"] = rebin_spw(step.config["spw"], chanbin)
+
+
+@graph.register_io(average_ms)
+def _average_ms_io(step):
+    names = list(step.config.get("datacolumns", DATA_COLUMNS))
+    names += ["FLAG", "WEIGHT", "SIGMA", "WEIGHT_SPECTRUM"]
+    output = step.output_ms
+    writes = set(("column", output, name.upper()) for name in names)
+    writes.add(("table", output))
+    return graph.columns(step, *names), writes
@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the stages of the 1gc and 2gc recipes.
+
+A scenario is one stage (flagging, a calibration solve, applycal, plots,
+imaging, clean masks, source finding, copycol, snapshots, predict) run as
+the single step of a gcpipe.Recipe on a synthetic MS from gcpipe.synthms.
+Scenarios are registered with the `scenario` decorator, together with a
+grid of parameters to sweep (e.g. wsclean npix and nwlayers); the decorated
+function writes the inputs the step needs (calibration tables, images, sky
+models, untimed) and returns the step's cab and config.
+
+run_suite runs every variant of the chosen scenarios for every data size in
+SIZES and every worker count, `repeat` times each. The MSs are generated
+once and kept in the work directory with a pristine snapshot (see
+gcpipe.MSSnapshots) that is restored before every run, so each run sees the
+same data. A StepProfiler hook measures the step; the median wall time of
+the repeats is the figure compared between runs. Stages that are not
+multi-threaded run with one worker only.
+
+Steps of container cabs (the CASA solves, wsclean, pybdsm) go through the
+given backend. With a MockBackend (the default) they cost only the
+pipeline's own I/O; pass a ContainerPool or StimelaBackend to time the
+real tools.
+
+Results are saved as JSON together with a description of the machine.
+compare() matches them with a baseline file and marks every case whose
+median wall time grew by more than `threshold` as slower. Run
+
+    python -m gcpipe.bench --sizes small,medium --workers 1,4 \\
+        --baseline reports/bench/bench-<date>-<time>.json
+
+to benchmark and compare in one go; the exit status is 1 if anything got
+slower.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from gcpipe.applycal import applycal
+from gcpipe.autoflag import autoflag
+from gcpipe.cleanmask import cleanmask
+from gcpipe.columns import copycol
+from gcpipe.flagplan import flag_plan
+from gcpipe.instrument import StepProfiler
+from gcpipe.mock import (MockBackend, write_caltable, write_column,
+                         write_images, write_skymodel)
+from gcpipe.plotcal import plotcal
+from gcpipe.predict import predict
+from gcpipe.recipe import Recipe
+from gcpipe.scheduler import StepFailed
+from gcpipe.snapshot import MSSnapshots
+from gcpipe.synthms import make_gmrt_ms
+from gcpipe.visstats import visplots
+
+# make_gmrt_ms arguments of the data sizes
+SIZES = {
+    "small"  : {"nchan": 64, "schedule": ((0, 120), (1, 60), (2, 300),
+                                          (1, 60))},
+    "medium" : {"nchan": 512},
+    "large"  : {"nchan": 2048},
+}
+
+# Snapshot of every benchmark MS restored before each run
+PRISTINE = "PRISTINE"
+
+# Field names of the synthetic data (see gcpipe.synthms.FIELDS)
+BANDPASS_CAL, PHASE_CAL, TARGET = "3C48", "3C091", "GALSYN"
+
+SCENARIOS = {}
+
+
+class Scenario(object):
+    """A stage to benchmark and the grid of parameters it is swept over"""
+
+    def __init__(self, name, stage, build, grid, threaded):
+        self.name = name
+        self.stage = stage
+        self.build = build
+        self.grid = grid
+        self.threaded = threaded
+
+    def variants(self):
+        """Every combination of the grid, as dicts"""
+        keys = sorted(self.grid)
+        return [dict(zip(keys, values)) for values in
+                itertools.product(*[self.grid[key] for key in keys])]
+
+
+def scenario(name, stage, threaded=True, **grid):
+    """
+    Decorator registering build(bench, **params) -> (cab, config) as
+    scenario name of stage, swept over grid (lists of values by param).
+    """
+    def wrapper(build):
+        SCENARIOS[name] = Scenario(name, stage, build, grid, threaded)
+        return build
+    return wrapper
+
+
+class Bench(object):
+    """What a scenario builds its step from: the MS and the work directory"""
+
+    def __init__(self, ms, output, workers, size_args):
+        self.ms = ms
+        self.ms_dir, self.msname = os.path.split(ms)
+        self.output = output
+        self.workers = workers
+        self.nchan = size_args.get("nchan", 512)
+
+    def path(self, name):
+        return os.path.join(self.output, name)
+
+    def caltable(self, name, kind, field=""):
+        """A unit-gain table in the output directory; returns its name"""
+        write_caltable(self.path(name), self.ms, kind, field)
+        return name
+
+
+def case_key(name, params, size, workers):
+    """The name of one benchmark case, e.g. wsclean[npix=1024]/small/w4"""
+    label = ",".join("%s=%s" % item for item in sorted(params.items()))
+    return "%s%s/%s/w%d" % (name, "[%s]" % label if label else "", size,
+                            workers)
+
+
+# Flagging
+
+@scenario("autoflag", "flagging")
+def _autoflag(bench):
+    return autoflag, {"msname": bench.msname, "column": "DATA",
+                      "threshold": 6.0, "iterations": 3,
+                      "workers": bench.workers}
+
+
+@scenario("flag_plan", "flagging", threaded=False)
+def _flag_plan(bench):
+    edge = max(1, bench.nchan // 32)
+    return flag_plan, {"msname": bench.msname, "commands": [
+        {"mode": "quack", "quackinterval": 30.0, "quackmode": "beg"},
+        {"mode": "manual", "autocorr": True},
+        {"mode": "manual", "antenna": "C05,E04"},
+        {"mode": "manual", "spw": "0:0~%d" % edge, "autocorr": True},
+        {"mode": "manual", "spw": "0:%d~%d" % (bench.nchan - edge,
+                                               bench.nchan - 1),
+         "autocorr": True},
+    ]}
+
+
+# Calibration solves
+
+@scenario("setjy", "solve", threaded=False)
+def _setjy(bench):
+    return "cab/casa_setjy", {"msname": bench.msname, "field": BANDPASS_CAL,
+                              "standard": "Perley-Butler 2013",
+                              "usescratch": False, "scalebychan": True,
+                              "spw": ""}
+
+
+@scenario("gaincal", "solve", threaded=False, gaintype=["G", "K"])
+def _gaincal(bench, gaintype):
+    config = {"msname": bench.msname, "caltable": "bench.%s:output" %
+              gaintype, "field": BANDPASS_CAL, "refant": "C00",
+              "gaintype": gaintype, "minsnr": 3}
+    if gaintype == "K":
+        config.update(solint="inf", combine="scan", gaintable=[
+            bench.caltable("bench.G0", "G", BANDPASS_CAL) + ":output"])
+    else:
+        config.update(solint="85s", calmode="p")
+    return "cab/casa_gaincal", config
+
+
+@scenario("bandpass", "solve", threaded=False)
+def _bandpass(bench):
+    return "cab/casa_bandpass", {
+        "msname": bench.msname, "caltable": "bench.B:output",
+        "field": BANDPASS_CAL, "refant": "C00", "combine": "scan",
+        "solint": "inf", "bandtype": "B", "solnorm": True, "minsnr": 3,
+        "gaintable": [
+            bench.caltable("bench.G0", "G", BANDPASS_CAL) + ":output",
+            bench.caltable("bench.K", "K", BANDPASS_CAL) + ":output"],
+        "interp": ["", ""]}
+
+
+@scenario("fluxscale", "solve", threaded=False)
+def _fluxscale(bench):
+    fields = "%s,%s" % (BANDPASS_CAL, PHASE_CAL)
+    return "cab/casa_fluxscale", {
+        "msname": bench.msname,
+        "caltable": bench.caltable("bench.G1", "G", fields) + ":output",
+        "fluxtable": "bench.F:output", "reference": [BANDPASS_CAL],
+        "transfer": [PHASE_CAL], "incremental": False}
+
+
+# Applying the solutions
+
+@scenario("applycal", "applycal")
+def _applycal(bench):
+    fields = "%s,%s" % (BANDPASS_CAL, PHASE_CAL)
+    tables = [bench.caltable("bench.F", "G", fields),
+              bench.caltable("bench.K", "K", BANDPASS_CAL),
+              bench.caltable("bench.B", "B", BANDPASS_CAL)]
+    return applycal, {
+        "msname": bench.msname,
+        "gaintable": [name + ":output" for name in tables],
+        "fields": [
+            {"field": BANDPASS_CAL, "gainfield": ["", "", BANDPASS_CAL],
+             "interp": ["", "", "linear"]},
+            {"field": "%s,%s" % (PHASE_CAL, TARGET),
+             "gainfield": [PHASE_CAL, "", ""],
+             "interp": ["nearest", "", ""]},
+        ],
+        "calwt": [False], "parang": False, "workers": bench.workers}
+
+
+# Plots
+
+@scenario("plotcal", "plots")
+def _plotcal(bench):
+    table = bench.caltable("bench.B", "B", BANDPASS_CAL)
+    return plotcal, {
+        "caltable": table + ":output", "subplot": 655,
+        "iteration": "antenna", "workers": bench.workers,
+        "plots": [{"poln": poln, "xaxis": "chan", "yaxis": yaxis,
+                   "figfile": "bench-B-%s-%s.png:output" % (poln, yaxis)}
+                  for poln in "RL" for yaxis in ("amp", "phase")]}
+
+
+@scenario("plotms", "plots")
+def _plotms(bench):
+    write_column(bench.ms, "CORRECTED_DATA", "DATA")
+    plots = []
+    for corr in ("RR", "LL"):
+        plots += [
+            {"field": BANDPASS_CAL, "correlation": corr, "xaxis": "phase",
+             "plotfile": "bench-ampvsphase-%s.png:output" % corr},
+            {"field": TARGET, "correlation": corr, "avgtime": "1000",
+             "xaxis": "freq", "plotfile": "bench-freq-%s.png:output" % corr},
+            {"field": TARGET, "correlation": corr, "avgtime": "1000",
+             "xaxis": "time", "plotfile": "bench-time-%s.png:output" % corr},
+        ]
+    return visplots, {"msname": bench.msname, "datacolumn": "corrected",
+                      "workers": bench.workers, "plots": plots}
+
+
+# Imaging and source finding
+
+@scenario("wsclean", "imaging", npix=[1024, 4096], nwlayers=[1, 32, 128])
+def _wsclean(bench, npix, nwlayers):
+    return "cab/wsclean", {
+        "msname": bench.msname, "field": TARGET, "weight": "briggs 0",
+        "npix": npix, "cellsize": 2.0, "stokes": "I", "nwlayers": nwlayers,
+        "clean_iterations": 1000, "gain": 0.05, "mgain": 0.9,
+        "auto-threshold": 10, "prefix": "bench-image:output",
+        "j": bench.workers}
+
+
+@scenario("cleanmask", "imaging", npix=[1024, 4096])
+def _cleanmask(bench, npix):
+    write_images(bench.path("bench-image"), npix, seed=0)
+    return cleanmask, {"image": "bench-image-image.fits:output",
+                       "output": "bench-mask.fits:output", "sigma": 10,
+                       "workers": bench.workers}
+
+
+@scenario("pybdsm", "imaging", threaded=False, npix=[1024, 4096])
+def _pybdsm(bench, npix):
+    write_images(bench.path("bench-image"), npix, seed=0)
+    return "cab/pybdsm", {"image": "bench-image-image.fits:output",
+                          "outfile": "bench-LSM:output", "thresh_pix": 25,
+                          "thresh_isl": 15, "port2tigger": True,
+                          "clobber": True}
+
+
+# MS handling and prediction
+
+@scenario("copycol", "ms")
+def _copycol(bench):
+    return copycol, {"msname": bench.msname, "fromcol": "DATA",
+                     "tocol": "CORRECTED_DATA", "workers": bench.workers}
+
+
+def take_snapshot(msname, name, root=None):
+    """MSSnapshots(msname, root).take(name), as a recipe step"""
+    return MSSnapshots(msname, root).take(name)
+
+
+@scenario("snapshot", "ms", threaded=False, incremental=[False, True])
+def _snapshot(bench, incremental):
+    root = bench.path("snapshots")
+    if incremental:
+        # Only the column added since the first snapshot is copied
+        MSSnapshots(bench.ms, root).take("before")
+        write_column(bench.ms, "CORRECTED_DATA", "DATA")
+    return take_snapshot, {"msname": bench.msname, "name": "bench",
+                           "root": root}
+
+
+@scenario("predict", "predict", sources=[10, 100])
+def _predict(bench, sources):
+    write_skymodel(bench.path("bench.lsm.html"), bench.ms, sources, seed=0)
+    return predict, {"msname": bench.msname,
+                     "skymodel": "bench.lsm.html:output",
+                     "column": "CORRECTED_DATA", "input_column": "DATA",
+                     "mode": "add", "workers": bench.workers}
+
+
+def machine():
+    """Description of the machine and software the benchmarks ran on"""
+    info = {
+        "hostname"  : socket.gethostname(),
+        "platform"  : platform.platform(),
+        "python"    : platform.python_version(),
+        "cpus"      : multiprocessing.cpu_count(),
+        "numpy"     : np.__version__,
+        "time"      : time.time(),
+    }
+    try:
+        with open("/proc/meminfo") as stdr:
+            for line in stdr:
+                if line.startswith("MemTotal:"):
+                    info["memory"] = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    try:
+        import casacore
+        info["casacore"] = casacore.__version__
+    except (ImportError, AttributeError):
+        pass
+    try:
+        with open(os.devnull, "w") as null:
+            info["commit"] = subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], stderr=null,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def dataset(directory, size):
+    """Path to the MS of size in directory, generated if missing or stale"""
+    args = SIZES[size]
+    path = os.path.join(directory, size + ".ms")
+    spec = os.path.join(directory, size + ".json")
+    snapshots = MSSnapshots(path)
+    wanted = json.loads(json.dumps(args))
+    if os.path.exists(spec):
+        with open(spec) as stdr:
+            if json.load(stdr) == wanted and PRISTINE in snapshots.names():
+                return path
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    make_gmrt_ms(path, **args)
+    shutil.rmtree(snapshots.root, ignore_errors=True)
+    snapshots.take(PRISTINE)
+    with open(spec, "w") as stdw:
+        json.dump(wanted, stdw)
+    return path
+
+
+def run_case(case, params, ms, size, workers, repeat, backend, work):
+    """Run one variant of a scenario repeat times; returns its result"""
+    runs = []
+    failure = None
+    output = os.path.join(work, "output")
+    for index in range(repeat):
+        MSSnapshots(ms).restore(PRISTINE)
+        shutil.rmtree(output, ignore_errors=True)
+        os.makedirs(output)
+        bench = Bench(ms, output, workers, SIZES[size])
+        cab, config = case.build(bench, **params)
+        profiler = StepProfiler(os.path.join(work, "profiles"),
+                                prefix=time.strftime("bench-%Y%m%d-%H%M%S"))
+        recipe = Recipe("bench %s" % case.name, ms_dir=bench.ms_dir,
+                        backend=backend, hooks=[profiler])
+        recipe.add(cab, case.name, config, input=output, output=output,
+                   label=case.name)
+        try:
+            recipe.run()
+        except StepFailed as error:
+            failure = str(error)
+            break
+        runs.append(profiler.records[-1])
+    walls = [run["wall"] for run in runs]
+    return {
+        "key"      : case_key(case.name, params, size, workers),
+        "scenario" : case.name,
+        "stage"    : case.stage,
+        "params"   : params,
+        "size"     : size,
+        "workers"  : workers,
+        "wall"     : float(np.median(walls)) if failure is None else None,
+        "runs"     : runs,
+        "failure"  : failure,
+    }
+
+
+def select(names=None):
+    """Scenarios by name or stage (all if names is empty), in name order"""
+    chosen = [case for _, case in sorted(SCENARIOS.items())
+              if not names or case.name in names or case.stage in names]
+    unknown = set(names or ()) - set(case.name for case in chosen) - set(
+        case.stage for case in chosen)
+    if unknown:
+        raise ValueError("Unknown scenario(s) or stage(s): %s" %
+                         ", ".join(sorted(unknown)))
+    return chosen
+
+
+def run_suite(names=None, sizes=("small",), workers=(1, 4), repeat=3,
+              backend=None, work="bench"):
+    """
+    Run the scenarios (or stages) in names for every size and worker count;
+    returns {"machine": machine(), "backend": ..., "results": [...]}.
+    """
+    for size in sizes:
+        if size not in SIZES:
+            raise ValueError("Unknown data size '%s'" % size)
+    data = os.path.join(work, "data")
+    backend = backend or MockBackend(ms_dir=data)
+    results = []
+    for size in sizes:
+        ms = dataset(data, size)
+        for case in select(names):
+            for params in case.variants():
+                for count in (workers if case.threaded else workers[:1]):
+                    result = run_case(case, params, ms, size, count, repeat,
+                                      backend, work)
+                    print(result_line(result))
+                    results.append(result)
+        MSSnapshots(ms).restore(PRISTINE)
+    close = getattr(backend, "close", None)
+    if close is not None:
+        close()
+    return {"machine": machine(), "backend": type(backend).__name__,
+            "results": results}
+
+
+def result_line(result):
+    if result["failure"] is not None:
+        return "%-48s FAILED" % result["key"]
+    runs = result["runs"]
+    return "%-48s %9.2f s %9.1f MB rss %9.1f MB written" % (
+        result["key"], result["wall"],
+        max(run["peak_rss"] for run in runs) / 2.0**20,
+        np.median([run["write_bytes"] for run in runs]) / 2.0**20)
+
+
+def save(suite, directory):
+    """Write suite to <directory>/bench-<date>-<time>.json; returns the path"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, time.strftime("bench-%Y%m%d-%H%M%S.json"))
+    with open(path, "w") as stdw:
+        json.dump(suite, stdw, indent=1, sort_keys=True)
+    return path
+
+
+def load(path):
+    with open(path) as stdr:
+        return json.load(stdr)
+
+
+def compare(suite, baseline, threshold=0.1):
+    """
+    Rows (key, baseline wall, wall, ratio, verdict) of the cases of suite;
+    verdict is "slower" or "faster" if the median wall time changed by more
+    than threshold (a fraction), "same", "new" (not in the baseline) or
+    "failed".
+    """
+    before = dict((result["key"], result) for result in baseline["results"])
+    rows = []
+    for result in suite["results"]:
+        old = before.get(result["key"])
+        wall = result["wall"]
+        if wall is None:
+            rows.append((result["key"], None, None, None, "failed"))
+            continue
+        if old is None or not old["wall"]:
+            rows.append((result["key"], None, wall, None, "new"))
+            continue
+        ratio = wall / old["wall"]
+        if ratio > 1 + threshold:
+            verdict = "slower"
+        elif ratio < 1 / (1 + threshold):
+            verdict = "faster"
+        else:
+            verdict = "same"
+        rows.append((result["key"], old["wall"], wall, ratio, verdict))
+    return rows
+
+
+def machine_differences(suite, baseline):
+    """Keys of the machine descriptions that differ, e.g. ['cpus']"""
+    keys = ("hostname", "platform", "python", "cpus", "memory", "numpy",
+            "casacore")
+    return [key for key in keys if suite["machine"].get(key) !=
+            baseline["machine"].get(key)]
+
+
+def report(rows, threshold):
+    """Table of compare() rows"""
+    lines = ["%-48s %10s %10s %7s  %s" % ("case", "base(s)", "now(s)",
+                                          "ratio", "verdict")]
+    for key, old, wall, ratio, verdict in rows:
+        lines.append("%-48s %10s %10s %7s  %s" % (
+            key[:48], "-" if old is None else "%.2f" % old,
+            "-" if wall is None else "%.2f" % wall,
+            "-" if ratio is None else "%.2f" % ratio, verdict))
+    slower = sum(1 for row in rows if row[4] == "slower")
+    lines.append("%d of %d cases slower by more than %d%%" % (
+        slower, len(rows), 100 * threshold))
+    return "\n".join(lines)
+
+
+def _backend(name, ms_dir):
+    from gcpipe.pool import ContainerPool
+    from gcpipe.recipe import StimelaBackend
+    backends = {"mock": MockBackend, "pool": ContainerPool,
+                "stimela": StimelaBackend}
+    return backends[name](ms_dir=ms_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of the 1gc and 2gc recipes")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios or stages to run (default: all)")
+    parser.add_argument("--sizes", default="small",
+                        help="data sizes, comma separated (%s)" %
+                        ", ".join(sorted(SIZES)))
+    parser.add_argument("--workers", default="1,4",
+                        help="worker counts, comma separated")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backend", default="mock",
+                        choices=("mock", "pool", "stimela"),
+                        help="runs the container cabs")
+    parser.add_argument("--work", default="bench",
+                        help="directory for the data and the step outputs")
+    parser.add_argument("--reports", default=os.path.join("reports",
+                                                          "bench"))
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown reported as a regression")
+    parser.add_argument("--list", action="store_true",
+                        help="list the scenarios and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for case in select():
+            print("%-12s %-10s %s" % (case.name, case.stage, ", ".join(
+                "%s=%s" % item for item in sorted(case.grid.items()))))
+        return 0
+    try:
+        select(args.scenarios)
+    except ValueError as error:
+        parser.error(str(error))
+    backend = _backend(args.backend, os.path.join(args.work, "data"))
+    suite = run_suite(args.scenarios, args.sizes.split(","),
+                      [int(count) for count in args.workers.split(",")],
+                      args.repeat, backend, args.work)
+    print("Results written to %s" % save(suite, args.reports))
+    if not args.baseline:
+        return 0
+    baseline = load(args.baseline)
+    differences = machine_differences(suite, baseline)
+    if differences:
+        print("Warning: the baseline ran on a different machine (%s)" %
+              ", ".join(differences))
+    rows = compare(suite, baseline, args.threshold)
+    print(report(rows, args.threshold))
+    return 1 if any(row[4] == "slower" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
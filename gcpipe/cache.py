@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed step cache.
+
+A step's key is a hash of its cab, its parameters and the lineage of every
+resource it reads (and of every MS column it modifies in place). The lineage
+of a resource is the chain of step keys that produced its current content,
+starting from a fingerprint of the data as first seen. After a run the
+lineage and a cheap stat based fingerprint of every resource is stored, so on
+the next run a step whose key is unchanged is skipped as long as the data on
+disk is still the data it produced.
+
+Because measurement sets are modified in place, hits have to be replayed in
+the original order: a step is only skipped if its output is the next entry in
+the recorded history of each resource it writes. The same holds for files
+and image prefixes, which can be written by more than one step of a run (a
+wsclean -continue step reusing the prefix of the one before). If a step has
+to rerun on data that later steps of the previous run have already modified,
+a warning is printed since the result may differ from a clean run; restore a
+copy of the MS first if that matters.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import glob
+import hashlib
+import json
+import os
+import threading
+
+from gcpipe import graph
+
+STATE_FILE = "state.json"
+
+# Longest history kept per resource
+MAX_CHAIN = 256
+
+
+def _hash(*items):
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(json.dumps(item, sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+
+def _tree(path):
+    if os.path.isdir(path):
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                yield os.path.join(root, name)
+    elif os.path.exists(path):
+        yield path
+
+
+def stat_fingerprint(paths):
+    """Hash of the names, sizes and modification times of paths (recursive)"""
+    digest = hashlib.sha1()
+    found = False
+    for path in paths:
+        for name in _tree(path):
+            info = os.stat(name)
+            digest.update(("%s|%d|%d\n" % (name, info.st_size,
+                           int(info.st_mtime * 1e6))).encode())
+            found = True
+    return digest.hexdigest() if found else None
+
+
+def column_files(ms, column):
+    """Storage manager files holding column (whole MS if pyrap is missing)"""
+    try:
+        import pyrap.tables as pt
+    except ImportError:
+        return [ms]
+    if not os.path.isdir(ms):
+        return []
+    tab = pt.table(ms, ack=False)
+    try:
+        if column not in tab.colnames():
+            return []
+        seqnr = tab.getdminfo(column)["SEQNR"]
+    finally:
+        tab.close()
+    stem = os.path.join(ms, "table.f%d" % seqnr)
+    return sorted(glob.glob(stem) + glob.glob(stem + "_*"))
+
+
+def fingerprint(resource):
+    kind = resource[0]
+    if kind == "column":
+        return stat_fingerprint(column_files(resource[1], resource[2]))
+    if kind == "prefix":
+        return stat_fingerprint(sorted(glob.glob(resource[1] + "*")))
+    return stat_fingerprint([resource[1]])
+
+
+def _rid(resource):
+    return "|".join(resource)
+
+
+class StepCache(object):
+    """Persistent cache stored in directory `path`"""
+
+    def __init__(self, path):
+        self.path = path
+        self._session = None
+
+    def load(self):
+        name = os.path.join(self.path, STATE_FILE)
+        if not os.path.exists(name):
+            return {"steps": {}, "resources": {}}
+        with open(name) as stdr:
+            return json.load(stdr)
+
+    def save(self, state):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = os.path.join(self.path, STATE_FILE)
+        with open(name + ".tmp", "w") as stdw:
+            json.dump(state, stdw, indent=1, sort_keys=True)
+        os.rename(name + ".tmp", name)
+
+    def session(self):
+        """
+        Bookkeeping shared by every Recipe.run call of this process, so that
+        a script made of several runs is replayed as one history.
+        """
+        if self._session is None:
+            self._session = CacheSession(self)
+        return self._session
+
+
+class CacheEntry(object):
+
+    def __init__(self, step, key, reads, writes, hit):
+        self.step = step
+        self.key = key
+        self.reads = reads
+        self.writes = writes
+        self.hit = hit
+
+
+class CacheSession(object):
+    """Cache bookkeeping for the recipe runs of one process"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.state = cache.load()
+        self.lock = threading.Lock()
+        self.resources = {}
+        self.lineage = {}
+        self.position = {}
+        self.disabled = False
+
+    def _track(self, resource):
+        """Start tracking a resource, adopting its stored history if valid"""
+        rid = _rid(resource)
+        if rid in self.resources:
+            return rid
+        self.resources[rid] = resource
+        record = self.state["resources"].get(rid)
+        current = fingerprint(resource)
+        if record is None or record["fingerprint"] != current:
+            record = {"base": "fp:%s" % current, "chain": [],
+                      "fingerprint": current}
+            self.state["resources"][rid] = record
+        self.lineage[rid] = record["base"]
+        self.position[rid] = 0
+        return rid
+
+    def _consistent(self, rid):
+        """True if the data on disk matches the lineage of this run"""
+        return self.position[rid] == len(self.state["resources"][rid]["chain"])
+
+    def begin(self, step):
+        """Work out the step's key and whether its result is cached"""
+        io = graph.step_io(step)
+        with self.lock:
+            if io is graph.BARRIER or self.disabled:
+                # Unknown steps may touch anything: stop trusting the cache
+                self.disabled = True
+                return CacheEntry(step, None, [], [], False)
+            reads = sorted(self._track(r) for r in io[0] if r[0] != "table")
+            writes = sorted(self._track(w) for w in io[1] if w[0] != "table")
+            inplace = [w for w in writes if self.resources[w][0] == "column"]
+            key = _hash(step.cab_name, step.config,
+                        [(rid, self.lineage[rid]) for rid in reads],
+                        [(rid, self.lineage[rid]) for rid in inplace])
+            hit = key in self.state["steps"] and all(
+                self._next(rid) == _hash(key, rid) for rid in writes)
+            if hit:
+                for rid in writes:
+                    self.lineage[rid] = _hash(key, rid)
+                    self.position[rid] += 1
+            else:
+                stale = sorted(set(rid for rid in reads + inplace
+                                   if not self._consistent(rid)))
+                if stale:
+                    print("%s: rerunning on data already modified by later "
+                          "steps of a previous run (%s)" %
+                          (step.label, ", ".join(stale)))
+            return CacheEntry(step, key, reads, writes, hit)
+
+    def _next(self, rid):
+        chain = self.state["resources"][rid]["chain"]
+        position = self.position[rid]
+        return chain[position] if position < len(chain) else None
+
+    def commit(self, entry):
+        """Record a successfully executed step"""
+        if entry.key is None:
+            return
+        with self.lock:
+            for rid in entry.writes:
+                record = self.state["resources"][rid]
+                token = _hash(entry.key, rid)
+                # History not replayed in this run no longer applies. Files
+                # and prefixes keep one entry per writer too: a wsclean
+                # prefix may be written again by a later -continue step
+                chain = record["chain"][:self.position[rid]] + [token]
+                if len(chain) > MAX_CHAIN:
+                    record["base"] = chain[-MAX_CHAIN - 1]
+                    chain = chain[-MAX_CHAIN:]
+                record["chain"] = chain
+                self.position[rid] = len(chain)
+                self.lineage[rid] = token
+            self.state["steps"][entry.key] = {"label": entry.step.label}
+            self._refresh(entry)
+            self.cache.save(self.state)
+
+    def _refresh(self, entry):
+        """Update fingerprints of everything the step may have changed"""
+        changed = set(entry.writes)
+        # Columns can share storage manager files with their neighbours
+        changed.update(rid for rid, resource in self.resources.items()
+                       if resource[0] == "column" and
+                       resource[1] == entry.step.ms)
+        # Files below a prefix the step wrote (and the other way round)
+        writes = [self.resources[rid] for rid in entry.writes]
+        changed.update(rid for rid, resource in self.resources.items()
+                       if graph.intersects([resource], writes))
+        for rid in changed:
+            self.state["resources"][rid]["fingerprint"] = \
+                fingerprint(self.resources[rid])
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process clean masks, replacing `cab/cleanmask`.
+
+The image is memory-mapped and split into a boxes x boxes grid of tiles. The
+noise of every tile is estimated by iterative sigma clipping over the tile
+extended by `overlap` (a fraction of the tile size) on each side, so that
+sources on tile edges do not bias the estimate of one tile only. Pixels above
+`sigma` times the local noise are masked.
+
+With workers > 1 the tiles are spread over a process pool. Every worker maps
+the image and the (pre-allocated) mask file itself and writes the mask of its
+own tiles, so no pixel data passes between processes.
+
+The tile noise levels are kept in the image's statistics sidecar (see
+gcpipe.fitsio), so masking the same image again at another sigma only
+thresholds it.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from gcpipe import graph
+from gcpipe.fitsio import FitsImage, create_image
+from gcpipe.scheduler import forks
+
+# Clipping level, in units of the current noise estimate
+CLIP = 3.0
+
+_worker_images = {}
+
+
+def _image(path, mode="r"):
+    key = (path, mode)
+    if key not in _worker_images:
+        _worker_images[key] = FitsImage(path, mode=mode)
+    return _worker_images[key]
+
+
+def clipped_rms(data, iters=30, tolerance=0.01, negative=True):
+    """
+    Noise of data from iterative CLIP-sigma clipping, stopping when the
+    estimate changes by less than tolerance (a fraction). With negative, the
+    estimate uses the negative pixels only, mirrored around zero, as these
+    are free of (positive) sources.
+    """
+    data = np.asarray(data, dtype=np.float64).ravel()
+    data = data[np.isfinite(data)]
+    if negative:
+        data = data[data < 0]
+        data = np.concatenate([data, -data])
+    if not data.size:
+        return 0.0
+    centre = 0.0 if negative else np.median(data)
+    rms = data.std()
+    for _ in range(iters):
+        kept = data[np.abs(data - centre) < CLIP * rms]
+        if not kept.size:
+            break
+        if not negative:
+            centre = np.median(kept)
+        previous, rms = rms, kept.std()
+        if abs(previous - rms) <= tolerance * previous:
+            break
+    return float(rms)
+
+
+def dilate_mask(mask, iterations=1):
+    """Grow a boolean mask by one pixel along both axes per iteration"""
+    for _ in range(iterations):
+        grown = mask.copy()
+        grown[1:] |= mask[:-1]
+        grown[:-1] |= mask[1:]
+        grown[:, 1:] |= mask[:, :-1]
+        grown[:, :-1] |= mask[:, 1:]
+        mask = grown
+    return mask
+
+
+def tiles(shape, boxes=11, overlap=0.3):
+    """
+    (core, padded) pairs of (row slice, column slice) for a boxes x boxes
+    grid over a 2-D shape; padded extends core by overlap on every side.
+    """
+    edges = [np.linspace(0, size, min(boxes, size) + 1).astype(int)
+             for size in shape]
+    result = []
+    for y0, y1 in zip(edges[0][:-1], edges[0][1:]):
+        for x0, x1 in zip(edges[1][:-1], edges[1][1:]):
+            pady = int(np.ceil(overlap * (y1 - y0)))
+            padx = int(np.ceil(overlap * (x1 - x0)))
+            result.append(((slice(y0, y1), slice(x0, x1)),
+                           (slice(max(y0 - pady, 0), y1 + pady),
+                            slice(max(x0 - padx, 0), x1 + padx))))
+    return result
+
+
+def _mask_tile(job):
+    (image, output, core, padded, sigma, iters, tolerance, negative, dilate,
+     noise) = job
+    data = _image(image).plane()[padded]
+    if noise is None:
+        noise = clipped_rms(data, iters, tolerance, negative)
+    with np.errstate(invalid="ignore"):
+        mask = data > sigma * noise if noise > 0 else np.zeros(data.shape,
+                                                                bool)
+    mask = dilate_mask(mask, dilate)
+    # Position of the core within the padded tile
+    inner = tuple(slice(c.start - p.start, c.stop - p.start)
+                  for c, p in zip(core, padded))
+    target = _image(output, "r+")
+    target.data.reshape((-1,) + target.shape[-2:])[0][core] = mask[inner]
+    target.data.flush()
+    return noise, int(mask[inner].sum())
+
+
+@forks()
+def cleanmask(image, output, sigma=5, iters=30, tolerance=0.01, boxes=11,
+              overlap=0.3, no_negative=False, dilate=False, workers=4):
+    """
+    Write a clean mask for FITS image to output: 1 where the image exceeds
+    sigma times the local noise, 0 elsewhere. The noise comes from the
+    negative pixels unless no_negative is set, in which case all pixels are
+    clipped. dilate grows the mask by that many pixels (True is 1).
+    """
+    template = FitsImage(image)
+    shape = template.shape[-2:]
+    dilate = int(dilate)
+    # The padding must cover the dilation for tiles to join up seamlessly
+    overlap = max(overlap, dilate * boxes / float(min(shape)))
+    grid = tiles(shape, boxes, overlap)
+    key = "tile_noise %d %g %d %g %s" % (boxes, overlap, iters, tolerance,
+                                         not no_negative)
+    known = template.lookup(key) or [None] * len(grid)
+    temp = output + ".tmp"
+    create_image(temp, template)
+    jobs = [(image, temp, core, padded, sigma, iters, tolerance,
+             not no_negative, dilate, noise)
+            for (core, padded), noise in zip(grid, known)]
+    if workers <= 1:
+        results = [_mask_tile(job) for job in jobs]
+    else:
+        pool = Pool(min(workers, len(jobs)))
+        try:
+            results = pool.map(_mask_tile, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    _worker_images.clear()
+    os.rename(temp, output)
+
+    noise = [result[0] for result in results]
+    if known[0] is None:
+        template.store(key, noise)
+    masked = sum(result[1] for result in results)
+    print("%s: %.2f%% of pixels masked, local noise %.3g - %.3g" % (
+        os.path.basename(output), 100.0 * masked / (shape[0] * shape[1]),
+        min(noise), max(noise)))
+    return output
+
+
+@graph.register_io(cleanmask)
+def _cleanmask_io(step):
+    return graph.files(step, "image"), graph.files(step, "output")
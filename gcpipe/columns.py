@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process visibility column copies, replacing `cab/msutils copycol`.
+
+Rows are copied in blocks of about CHUNK_BYTES. With workers > 1 the blocks
+are spread over a process pool; every worker opens the MS with user locking,
+reads its block under a shared read lock and writes it under the write lock,
+so reads proceed in parallel while casacore serialises the writes.
+
+If the source column is not read again before it is rewritten, rename=True
+moves it to the destination instead of copying any data.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from gcpipe import graph
+from gcpipe.scheduler import forks
+
+CHUNK_BYTES = 256 * 2**20
+
+_worker_table = {}
+
+
+def _table(ms, **kw):
+    import pyrap.tables as pt
+    return pt.table(ms, ack=False, **kw)
+
+
+def _dm_name(tab, base):
+    """A data manager name not used in tab yet"""
+    used = set(info["NAME"] for info in tab.getdminfo().values())
+    name, count = base, 0
+    while name in used:
+        count += 1
+        name = "%s_%d" % (base, count)
+    return name
+
+
+def add_column_like(tab, template, name):
+    """Add column `name` to tab with the description and storage of template"""
+    import pyrap.tables as pt
+    desc = tab.getcoldesc(template)
+    dminfo = tab.getdminfo(template)
+    dminfo["NAME"] = _dm_name(tab, name)
+    tab.addcols(pt.makecoldesc(name, desc), dminfo)
+
+
+def row_blocks(nrows, rows_per_block):
+    return [(start, min(rows_per_block, nrows - start))
+            for start in range(0, nrows, rows_per_block)]
+
+
+def row_runs(rows):
+    """(start, nrow) of the runs of consecutive numbers in sorted rows"""
+    if not len(rows):
+        return []
+    breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(rows)]])
+    return [(int(rows[a]), int(b - a)) for a, b in zip(starts, stops)]
+
+
+def rows_per_chunk(tab, column, chunk_bytes=CHUNK_BYTES):
+    """Number of rows of column that fit in chunk_bytes"""
+    if tab.nrows() == 0:
+        return 1
+    return max(1, chunk_bytes // max(1, tab.getcell(column, 0).nbytes))
+
+
+def _copy_block(args):
+    ms, fromcol, tocol, start, nrow = args
+    tab = _worker_table.get(ms)
+    if tab is None:
+        tab = _worker_table[ms] = _table(ms, readonly=False,
+                                         lockoptions="user")
+    tab.lock(write=False)
+    try:
+        data = tab.getcol(fromcol, start, nrow)
+    finally:
+        tab.unlock()
+    tab.lock(write=True)
+    try:
+        tab.putcol(tocol, data, start, nrow)
+    finally:
+        tab.unlock()
+    return nrow
+
+
+def rename_column(ms, fromcol, tocol, recreate=True):
+    """
+    Make `fromcol` the new `tocol` without touching the data. The old tocol
+    is removed. With recreate, an empty fromcol is added back so the MS keeps
+    the same set of columns; its contents are undefined until rewritten.
+    """
+    tab = _table(ms, readonly=False)
+    try:
+        if tocol in tab.colnames():
+            tab.removecols(tocol)
+        tab.renamecol(fromcol, tocol)
+        if recreate:
+            add_column_like(tab, tocol, fromcol)
+    finally:
+        tab.close()
+
+
+@forks()
+def copycol(msname, fromcol, tocol, rename=False, recreate=True, workers=1,
+            chunk_bytes=CHUNK_BYTES):
+    """
+    Copy column fromcol of msname to tocol (created if missing). See
+    rename_column for rename/recreate.
+    """
+    if rename:
+        rename_column(msname, fromcol, tocol, recreate=recreate)
+        return
+
+    tab = _table(msname, readonly=False)
+    try:
+        if tocol not in tab.colnames():
+            add_column_like(tab, fromcol, tocol)
+        blocks = row_blocks(tab.nrows(),
+                            rows_per_chunk(tab, fromcol, chunk_bytes))
+        if workers <= 1 or len(blocks) <= 1:
+            for start, nrow in blocks:
+                tab.putcol(tocol, tab.getcol(fromcol, start, nrow),
+                           start, nrow)
+            return
+    finally:
+        tab.close()
+
+    pool = Pool(min(workers, len(blocks)))
+    try:
+        pool.map(_copy_block, [(msname, fromcol, tocol, start, nrow)
+                               for start, nrow in blocks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@graph.register_io(copycol)
+def _copycol_io(step):
+    fromcol = step.config["fromcol"]
+    tocol = step.config["tocol"]
+    if step.config.get("rename", False):
+        return graph.columns(step, fromcol), graph.ms_writer(step, fromcol,
+                                                             tocol)
+    return graph.columns(step, fromcol), graph.ms_writer(step, tocol)
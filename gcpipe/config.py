@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+"""
+Recipes written as a YAML or JSON config instead of recipe.add calls.
+
+A config has the sections
+
+    name:       the recipe name
+    ms_dir:     directory of the measurement sets
+    variables:  values substituted for ${name} anywhere in the steps
+    defaults:   keys every step starts from (typically input and output)
+    templates:  named partial steps (cab and/or config) steps build on
+    steps:      list of steps: label, cab, config, plus optionally info
+                (the text after '::' in the label), name, input, output
+                and template (a template name or a list of them)
+    run:        the labels run by default (all steps if missing)
+
+A cab is a stimela cab ("cab/wsclean") or the dotted name of a python
+callable ("gcpipe.autoflag"). A step is its templates merged in order, then
+its own keys; config dicts are merged key by key (nested dicts too), other
+values replaced, and a key set to null is removed. Templates may use other
+templates. A string that is exactly "${name}" takes the variable's value
+with its type; elsewhere ${name} is replaced by its text.
+
+Parsing only checks the structure. Steps are declared on the recipe (see
+Recipe.declare) and built when first used: the templates merged, variables
+substituted, the cab imported, the config checked against the arguments of
+a callable cab and the step's IO rule evaluated. So a run, or a dry run,
+only pays for the steps it names.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import importlib
+import inspect
+import json
+import os
+import re
+import time
+
+from gcpipe import graph
+from gcpipe.recipe import Recipe, string_types
+
+SECTIONS = ("name", "ms_dir", "variables", "defaults", "templates", "steps",
+            "run")
+
+STEP_KEYS = ("label", "template", "cab", "name", "info", "config", "input",
+             "output")
+
+VARIABLE = re.compile(r"\$\{(\w+)\}")
+
+
+def load_file(path):
+    """The contents of a .yml/.yaml (needs PyYAML) or JSON file"""
+    with open(path) as stdr:
+        if os.path.splitext(path)[1].lower() in (".yml", ".yaml"):
+            import yaml
+            return yaml.safe_load(stdr)
+        return json.load(stdr)
+
+
+def merge(base, override):
+    """
+    Copy of dict base with override merged in: dicts recursively, other
+    values replaced; keys set to None in override are removed.
+    """
+    result = dict(base)
+    for key, value in override.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = merge(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def substitute(value, variables, _seen=()):
+    """value with ${name} replaced from variables, in nested dicts/lists"""
+    if isinstance(value, dict):
+        return dict((key, substitute(item, variables, _seen))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [substitute(item, variables, _seen) for item in value]
+    if not isinstance(value, string_types):
+        return value
+
+    def lookup(name):
+        if name in _seen:
+            raise ValueError("Variable '%s' refers to itself" % name)
+        if name not in variables:
+            raise ValueError("Undefined variable '%s'" % name)
+        return substitute(variables[name], variables, _seen + (name,))
+
+    match = VARIABLE.match(value)
+    if match and match.end() == len(value):
+        return lookup(match.group(1))
+    return VARIABLE.sub(lambda match: str(lookup(match.group(1))), value)
+
+
+def resolve_cab(cab):
+    """A stimela cab name as is, or the python callable a dotted name names"""
+    if not isinstance(cab, string_types):
+        raise ValueError("cab must be a string, not %r" % (cab,))
+    if cab.startswith("cab/"):
+        return cab
+    module, _, name = cab.rpartition(".")
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError, ValueError):
+        raise ValueError("Cannot import cab '%s'" % cab)
+
+
+def arguments(function):
+    """
+    (accepted, required) keyword argument names of function; accepted is
+    None if it takes **kwargs.
+    """
+    try:
+        spec = inspect.getfullargspec(function)
+        varkw = spec.varkw
+    except AttributeError:
+        spec = inspect.getargspec(function)
+        varkw = spec.keywords
+    required = spec.args[:len(spec.args) - len(spec.defaults or ())]
+    return (None if varkw else set(spec.args)), required
+
+
+class RecipeConfig(object):
+    """
+    A recipe config; see the module description. variables override those
+    of the config.
+    """
+
+    def __init__(self, data, variables=None, source="<config>"):
+        self.source = source
+        unknown = set(data) - set(SECTIONS)
+        if unknown:
+            raise ValueError("%s: unknown section(s) %s" % (
+                source, ", ".join(sorted(unknown))))
+        self.name = data.get("name") or os.path.basename(source)
+        self.ms_dir = data.get("ms_dir")
+        self.variables = dict(data.get("variables") or {})
+        self.variables.update(variables or {})
+        self.defaults = dict(data.get("defaults") or {})
+        self.templates = dict(data.get("templates") or {})
+        for name, template in self.templates.items():
+            self._check_keys(template, "template '%s'" % name)
+        self.specs = {}
+        self.labels = []
+        for index, spec in enumerate(data.get("steps") or []):
+            self._check_keys(spec, "step %d" % (index + 1))
+            label = spec.get("label")
+            if not label:
+                raise ValueError("%s: step %d has no label" % (source,
+                                                              index + 1))
+            if label in self.specs:
+                raise ValueError("%s: step '%s' defined twice" % (source,
+                                                                   label))
+            self.specs[label] = spec
+            self.labels.append(label)
+        self.sequence = list(data.get("run") or self.labels)
+        missing = [label for label in self.sequence
+                   if label not in self.specs]
+        if missing:
+            raise ValueError("%s: run lists unknown step(s) %s" % (
+                source, ", ".join(missing)))
+
+    @classmethod
+    def load(cls, path, variables=None):
+        return cls(load_file(path), variables, source=path)
+
+    def value(self, name):
+        """Variable name, with the variables it refers to substituted"""
+        try:
+            return substitute("${%s}" % name, self.variables)
+        except ValueError as error:
+            raise ValueError("%s: %s" % (self.source, error))
+
+    def default(self, key):
+        """Key of the defaults section, with variables substituted"""
+        try:
+            return substitute(self.defaults.get(key), self.variables)
+        except ValueError as error:
+            raise ValueError("%s: %s" % (self.source, error))
+
+    def _check_keys(self, spec, where):
+        if not isinstance(spec, dict):
+            raise ValueError("%s: %s is not a mapping" % (self.source, where))
+        unknown = set(spec) - set(STEP_KEYS)
+        if unknown:
+            raise ValueError("%s: %s has unknown key(s) %s" % (
+                self.source, where, ", ".join(sorted(unknown))))
+
+    def _expand(self, spec, seen=()):
+        """spec merged on top of its templates"""
+        result = {}
+        for name in graph.as_list(spec.get("template")):
+            if name in seen:
+                raise ValueError("template '%s' uses itself" % name)
+            if name not in self.templates:
+                raise ValueError("unknown template '%s'" % name)
+            result = merge(result, self._expand(self.templates[name],
+                                                seen + (name,)))
+        return merge(result, dict((key, value) for key, value in
+                                  spec.items() if key != "template"))
+
+    def template(self, name):
+        """Template name with its own templates merged and substituted"""
+        if name not in self.templates:
+            raise KeyError("%s: unknown template '%s'" % (self.source, name))
+        try:
+            return substitute(self._expand({"template": name}),
+                              self.variables)
+        except ValueError as error:
+            raise ValueError("%s: template '%s': %s" % (self.source, name,
+                                                        error))
+
+    def spec(self, label):
+        """The complete step label: defaults, templates, own keys"""
+        if label not in self.specs:
+            raise KeyError("%s: unknown step label '%s'" % (self.source,
+                                                            label))
+        try:
+            spec = substitute(merge(self.defaults,
+                                    self._expand(self.specs[label])),
+                              self.variables)
+            self._check(spec)
+        except ValueError as error:
+            raise ValueError("%s: step '%s': %s" % (self.source, label,
+                                                    error))
+        return spec
+
+    @staticmethod
+    def _check(spec):
+        if "cab" not in spec:
+            raise ValueError("no cab")
+        if not isinstance(spec.get("config", {}), dict):
+            raise ValueError("config is not a mapping")
+        cab = spec["cab"] = resolve_cab(spec["cab"])
+        if not callable(cab):
+            return
+        accepted, required = arguments(cab)
+        config = spec.get("config", {})
+        missing = [name for name in required if name not in config]
+        if missing:
+            raise ValueError("%s needs %s" % (cab.__name__,
+                                              ", ".join(missing)))
+        if accepted is not None and set(config) - accepted:
+            raise ValueError("%s takes no %s" % (cab.__name__, ", ".join(
+                sorted(set(config) - accepted))))
+
+    def add(self, recipe, label):
+        """Build step label and add it to recipe"""
+        spec = self.spec(label)
+        info = spec.get("info")
+        step = recipe.add(spec["cab"], spec.get("name", label),
+                          spec.get("config", {}), input=spec.get("input"),
+                          output=spec.get("output"),
+                          label="%s:: %s" % (label, info) if info else label)
+        try:
+            graph.step_io(step)
+        except (KeyError, TypeError, ValueError, AttributeError) as error:
+            raise ValueError("%s: step '%s': the IO rule of %s fails (%s: %s)"
+                             % (self.source, label, step.cab_name,
+                                type(error).__name__, error))
+        return step
+
+    def declare(self, recipe, labels=None):
+        """Declare steps labels (all by default) on recipe"""
+        for label in labels or self.labels:
+            if label not in self.specs:
+                raise KeyError("%s: unknown step label '%s'" % (self.source,
+                                                                label))
+            recipe.declare(label, lambda recipe, label=label:
+                           self.add(recipe, label))
+
+    def recipe(self, **kwargs):
+        """A Recipe (kwargs as for Recipe) with every step declared"""
+        name = kwargs.pop("name", self.name)
+        kwargs.setdefault("ms_dir", self.ms_dir)
+        recipe = Recipe(name, **kwargs)
+        self.declare(recipe)
+        return recipe
+
+    def dry_run(self, labels=None, recipe=None):
+        """
+        Build and check the steps of labels (the run section by default)
+        without running them, and print each with the steps it waits for.
+        Returns the steps.
+        """
+        start = time.time()
+        recipe = recipe or self.recipe()
+        steps = recipe.get(labels or self.sequence)
+        deps = graph.build_graph(steps)
+        for index, step in enumerate(steps):
+            if graph.step_io(step) is graph.BARRIER:
+                after = "(no IO rule: waits for all earlier steps)"
+            else:
+                after = ", ".join(steps[dep].label
+                                  for dep in sorted(deps[index])) or "-"
+            print("%3d %-28s %-22s after %s" % (index + 1, step.label,
+                                                step.cab_name, after))
+        print("%s: %d steps checked in %.1f ms" % (
+            self.name, len(steps), 1000 * (time.time() - start)))
+        return steps
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Minimal FITS image access: the primary HDU of an image as a memory-mapped
+NumPy array, and writing an image with a given header.
+
+Only what the imaging products of the recipes need is supported: a primary
+array with BITPIX 8/16/32/64/-32/-64 and optional BSCALE/BZERO.
+
+Statistics of an image (FitsImage.stats) and other values derived from it
+(FitsImage.cached) are computed on first use and kept in a sidecar file next
+to the image, `.<image name>.stats`, together with a fingerprint of the
+image. Later readers, in this or another process, reuse them until the image
+is rewritten. The leading dot keeps the sidecar out of the wsclean prefix
+globs used to fingerprint imaging outputs.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import threading
+
+import numpy as np
+
+from gcpipe.cache import stat_fingerprint
+
+BLOCK = 2880
+CARD = 80
+
+DTYPES = {
+    8   : "u1",
+    16  : ">i2",
+    32  : ">i4",
+    64  : ">i8",
+    -32 : ">f4",
+    -64 : ">f8",
+}
+
+HISTOGRAM_BINS = 256
+
+# Rows of the image plane reduced at a time by FitsImage.stats
+STATS_ROWS = 512
+
+_sidecar_lock = threading.Lock()
+
+
+def _value(text):
+    """Python value of the value field of a header card"""
+    text = text.strip()
+    if text.startswith("'"):
+        return text[1:].split("'")[0].rstrip()
+    text = text.split("/")[0].strip()
+    if text in ("T", "F"):
+        return text == "T"
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text.replace("D", "E"))
+        except ValueError:
+            return text
+
+
+def read_header(path):
+    """Return (cards, data offset): the header cards as (key, raw card)"""
+    cards = []
+    with open(path, "rb") as stdr:
+        while True:
+            block = stdr.read(BLOCK)
+            if len(block) < BLOCK:
+                raise IOError("%s: truncated FITS header" % path)
+            for start in range(0, BLOCK, CARD):
+                card = block[start:start + CARD].decode("ascii", "replace")
+                key = card[:8].strip()
+                if key == "END":
+                    return cards, stdr.tell()
+                cards.append((key, card))
+
+
+class FitsImage(object):
+    """Primary array of a FITS file, memory-mapped (read-only by default)"""
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        self.cards, self.offset = read_header(path)
+        self.header = {}
+        for key, card in self.cards:
+            if card[8:10] == "= ":
+                self.header[key] = _value(card[10:])
+        naxis = self.header["NAXIS"]
+        # FITS axes are fastest first, NumPy's slowest first
+        self.shape = tuple(self.header["NAXIS%d" % (i + 1)]
+                           for i in reversed(range(naxis)))
+        self.dtype = np.dtype(DTYPES[self.header["BITPIX"]])
+        self._data = None
+
+    @property
+    def data(self):
+        """The raw pixel array (memory-mapped, big-endian)"""
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=self.dtype,
+                                   mode=self.mode, offset=self.offset,
+                                   shape=self.shape)
+        return self._data
+
+    def plane(self):
+        """
+        The first image plane (frequency and Stokes axes dropped) as a 2-D
+        view; scaled to a new array if BSCALE/BZERO are set.
+        """
+        data = self.data.reshape((-1,) + self.shape[-2:])[0]
+        scale = self.header.get("BSCALE", 1)
+        zero = self.header.get("BZERO", 0)
+        if scale != 1 or zero != 0:
+            return data * scale + zero
+        return data
+
+    @property
+    def sidecar(self):
+        head, tail = os.path.split(self.path)
+        return os.path.join(head, ".%s.stats" % tail)
+
+    def _load_sidecar(self, current):
+        try:
+            with open(self.sidecar) as stdr:
+                stored = json.load(stdr)
+        except (IOError, OSError, ValueError):
+            return {}
+        if stored.get("fingerprint") != current:
+            return {}
+        return stored.get("values", {})
+
+    def lookup(self, key):
+        """Value stored under key in the sidecar file (None if not known)"""
+        return self._load_sidecar(stat_fingerprint([self.path])).get(key)
+
+    def store(self, key, value):
+        """Store a JSON-serialisable value under key in the sidecar file"""
+        current = stat_fingerprint([self.path])
+        with _sidecar_lock:
+            # Another process may have added keys in the meantime
+            values = self._load_sidecar(current)
+            values[key] = value
+            temp = "%s.%d.tmp" % (self.sidecar, os.getpid())
+            with open(temp, "w") as stdw:
+                json.dump({"fingerprint": current, "values": values}, stdw)
+            os.rename(temp, self.sidecar)
+
+    def cached(self, key, compute):
+        """
+        Value stored under key in the sidecar file; compute() is called and
+        its result stored if it is missing or the image has changed since.
+        """
+        value = self.lookup(key)
+        if value is None:
+            value = compute()
+            self.store(key, value)
+        return value
+
+    def stats(self):
+        """
+        Statistics of the finite pixels of the first image plane: npix, min,
+        max, mean, rms, std, median, mad, robust_rms (1.4826 mad) and a
+        histogram ({"range": [min, max], "counts": [...]}).
+        """
+        return self.cached("stats", self._stats)
+
+    def _stats(self):
+        plane = self.plane()
+        values = []
+        for start in range(0, plane.shape[0], STATS_ROWS):
+            block = np.asarray(plane[start:start + STATS_ROWS],
+                               dtype=np.float32)
+            values.append(block[np.isfinite(block)])
+        values = np.concatenate(values)
+        if not values.size:
+            return {"npix": 0}
+        low, high = float(values.min()), float(values.max())
+        median = float(np.median(values))
+        mad = float(np.median(np.abs(values - median)))
+        counts = np.histogram(values, HISTOGRAM_BINS, (low, high))[0]
+        return {
+            "npix"       : int(values.size),
+            "min"        : low,
+            "max"        : high,
+            "mean"       : float(values.mean(dtype=np.float64)),
+            "rms"        : float(np.sqrt(np.mean(np.square(values,
+                                                          dtype=np.float64)))),
+            "std"        : float(values.std(dtype=np.float64)),
+            "median"     : median,
+            "mad"        : mad,
+            "robust_rms" : 1.4826 * mad,
+            "histogram"  : {"range": [low, high],
+                            "counts": counts.tolist()},
+        }
+
+
+def image_stats(path):
+    """FitsImage(path).stats()"""
+    return FitsImage(path).stats()
+
+
+def _header(shape, template=None):
+    cards = ["%-8s= %20s" % ("SIMPLE", "T"),
+             "%-8s= %20d" % ("BITPIX", -32),
+             "%-8s= %20d" % ("NAXIS", len(shape))]
+    cards += ["%-8s= %20d" % ("NAXIS%d" % (i + 1), size)
+              for i, size in enumerate(reversed(shape))]
+    skip = set(["SIMPLE", "BITPIX", "NAXIS", "BSCALE", "BZERO", "END",
+                "EXTEND"])
+    if template is not None:
+        cards += [card for key, card in template.cards
+                  if key not in skip and not (key.startswith("NAXIS") and
+                                              key[5:].isdigit())]
+    cards.append("END")
+    header = "".join(card.ljust(CARD)[:CARD] for card in cards)
+    return (header + " " * (-len(header) % BLOCK)).encode("ascii")
+
+
+def create_image(path, template=None, shape=None):
+    """
+    Create a zero-filled float32 FITS image of the shape of FitsImage
+    template (or of `shape`), copying the template's other header cards.
+    Returns it as a writable FitsImage.
+    """
+    shape = tuple(shape or template.shape)
+    header = _header(shape, template)
+    nbytes = int(np.prod(shape)) * 4
+    with open(path, "wb") as stdw:
+        stdw.write(header)
+        # Sparse until written to
+        stdw.truncate(len(header) + nbytes + (-nbytes % BLOCK))
+    return FitsImage(path, mode="r+")
+
+
+def write_image(path, data, template=None):
+    """Write data as a float32 FITS image (see create_image)"""
+    data = np.asarray(data)
+    image = create_image(path + ".tmp", template,
+                         None if template is not None else data.shape)
+    image.data[...] = data.reshape(image.shape)
+    image.data.flush()
+    del image
+    os.rename(path + ".tmp", path)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+Several manual and quack `cab/casa_flagdata` commands applied in one pass
+over the FLAG column.
+
+Each command is a dict of flagdata parameters. As in flagdata, the
+selections of one command (field, spw with channel ranges, antenna, scan,
+correlation, autocorr) must all match for data to be flagged, and a
+command flags what any of its selections' intersection covers; the plan
+flags the union of its commands. The row selections are evaluated once on
+the metadata columns of the whole MS; FLAG is then read, ORed with the
+channel and correlation masks of the commands selecting each row and
+written back in blocks of about chunk_bytes, skipping blocks that no
+command touches. FLAG_ROW is set for rows that end up fully flagged.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+
+from gcpipe import columns, flagstats, graph
+from gcpipe.visstats import CORR_TYPES, MSInfo, parse_fields, parse_spw
+
+MODES = ("manual", "quack")
+QUACKMODES = ("beg", "endb", "end", "tail")
+
+# Parameters without an effect on the selection
+IGNORED = ("mode", "flagbackup", "action", "savepars")
+
+SELECTIONS = ("field", "spw", "antenna", "scan", "correlation", "autocorr",
+              "quackinterval", "quackmode")
+
+
+def parse_antennas(antenna, names):
+    """flagdata antenna selection (ids or names, comma separated) to ids"""
+    selected = set()
+    for item in str(antenna).split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if item in names:
+            selected.add(names.index(item))
+        elif item.isdigit():
+            selected.add(int(item))
+        else:
+            raise ValueError("Unknown antenna '%s'" % item)
+    return selected
+
+
+class FlagCommand(object):
+    """One flagdata command: a row selection, and channel/correlation masks"""
+
+    def __init__(self, spec, info, antennas):
+        unknown = set(spec) - set(SELECTIONS + IGNORED)
+        if unknown:
+            raise ValueError("Unsupported flagdata parameter(s): %s" %
+                             ", ".join(sorted(unknown)))
+        self.mode = spec.get("mode", "manual")
+        if self.mode not in MODES:
+            raise ValueError("Unsupported flagdata mode '%s'" % self.mode)
+        self.quackmode = spec.get("quackmode", "beg")
+        if self.quackmode not in QUACKMODES:
+            raise ValueError("Unsupported quackmode '%s'" % self.quackmode)
+        self.quackinterval = float(spec.get("quackinterval", 1.0))
+        self.spec = spec
+        self.fields = parse_fields(spec.get("field", ""), info.fields)
+        self.spws = parse_spw(spec.get("spw", ""))
+        self.antennas = parse_antennas(spec.get("antenna", ""), antennas)
+        self.scans = set(int(scan) for scan in
+                         str(spec.get("scan", "")).split(",") if scan.strip())
+        self.autocorr = bool(spec.get("autocorr", False))
+        self.corrs = [CORR_TYPES[name.strip().upper()] for name in
+                      str(spec.get("correlation", "")).split(",")
+                      if name.strip()]
+        self.info = info
+
+    def rows(self, meta):
+        """Rows (of the arrays in meta) selected by the command"""
+        select = np.ones(len(meta["TIME"]), bool)
+        if self.fields:
+            select &= np.isin(meta["FIELD_ID"], sorted(self.fields))
+        if self.spws:
+            spws = np.array(self.info.ddid_spw)[meta["DATA_DESC_ID"]]
+            select &= np.isin(spws, sorted(self.spws))
+        if self.antennas:
+            ants = sorted(self.antennas)
+            select &= (np.isin(meta["ANTENNA1"], ants) |
+                       np.isin(meta["ANTENNA2"], ants))
+        if self.scans:
+            select &= np.isin(meta["SCAN_NUMBER"], sorted(self.scans))
+        if self.autocorr:
+            select &= meta["ANTENNA1"] == meta["ANTENNA2"]
+        if self.mode == "quack":
+            select &= self._quack(meta)
+        return select
+
+    def _quack(self, meta):
+        times = meta["TIME"]
+        keys = meta["SCAN_NUMBER"] * 65536 + meta["FIELD_ID"]
+        _, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        start = np.full(inverse.max() + 1 if len(inverse) else 0, np.inf)
+        end = np.full(len(start), -np.inf)
+        np.minimum.at(start, inverse, times)
+        np.maximum.at(end, inverse, times)
+        start, end = start[inverse], end[inverse]
+        interval = self.quackinterval
+        return {
+            "beg"  : times < start + interval,
+            "endb" : times > end - interval,
+            "end"  : times < end - interval,
+            "tail" : times > start + interval,
+        }[self.quackmode]
+
+    def cells(self, ddid, shape):
+        """(channel, correlation) mask of the command for a ddid"""
+        mask = np.ones(shape, bool)
+        chans = self.spws.get(self.info.ddid_spw[ddid])
+        if chans is not None:
+            mask[:chans[0]] = False
+            mask[chans[1] + 1:] = False
+        if self.corrs:
+            keep = np.isin(self.info.corr_types[ddid], self.corrs)
+            mask[:, ~keep] = False
+        return mask
+
+
+@flagstats.incremental
+def flag_plan(msname, commands, chunk_bytes=columns.CHUNK_BYTES):
+    """
+    Apply the flagdata commands (dicts of flagdata parameters) to msname in
+    one pass over FLAG; see the module description.
+    """
+    import pyrap.tables as pt
+
+    info = MSInfo(msname)
+    sub = pt.table(os.path.join(msname, "ANTENNA"), ack=False)
+    antennas = list(sub.getcol("NAME"))
+    sub.close()
+    plan = [FlagCommand(spec, info, antennas) for spec in commands]
+
+    tab = pt.table(msname, readonly=False, ack=False)
+    flagged = 0
+    stats = flagstats.recording(msname)
+    try:
+        meta = dict((name, tab.getcol(name)) for name in
+                    ("TIME", "FIELD_ID", "DATA_DESC_ID", "SCAN_NUMBER",
+                     "ANTENNA1", "ANTENNA2"))
+        selected = np.array([command.rows(meta) for command in plan])
+        nrows = columns.rows_per_chunk(tab, "FLAG", chunk_bytes)
+        for start, nrow in columns.row_blocks(tab.nrows(), nrows):
+            rows = selected[:, start:start + nrow]
+            if not rows.any():
+                continue
+            flag = tab.getcol("FLAG", start, nrow)
+            before = flag.copy()
+            ddids = meta["DATA_DESC_ID"][start:start + nrow]
+            for ddid in np.unique(ddids):
+                for command, chosen in zip(plan, rows):
+                    chosen = chosen & (ddids == ddid)
+                    if chosen.any():
+                        flag[chosen] |= command.cells(ddid, flag.shape[1:])
+            flagged += int((flag & ~before).sum())
+            if stats:
+                flagstats.record(msname, flagstats.delta(
+                    dict((name, meta[name][start:start + nrow])
+                         for name in flagstats.META), before, flag))
+            tab.putcol("FLAG", flag, start, nrow)
+            flag_row = tab.getcol("FLAG_ROW", start, nrow)
+            tab.putcol("FLAG_ROW", flag_row | flag.all(axis=(1, 2)), start,
+                       nrow)
+    finally:
+        tab.close()
+    print("%s: %d flag commands in one pass, %d visibilities flagged" % (
+        os.path.basename(msname), len(plan), flagged))
+
+
+@graph.register_io(flag_plan)
+def _flag_plan_io(step):
+    return graph.columns(step, "FLAG"), graph.ms_writer(step, "FLAG",
+                                                        "FLAG_ROW")
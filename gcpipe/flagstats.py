@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+Flagged fractions per antenna, baseline, channel, scan and field, kept up to
+date after every flagging step.
+
+FlagStats is a recipe hook. A step is a flagging step if its IO rule writes
+the FLAG column of its MS. The counts of an MS are established once, by a
+pass over FLAG, or taken from the last record of an earlier run if FLAG is
+unchanged on disk since. After that the in-process flaggers (the cabs marked
+`incremental`) report what they change as they write FLAG, counted from the
+rows and channels they touch, and the hook only adds those changes up. After
+other flagging steps FLAG is counted again if it changed on disk.
+
+After every flagging step a line with the counts (flagged and total, so a
+later run can resume from it) is appended to <directory>/flagstats.jsonl,
+and the total flagged percentage, its change and every antenna flagged above
+`alert` are printed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from gcpipe import columns, graph
+from gcpipe.cache import column_files, stat_fingerprint
+
+AXES = ("antenna", "baseline", "scan", "field")
+
+META = ("ANTENNA1", "ANTENNA2", "SCAN_NUMBER", "FIELD_ID", "DATA_DESC_ID")
+
+# Cabs that report their changes to FLAG through record()
+INCREMENTAL = set()
+
+# Changes reported during the running steps, by MS
+_pending = {}
+_lock = threading.Lock()
+
+
+def incremental(cab):
+    """Decorator marking a callable cab that reports its FLAG changes"""
+    INCREMENTAL.add(cab)
+    return cab
+
+
+def _key(ms):
+    return os.path.abspath(os.path.normpath(ms))
+
+
+def _fingerprint(ms):
+    return stat_fingerprint(column_files(ms, "FLAG"))
+
+
+class FlagCounts(object):
+    """
+    Visibility counts per antenna, baseline (ant1, ant2), scan and field
+    (dicts by id), and per channel (arrays by DATA_DESC_ID).
+    """
+
+    def __init__(self):
+        self.axes = dict((axis, {}) for axis in AXES)
+        self.channels = {}
+
+    def add(self, meta, counts, first_channel=0):
+        """
+        Add counts (row, channel) of the rows described by meta (row arrays
+        of the META columns); the channels start at first_channel.
+        """
+        per_row = counts.sum(axis=1)
+        ant1, ant2 = meta["ANTENNA1"], meta["ANTENNA2"]
+        cross = ant1 != ant2
+        self._add("antenna", np.concatenate([ant1, ant2[cross]]),
+                  np.concatenate([per_row, per_row[cross]]))
+        self._add("baseline", ant1 * 65536 + ant2, per_row)
+        self._add("scan", meta["SCAN_NUMBER"], per_row)
+        self._add("field", meta["FIELD_ID"], per_row)
+        ddids = meta["DATA_DESC_ID"]
+        for ddid in np.unique(ddids):
+            summed = np.zeros(first_channel + counts.shape[1], np.int64)
+            summed[first_channel:] = counts[ddids == ddid].sum(axis=0)
+            self._add_channels(int(ddid), summed)
+
+    def _add(self, axis, keys, values):
+        keys, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=values)
+        table = self.axes[axis]
+        for key, value in zip(keys.tolist(), sums.tolist()):
+            if axis == "baseline":
+                key = divmod(key, 65536)
+            table[key] = table.get(key, 0) + int(round(value))
+
+    def _add_channels(self, ddid, values):
+        current = self.channels.get(ddid, np.zeros(0, np.int64))
+        if len(current) < len(values):
+            current = np.concatenate([current, np.zeros(len(values) -
+                                                        len(current),
+                                                        np.int64)])
+        current[:len(values)] += values
+        self.channels[ddid] = current
+
+    def merge(self, other):
+        for axis in AXES:
+            table = self.axes[axis]
+            for key, value in other.axes[axis].items():
+                table[key] = table.get(key, 0) + value
+        for ddid, values in other.channels.items():
+            self._add_channels(ddid, values)
+
+    @property
+    def total(self):
+        return sum(self.axes["field"].values())
+
+    def as_dict(self):
+        """JSON friendly copy; baselines are keyed 'ant1-ant2'"""
+        data = {}
+        for axis in AXES:
+            items = sorted(self.axes[axis].items())
+            if axis == "baseline":
+                data[axis] = dict(("%d-%d" % key, value)
+                                  for key, value in items)
+            else:
+                data[axis] = dict((str(key), value) for key, value in items)
+        data["channel"] = dict((str(ddid), values.tolist()) for ddid, values
+                               in sorted(self.channels.items()))
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        counts = cls()
+        for axis in AXES:
+            for key, value in data.get(axis, {}).items():
+                if axis == "baseline":
+                    key = tuple(int(ant) for ant in key.split("-"))
+                else:
+                    key = int(key)
+                counts.axes[axis][key] = value
+        for ddid, values in data.get("channel", {}).items():
+            counts.channels[int(ddid)] = np.array(values, np.int64)
+        return counts
+
+
+def delta(meta, before, after, first_channel=0):
+    """
+    FlagCounts of the change from flags before to after (row, channel,
+    correlation) of the rows described by meta, or None if nothing changed.
+    """
+    changed = (before != after).any(axis=(1, 2))
+    if not changed.any():
+        return None
+    counts = (after[changed].sum(axis=2, dtype=np.int64) -
+              before[changed].sum(axis=2, dtype=np.int64))
+    result = FlagCounts()
+    result.add(dict((name, meta[name][changed]) for name in META), counts,
+               first_channel)
+    return result
+
+
+def recording(ms):
+    """Whether a FlagStats hook wants the FLAG changes to ms"""
+    with _lock:
+        return _key(ms) in _pending
+
+
+def record(ms, counts):
+    """Report FlagCounts counts (from delta, may be None) of changes to ms"""
+    if counts is None:
+        return
+    with _lock:
+        pending = _pending.get(_key(ms))
+        if pending is not None:
+            pending.merge(counts)
+
+
+def count_flags(ms, chunk_bytes=columns.CHUNK_BYTES):
+    """(flagged, total) FlagCounts of ms, from one pass over FLAG"""
+    import pyrap.tables as pt
+
+    flagged, total = FlagCounts(), FlagCounts()
+    tab = pt.table(ms, ack=False)
+    try:
+        per_block = columns.rows_per_chunk(tab, "FLAG", chunk_bytes)
+        for start, nrow in columns.row_blocks(tab.nrows(), per_block):
+            meta = dict((name, tab.getcol(name, start, nrow))
+                        for name in META)
+            flag = tab.getcol("FLAG", start, nrow)
+            flagged.add(meta, flag.sum(axis=2, dtype=np.int64))
+            total.add(meta, np.full(flag.shape[:2], flag.shape[2], np.int64))
+    finally:
+        tab.close()
+    return flagged, total
+
+
+class MSFlags(object):
+    """The current counts of one MS"""
+
+    def __init__(self, ms, flagged, total, fingerprint, names):
+        self.ms = ms
+        self.flagged = flagged
+        self.total = total
+        self.fingerprint = fingerprint
+        self.names = names
+
+    def recount(self):
+        self.flagged, self.total = count_flags(self.ms)
+        self.fingerprint = _fingerprint(self.ms)
+
+    def percent(self):
+        return 100.0 * self.flagged.total / max(self.total.total, 1)
+
+    def fractions(self, axis):
+        """Flagged fraction by key of axis"""
+        flagged = self.flagged.axes[axis]
+        return dict((key, flagged.get(key, 0) / max(value, 1))
+                    for key, value in self.total.axes[axis].items())
+
+
+class FlagStats(object):
+    """
+    Recipe hook recording the flag counts of the MS of every flagging step;
+    see the module description.
+    """
+
+    def __init__(self, directory="reports", name="flagstats.jsonl",
+                 alert=0.5):
+        self.path = os.path.join(directory, name)
+        self.alert = alert
+        self.state = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def flags_step(step):
+        """Whether step writes the FLAG column of its MS"""
+        io = graph.step_io(step) if step.ms else graph.BARRIER
+        return io is not graph.BARRIER and graph.column(step, "FLAG") in io[1]
+
+    def before_step(self, step):
+        if not self.flags_step(step):
+            return
+        key = _key(step.ms)
+        with self.lock:
+            state = self.state.get(key)
+            if state is None:
+                self.state[key] = self._load(key)
+            elif state.fingerprint != _fingerprint(key):
+                # FLAG was changed by a step not known to flag
+                state.recount()
+        with _lock:
+            _pending[key] = FlagCounts()
+
+    def after_step(self, step, status):
+        if not self.flags_step(step):
+            return
+        key = _key(step.ms)
+        with _lock:
+            changes = _pending.pop(key, None)
+        with self.lock:
+            state = self.state[key]
+            before = state.percent()
+            if status == "done" and step.cab in INCREMENTAL:
+                state.flagged.merge(changes)
+                state.fingerprint = _fingerprint(key)
+            elif state.fingerprint != _fingerprint(key):
+                state.recount()
+            self._append(step, status, state)
+        print(self.summary(step.label, state, before))
+
+    def _load(self, key):
+        """Counts of MS key: from the last record if FLAG is unchanged"""
+        import pyrap.tables as pt
+
+        sub = pt.table(os.path.join(key, "ANTENNA"), ack=False)
+        names = list(sub.getcol("NAME"))
+        sub.close()
+        fingerprint = _fingerprint(key)
+        last = None
+        if os.path.exists(self.path):
+            with open(self.path) as stdr:
+                for line in stdr:
+                    entry = json.loads(line)
+                    if entry["ms"] == key:
+                        last = entry
+        if last is not None and last["fingerprint"] == fingerprint:
+            flagged = FlagCounts.from_dict(last["flagged"])
+            total = FlagCounts.from_dict(last["total"])
+        else:
+            flagged, total = count_flags(key)
+        return MSFlags(key, flagged, total, fingerprint, names)
+
+    def _append(self, step, status, state):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        entry = {
+            "time"        : time.time(),
+            "label"       : step.label,
+            "status"      : status,
+            "ms"          : state.ms,
+            "fingerprint" : state.fingerprint,
+            "percent"     : state.percent(),
+            "antennas"    : state.names,
+            "flagged"     : state.flagged.as_dict(),
+            "total"       : state.total.as_dict(),
+        }
+        with open(self.path, "a") as stdw:
+            stdw.write(json.dumps(entry, sort_keys=True,
+                                  separators=(",", ":")) + "\n")
+
+    def summary(self, label, state, before):
+        """Flagged percentage after step label, and antennas above alert"""
+        percent = state.percent()
+        line = "%s: %s %.2f%% flagged (%+.2f%%)" % (
+            label, os.path.basename(state.ms), percent, percent - before)
+        high = sorted((fraction, ant) for ant, fraction in
+                      state.fractions("antenna").items()
+                      if fraction > self.alert)
+        if high:
+            line += "; antennas above %d%%: %s" % (100 * self.alert, ", ".join(
+                "%s (%.1f%%)" % (state.names[ant] if ant < len(state.names)
+                                 else ant, 100 * fraction)
+                for fraction, ant in reversed(high)))
+        return line
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+Saved versions of the FLAG column of a measurement set, replacing the
+flagset backups of `cab/flagms`.
+
+The first version saved becomes the base: the whole FLAG cube, bit-packed
+per row (one bit per channel and correlation). Every version, the first
+included, stores only the rows whose flags differ from the base, bit-packed
+and compressed, together with its flagged counts (in total and per field),
+so listing versions and their flag percentages never reads FLAG.
+
+Saving reads FLAG once. Restoring writes only the rows that may differ
+between the MS and the version. If the FLAG column is unchanged on disk
+since the last save or restore (the head), those are the rows of the head's
+and the version's deltas and FLAG is not read at all; otherwise FLAG is read
+and compared with the version, and again only differing rows are written.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import time
+
+import numpy as np
+
+from gcpipe import columns, flagstats, graph
+from gcpipe.cache import column_files, stat_fingerprint
+
+INDEX = "index.json"
+BASE = "base.npy"
+
+MODES = ("save", "restore", "delete", "list")
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+class FlagVersions(object):
+    """
+    Versions of the FLAG column of measurement set `ms`, kept in directory
+    `root` (<ms>.flagstore by default).
+    """
+
+    def __init__(self, ms, root=None, chunk_bytes=columns.CHUNK_BYTES):
+        self.ms = os.path.normpath(ms)
+        self.root = root or self.ms + ".flagstore"
+        self.chunk_bytes = chunk_bytes
+
+    def _load(self):
+        name = os.path.join(self.root, INDEX)
+        if not os.path.exists(name):
+            return {"versions": [], "head": None}
+        with open(name) as stdr:
+            return json.load(stdr)
+
+    def _save(self, index):
+        name = os.path.join(self.root, INDEX)
+        with open(name + ".tmp", "w") as stdw:
+            json.dump(index, stdw, indent=1)
+        os.rename(name + ".tmp", name)
+
+    def names(self):
+        return [version["name"] for version in self._load()["versions"]]
+
+    def _find(self, index, name):
+        for version in index["versions"]:
+            if version["name"] == name:
+                return version
+        raise KeyError("No flag version '%s' of %s" % (name, self.ms))
+
+    def _delta(self, name):
+        """(rows, packed flags) of version name"""
+        with np.load(os.path.join(self.root, name + ".npz")) as delta:
+            return delta["rows"], delta["bits"]
+
+    def _fingerprint(self):
+        return stat_fingerprint(column_files(self.ms, "FLAG"))
+
+    def _table(self, readonly=True):
+        import pyrap.tables as pt
+        return pt.table(self.ms, readonly=readonly, ack=False)
+
+    def save(self, name):
+        """Save the current FLAG column as version name"""
+        _makedirs(self.root)
+        index = self._load()
+        tab = self._table()
+        try:
+            nrows = tab.nrows()
+            cell = tab.getcell("FLAG", 0).shape if nrows else (0, 0)
+            shape = [nrows] + list(cell)
+            base_path = os.path.join(self.root, BASE)
+            # A new base when the first version is saved or the MS changed
+            # shape; the versions kept so far refer to the old base
+            new_base = index.get("shape") != shape
+            if new_base:
+                for version in index["versions"]:
+                    os.remove(os.path.join(self.root,
+                                           version["name"] + ".npz"))
+                index = {"versions": [], "head": None, "shape": shape}
+                width = (int(np.prod(cell)) + 7) // 8
+                base = np.lib.format.open_memmap(
+                    base_path + ".tmp", mode="w+", dtype=np.uint8,
+                    shape=(nrows, width))
+            else:
+                base = np.load(base_path, mmap_mode="r")
+            fields = tab.getcol("FIELD_ID")
+            rows, bits = [], []
+            flagged = 0
+            per_field = np.zeros(fields.max() + 1 if nrows else 0)
+            per_block = columns.rows_per_chunk(tab, "FLAG", self.chunk_bytes)
+            for start, nrow in columns.row_blocks(nrows, per_block):
+                flag = tab.getcol("FLAG", start, nrow)
+                packed = np.packbits(flag.reshape(nrow, -1), axis=1)
+                if new_base:
+                    base[start:start + nrow] = packed
+                else:
+                    changed = np.nonzero((packed != base[start:start +
+                                                         nrow]).any(axis=1))[0]
+                    rows.append(changed + start)
+                    bits.append(packed[changed])
+                counts = flag.reshape(nrow, -1).sum(axis=1)
+                flagged += int(counts.sum())
+                per_field += np.bincount(fields[start:start + nrow],
+                                         weights=counts,
+                                         minlength=len(per_field))
+        finally:
+            tab.close()
+        if new_base:
+            base.flush()
+            del base
+            os.rename(base_path + ".tmp", base_path)
+        width = (int(np.prod(shape[1:])) + 7) // 8
+        rows = np.concatenate(rows) if rows else np.zeros(0, np.int64)
+        bits = (np.concatenate(bits) if bits else
+                np.zeros((0, width), np.uint8))
+        np.savez_compressed(os.path.join(self.root, name + ".npz"),
+                            rows=rows, bits=bits)
+
+        cells = int(np.prod(shape[1:]))
+        rows_per_field = np.bincount(fields, minlength=len(per_field))
+        index["versions"] = [version for version in index["versions"]
+                             if version["name"] != name]
+        index["versions"].append({
+            "name"    : name,
+            "created" : time.time(),
+            "rows"    : len(rows),
+            "flagged" : flagged,
+            "total"   : shape[0] * cells,
+            "fields"  : dict((str(fid), [int(per_field[fid]),
+                                         int(rows_per_field[fid] * cells)])
+                             for fid in range(len(per_field))),
+        })
+        index["head"] = name
+        index["head_fingerprint"] = self._fingerprint()
+        self._save(index)
+        return len(rows)
+
+    def restore(self, name):
+        """Bring FLAG back to version name; returns the rows written"""
+        index = self._load()
+        self._find(index, name)
+        rows, bits = self._delta(name)
+        base = np.load(os.path.join(self.root, BASE), mmap_mode="r")
+        shape = index["shape"]
+
+        head = index.get("head")
+        if (head in self.names() and
+                index.get("head_fingerprint") == self._fingerprint()):
+            # FLAG holds the head version: only rows in either delta differ
+            candidates = np.union1d(rows, self._delta(head)[0])
+            target = base[candidates]
+            position = np.searchsorted(candidates, rows)
+            target[position] = bits
+            write = [(candidates, target)]
+        else:
+            write = self._compare(base, rows, bits, shape)
+
+        written = 0
+        stats = flagstats.recording(self.ms)
+        tab = self._table(readonly=False)
+        try:
+            cells = int(np.prod(shape[1:]))
+            for chosen, packed in write:
+                flag = np.unpackbits(packed, axis=1)[:, :cells].astype(bool)
+                flag = flag.reshape([len(chosen)] + shape[1:])
+                offset = 0
+                for start, nrow in columns.row_runs(chosen):
+                    part = flag[offset:offset + nrow]
+                    if stats:
+                        meta = dict((name, tab.getcol(name, start, nrow))
+                                    for name in flagstats.META)
+                        flagstats.record(self.ms, flagstats.delta(
+                            meta, tab.getcol("FLAG", start, nrow), part))
+                    tab.putcol("FLAG", part, start, nrow)
+                    tab.putcol("FLAG_ROW", part.all(axis=(1, 2)), start, nrow)
+                    offset += nrow
+                written += len(chosen)
+        finally:
+            tab.close()
+        index["head"] = name
+        index["head_fingerprint"] = self._fingerprint()
+        self._save(index)
+        return written
+
+    def _compare(self, base, rows, bits, shape):
+        """(rows, packed flags) of version rows that differ from FLAG"""
+        write = []
+        tab = self._table()
+        try:
+            per_block = columns.rows_per_chunk(tab, "FLAG", self.chunk_bytes)
+            for start, nrow in columns.row_blocks(shape[0], per_block):
+                target = np.array(base[start:start + nrow])
+                inside = (rows >= start) & (rows < start + nrow)
+                target[rows[inside] - start] = bits[inside]
+                flag = tab.getcol("FLAG", start, nrow)
+                packed = np.packbits(flag.reshape(nrow, -1), axis=1)
+                changed = np.nonzero((packed != target).any(axis=1))[0]
+                if len(changed):
+                    write.append((changed + start, target[changed]))
+        finally:
+            tab.close()
+        return write
+
+    def remove(self, name):
+        index = self._load()
+        self._find(index, name)
+        os.remove(os.path.join(self.root, name + ".npz"))
+        index["versions"] = [version for version in index["versions"]
+                             if version["name"] != name]
+        if index.get("head") == name:
+            index["head"] = None
+        self._save(index)
+
+    def percent(self, name, field=None):
+        """Percentage of visibilities flagged in version name (or a field)"""
+        version = self._find(self._load(), name)
+        flagged, total = version["flagged"], version["total"]
+        if field is not None:
+            flagged, total = version["fields"].get(str(field), (0, 0))
+        return 100.0 * flagged / max(total, 1)
+
+    def summary(self, name):
+        """One line description of a version"""
+        version = self._find(self._load(), name)
+        return "%s: %.2f%% flagged, %d rows differ from the base" % (
+            name, self.percent(name), version["rows"])
+
+
+@flagstats.incremental
+def flagmanager(msname, mode="list", versionname=None, root=None):
+    """
+    Save, restore, delete or list versions of the FLAG column of msname, like
+    the CASA task of the same name; see FlagVersions.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown flagmanager mode '%s'" % mode)
+    store = FlagVersions(msname, root)
+    start = time.time()
+    if mode == "save":
+        rows = store.save(versionname)
+        print("%s: saved flag version %s (%d rows differ from the base) in "
+              "%.1fs" % (os.path.basename(msname), versionname, rows,
+                         time.time() - start))
+    elif mode == "restore":
+        rows = store.restore(versionname)
+        print("%s: restored flag version %s (%d rows written) in %.1fs" % (
+            os.path.basename(msname), versionname, rows,
+            time.time() - start))
+    elif mode == "delete":
+        store.remove(versionname)
+    else:
+        for name in store.names():
+            print(store.summary(name))
+
+
+@graph.register_io(flagmanager)
+def _flagmanager_io(step):
+    store = step.config.get("root") or os.path.normpath(step.ms) + ".flagstore"
+    mode = step.config.get("mode", "list")
+    if mode == "save":
+        return graph.columns(step, "FLAG"), set([("prefix", store)])
+    if mode == "restore":
+        return (graph.columns(step, "FLAG") | set([("prefix", store)]),
+                graph.ms_writer(step, "FLAG", "FLAG_ROW"))
+    if mode == "delete":
+        return set(), set([("prefix", store)])
+    return set([("prefix", store)]), set()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+Dependency graph for recipe steps.
+
+Every cab used by the 1gc/2gc scripts is described by a rule that returns the
+resources a step reads and writes. A resource is one of
+
+    ("column", ms, COLUMN)   a column of a measurement set
+    ("table", ms)            write lock on a measurement set
+    ("file", path)           a single file or CASA table on disk
+    ("prefix", path)         every file whose name starts with path
+
+A later step depends on an earlier one when it reads something the earlier
+step writes, writes something it reads, or writes something it also writes.
+Steps whose cab has no rule act as barriers.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+MS_KEYS = ("msname", "vis")
+
+# Measurement sets created by a step, relative to ms_dir like MS_KEYS
+OUTPUT_MS_KEYS = ("outputvis",)
+
+# plotms style datacolumn names
+DATACOLUMNS = {
+    "data"      : ["DATA"],
+    "corrected" : ["CORRECTED_DATA"],
+    "model"     : ["MODEL_DATA"],
+    "residual"  : ["CORRECTED_DATA", "MODEL_DATA"],
+}
+
+CAB_IO = {}
+
+# Sentinel returned for steps we know nothing about
+BARRIER = None
+
+
+def register_io(*cabs):
+    """Decorator registering an IO rule for one or more cabs (or callables)."""
+    def wrapper(rule):
+        for cab in cabs:
+            CAB_IO[cab] = rule
+        return rule
+    return wrapper
+
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def column(step, name):
+    return ("column", step.ms, name.upper())
+
+
+def columns(step, *names):
+    return set(column(step, name) for name in names)
+
+
+def table(step):
+    return ("table", step.ms)
+
+
+def files(step, *keys):
+    """File resources for every non-empty value stored under keys"""
+    found = set()
+    for key in keys:
+        for value in as_list(step.config.get(key)):
+            if value:
+                found.add(("file", step.path(value)))
+    return found
+
+
+def prefixes(step, *keys):
+    found = set()
+    for key in keys:
+        value = step.config.get(key)
+        if value:
+            found.add(("prefix", step.path(value)))
+    return found
+
+
+def ms_writer(step, *names):
+    """Writes to columns of the step's MS (plus the table write lock)"""
+    return columns(step, *names) | set([table(step)])
+
+
+def step_io(step):
+    """Return (reads, writes) for step, or BARRIER if it is unknown"""
+    rule = CAB_IO.get(step.cab)
+    if rule is None:
+        return BARRIER
+    return rule(step)
+
+
+def _overlap(a, b):
+    if a == b:
+        return True
+    kinds = (a[0], b[0])
+    if "prefix" in kinds and set(kinds) <= set(["file", "prefix"]):
+        if a[0] == "prefix" and b[1].startswith(a[1]):
+            return True
+        if b[0] == "prefix" and a[1].startswith(b[1]):
+            return True
+    return False
+
+
+def intersects(left, right):
+    """True if any resource in left overlaps one in right"""
+    for a in left:
+        for b in right:
+            if _overlap(a, b):
+                return True
+    return False
+
+
+def conflicts(earlier, later):
+    """True if `later` must wait for `earlier` (both are step_io results)"""
+    if earlier is BARRIER or later is BARRIER:
+        return True
+    reads0, writes0 = earlier
+    reads1, writes1 = later
+    return (intersects(reads1, writes0) or
+            intersects(writes1, reads0) or
+            intersects(writes1, writes0))
+
+
+def build_graph(steps):
+    """
+    Return a list of dependency sets, one per step, indexing into steps.
+    Only direct hazards are recorded; ordering is otherwise free.
+    """
+    ios = [step_io(step) for step in steps]
+    deps = []
+    for i, io in enumerate(ios):
+        deps.append(set(j for j in range(i) if conflicts(ios[j], io)))
+    return deps
+
+
+##############################################################################
+
+# IO rules for the cabs used in the 1gc/2gc scripts
+
+##############################################################################
+
+@register_io("cab/autoflagger")
+def _autoflagger(step):
+    reads = columns(step, step.config.get("column", "DATA"), "FLAG")
+    return reads, ms_writer(step, "FLAG")
+
+
+@register_io("cab/casa_flagdata")
+def _flagdata(step):
+    return columns(step, "FLAG"), ms_writer(step, "FLAG")
+
+
+@register_io("cab/casa_setjy")
+def _setjy(step):
+    return set(), ms_writer(step, "MODEL_DATA")
+
+
+@register_io("cab/casa_gaincal", "cab/casa_bandpass")
+def _solve(step):
+    reads = columns(step, "DATA", "MODEL_DATA", "FLAG")
+    reads |= files(step, "gaintable")
+    return reads, files(step, "caltable")
+
+
+@register_io("cab/casa_fluxscale")
+def _fluxscale(step):
+    return files(step, "caltable"), files(step, "fluxtable")
+
+
+@register_io("cab/casa_applycal")
+def _applycal(step):
+    reads = columns(step, "DATA", "FLAG") | files(step, "gaintable")
+    return reads, ms_writer(step, "CORRECTED_DATA", "FLAG")
+
+
+@register_io("cab/casa_plotcal")
+def _plotcal(step):
+    return files(step, "caltable"), files(step, "figfile")
+
+
+@register_io("cab/casa_plotms")
+def _plotms(step):
+    names = ["FLAG"]
+    for key in ("xdatacolumn", "ydatacolumn"):
+        names += DATACOLUMNS.get(step.config.get(key, "data"), ["DATA"])
+    return columns(step, *names), files(step, "plotfile")
+
+
+@register_io("cab/wsclean")
+def _wsclean(step):
+    if "column" in step.config:
+        reads = columns(step, step.config["column"], "FLAG")
+    else:
+        # wsclean picks CORRECTED_DATA if present, DATA otherwise
+        reads = columns(step, "DATA", "CORRECTED_DATA", "FLAG")
+    reads |= files(step, "fitsmask")
+    reads |= prefixes(step, "reuse-psf", "reuse-dirty")
+    if step.config.get("continue", False):
+        # Starts from the model images of an earlier run with this prefix
+        reads |= prefixes(step, "prefix") | columns(step, "MODEL_DATA")
+    writes = prefixes(step, "prefix")
+    if not step.config.get("no-update-model-required", False):
+        writes |= ms_writer(step, "MODEL_DATA")
+    return reads, writes
+
+
+@register_io("cab/cleanmask")
+def _cleanmask(step):
+    return files(step, "image"), files(step, "output")
+
+
+@register_io("cab/pybdsm")
+def _pybdsm(step):
+    return files(step, "image"), prefixes(step, "outfile")
+
+
+@register_io("cab/msutils")
+def _msutils(step):
+    command = step.config.get("command")
+    if command == "copycol":
+        fromcol, tocol = step.config["fromcol"], step.config["tocol"]
+        return columns(step, fromcol), ms_writer(step, tocol)
+    if command == "prep":
+        return set(), ms_writer(step, "BITFLAG", "BITFLAG_ROW", "FLAG")
+    return BARRIER
+
+
+@register_io("cab/flagms")
+def _flagms(step):
+    names = ("FLAG", "BITFLAG", "BITFLAG_ROW")
+    return columns(step, *names), ms_writer(step, *names)
+
+
+@register_io("cab/calibrator")
+def _calibrator(step):
+    reads = columns(step, step.config.get("column", "DATA"),
+                    "FLAG", "BITFLAG")
+    reads |= files(step, "skymodel")
+    return reads, ms_writer(step, "CORRECTED_DATA", "FLAG", "BITFLAG")
+
+
+@register_io("cab/tigger_convert")
+def _tigger_convert(step):
+    return (files(step, "input-skymodel", "append"),
+            files(step, "output-skymodel"))
+
+
+@register_io("cab/tigger_restore")
+def _tigger_restore(step):
+    return (files(step, "input-image", "input-skymodel"),
+            files(step, "output-image"))
+
+
+@register_io("cab/simulator")
+def _simulator(step):
+    reads = columns(step, step.config.get("input-column", "DATA"), "FLAG")
+    reads |= files(step, "skymodel")
+    return reads, ms_writer(step, step.config.get("column", "MODEL_DATA"))
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-step resource accounting for recipe runs.
+
+StepProfiler is a recipe hook: it records the wall time, CPU time, peak
+resident memory and disk bytes read/written of every executed step, plus the
+time taken to get a container for the step where the backend can tell
+(gcpipe.ContainerPool; stimela starts its containers out of sight, so
+StimelaBackend leaves it empty). Records are written as a JSON and a CSV
+report after every step, so a crashed run still leaves one.
+
+CPU, memory and I/O are measured for this process as a whole (CPU time of
+children once they have exited, memory and I/O of running children too), as
+differences over the step. They are not attributed per step: when steps run
+concurrently (recipe workers > 1) each step is charged with everything the
+pipeline did meanwhile. The `concurrent` field (the number of other steps
+that overlapped) marks those records, and the summary flags them. Work done
+inside docker containers is not visible from here.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import csv
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+FIELDS = ("label", "cab", "status", "start", "wall", "cpu", "peak_rss",
+          "read_bytes", "write_bytes", "container_setup", "concurrent")
+
+# Seconds between samples of the memory use of the process tree
+SAMPLE_INTERVAL = 0.5
+
+
+def cpu_seconds():
+    """User plus system time of this process and its reaped children"""
+    if resource is None:
+        return 0.0
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def io_bytes():
+    """
+    (read, written) bytes of storage I/O of this process, its exited
+    children (the kernel adds those to the parent's counts) and its running
+    descendants
+    """
+    read = written = 0
+    for member in _tree(os.getpid()) if os.path.isdir("/proc") else ():
+        counts = {}
+        try:
+            with open("/proc/%d/io" % member) as stdr:
+                for line in stdr:
+                    key, _, value = line.partition(":")
+                    counts[key] = int(value)
+        except (IOError, OSError, ValueError):
+            continue
+        read += counts.get("read_bytes", 0)
+        written += counts.get("write_bytes", 0)
+    return read, written
+
+
+def _children():
+    """Map of pid to parent pid for every process in /proc"""
+    parents = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as stdr:
+                stat = stdr.read()
+        except (IOError, OSError):
+            continue
+        # The command name may contain spaces; fields resume after ')'
+        parents[int(name)] = int(stat.rpartition(")")[2].split()[1])
+    return parents
+
+
+def _tree(pid):
+    """pid and all its descendants"""
+    parents = _children()
+    tree, todo = set(), [pid]
+    while todo:
+        current = todo.pop()
+        tree.add(current)
+        todo.extend(child for child, parent in parents.items()
+                    if parent == current and child not in tree)
+    return tree
+
+
+def tree_rss(pid=None):
+    """Resident memory in bytes of pid (default: this process) and descendants"""
+    pid = pid or os.getpid()
+    if not os.path.isdir("/proc/%d" % pid):
+        if resource is None:
+            return 0
+        # ru_maxrss is the high water mark, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    page = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for member in _tree(pid):
+        try:
+            with open("/proc/%d/statm" % member) as stdr:
+                total += int(stdr.read().split()[1]) * page
+        except (IOError, OSError):
+            continue
+    return total
+
+
+class StepRecord(object):
+
+    def __init__(self, step, concurrent):
+        self.step = step
+        self.start = time.time()
+        self.cpu = cpu_seconds()
+        self.io = io_bytes()
+        self.peak_rss = tree_rss()
+        self.concurrent = concurrent
+
+    def finish(self, status):
+        read, written = io_bytes()
+        return {
+            "label"           : self.step.label,
+            "cab"             : self.step.cab_name,
+            "status"          : status,
+            "start"           : self.start,
+            "wall"            : time.time() - self.start,
+            "cpu"             : cpu_seconds() - self.cpu,
+            "peak_rss"        : self.peak_rss,
+            "read_bytes"      : read - self.io[0],
+            "write_bytes"     : written - self.io[1],
+            "container_setup" : self.step.timings.get("container_setup"),
+            "concurrent"      : self.concurrent,
+        }
+
+
+class StepProfiler(object):
+    """
+    Recipe hook collecting a StepRecord per executed step. Reports are
+    written to <directory>/<prefix>.json and .csv.
+    """
+
+    def __init__(self, directory="reports", prefix=None):
+        self.directory = directory
+        self.prefix = prefix or time.strftime("run-%Y%m%d-%H%M%S")
+        self.records = []
+        self.active = {}
+        self.lock = threading.Lock()
+        self._sampler = None
+
+    def before_step(self, step):
+        with self.lock:
+            for record in self.active.values():
+                record.concurrent += 1
+            self.active[step.label] = StepRecord(step, len(self.active))
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample)
+                self._sampler.daemon = True
+                self._sampler.start()
+
+    def after_step(self, step, status):
+        with self.lock:
+            record = self.active.pop(step.label)
+            self.records.append(record.finish(status))
+            self.save()
+
+    def _sample(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            with self.lock:
+                if not self.active:
+                    self._sampler = None
+                    return
+                records = list(self.active.values())
+            rss = tree_rss()
+            for record in records:
+                record.peak_rss = max(record.peak_rss, rss)
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = os.path.join(self.directory, self.prefix)
+        with open(name + ".json.tmp", "w") as stdw:
+            json.dump({"steps": self.records}, stdw, indent=1)
+        os.rename(name + ".json.tmp", name + ".json")
+        with open(name + ".csv", "w") as stdw:
+            writer = csv.DictWriter(stdw, FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+    def summary(self):
+        """
+        Table of the recorded steps, slowest first; steps that overlapped
+        others are marked with '*'
+        """
+        lines = ["%-36s %-8s %9s %9s %9s %9s %9s" % (
+            "step", "status", "wall(s)", "cpu(s)", "rss(MB)", "read(MB)",
+            "write(MB)")]
+        for record in sorted(self.records, key=lambda r: -r["wall"]):
+            mark = "*" if record["concurrent"] else ""
+            lines.append("%-36s %-8s %9.1f %9.1f %9.1f %9.1f %9.1f" % (
+                (record["label"][:35] + mark).ljust(36), record["status"],
+                record["wall"], record["cpu"], record["peak_rss"] / 2.0**20,
+                record["read_bytes"] / 2.0**20,
+                record["write_bytes"] / 2.0**20))
+        total = sum(record["wall"] for record in self.records)
+        lines.append("%d steps, %.1f s of step time" % (len(self.records),
+                                                         total))
+        if any(record["concurrent"] for record in self.records):
+            lines.append("* ran alongside other steps: cpu, rss and I/O "
+                         "include theirs")
+        return "\n".join(lines)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoint journal for resuming a recipe script after a crash.
+
+The journal is a JSON-lines file recording, in order, every Recipe.run call
+(with its step labels), every finished step (with its status and a
+fingerprint of the files it wrote) and every MS snapshot taken through
+Journal.checkpoint. A script is expected to make the same runs and
+checkpoints each time it is started.
+
+With resume=True the previous journal is compared with the files on disk to
+find the first step that did not finish, or whose outputs have changed since.
+The MS is rolled back to the last checkpoint before that step when the script
+reaches it, and from there on a step is rerun if it touches a measurement set,
+if it did not finish or its outputs are gone, or if it uses anything written
+by a rerun step. All other steps are skipped.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import threading
+
+from gcpipe import graph
+from gcpipe.cache import fingerprint
+
+# Resources that are rolled back with the MS rather than fingerprinted
+MS_KINDS = ("column", "table")
+
+
+def touches_ms(io):
+    if io is graph.BARRIER:
+        return True
+    return any(res[0] in MS_KINDS for res in io[0] | io[1])
+
+
+def outputs(io):
+    """[resource, fingerprint] of the files and prefixes a step writes"""
+    if io is graph.BARRIER:
+        return []
+    return [[list(res), fingerprint(res)] for res in sorted(io[1])
+            if res[0] not in MS_KINDS]
+
+
+class Journal(object):
+    """
+    Journal kept in file `path`. Pass it to Recipe(journal=...) and take MS
+    snapshots with checkpoint() so that they can be restored on resume.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume and os.path.exists(path)
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.counts = {}
+        self.dirty = set()
+        self.restore = None
+        self.boundary = (0, 0)
+        if self.resume:
+            self._prepare(self._load())
+        open(path, "w").close()
+
+    def _load(self):
+        previous = {"runs": [], "steps": {}, "checkpoints": []}
+        with open(self.path) as stdr:
+            for seq, line in enumerate(stdr):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Last line cut short by the crash
+                    continue
+                event["seq"] = seq
+                if event["event"] == "run":
+                    previous["runs"].append(event["labels"])
+                elif event["event"] == "step":
+                    key = (event["run"], event["label"], event["n"])
+                    previous["steps"][key] = event
+                elif event["event"] == "checkpoint":
+                    previous["checkpoints"].append((event["run"],
+                                                    event["name"]))
+        return previous
+
+    def _valid(self, event):
+        return event is not None and event["status"] in ("done", "cached",
+                                                         "resumed") and all(
+            fingerprint(tuple(res)) == fp for res, fp in event["outputs"]
+            if tuple(res) not in event["superseded"])
+
+    def _supersede(self, previous):
+        """
+        Mark outputs that a later step wrote again (e.g. a wsclean prefix
+        continued by a second pass); those are not expected to match.
+        """
+        events = sorted(previous["steps"].values(), key=lambda e: e["seq"])
+        for index, event in enumerate(events):
+            later = [tuple(res) for other in events[index + 1:]
+                     for res, _ in other["outputs"]]
+            event["superseded"] = set(
+                tuple(res) for res, _ in event["outputs"]
+                if graph.intersects([tuple(res)], later))
+
+    def _prepare(self, previous):
+        """Find the first step to redo and the checkpoint to restore"""
+        self._supersede(previous)
+        self.valid = {}
+        first = (len(previous["runs"]), 0)
+        for run, labels in enumerate(previous["runs"]):
+            seen = {}
+            for index, label in enumerate(labels):
+                n = seen[label] = seen.get(label, -1) + 1
+                event = previous["steps"].get((run, label, n))
+                if self._valid(event):
+                    self.valid[(run, label, n)] = event
+                elif (run, index) < first:
+                    first = (run, index)
+        before = [cp for cp in previous["checkpoints"] if cp[0] <= first[0]]
+        if before:
+            self.restore = before[-1]
+            self.boundary = (self.restore[0], 0)
+        else:
+            self.boundary = first
+        labels = previous["runs"][first[0]] if first[0] < len(
+            previous["runs"]) else None
+        print("Resuming: %s%s" % (
+            "redoing from step '%s' of run %d" % (labels[first[1]], first[0])
+            if labels else "all recorded steps finished",
+            ", restoring snapshot %s" % self.restore[1]
+            if self.restore else ""))
+
+    def _append(self, event):
+        with open(self.path, "a") as stdw:
+            stdw.write(json.dumps(event) + "\n")
+
+    def plan(self, steps):
+        """
+        Start the next Recipe.run; returns the indices of the steps that can
+        be skipped.
+        """
+        with self.lock:
+            run = self.runs
+            self.runs += 1
+            self.counts = {}
+            self._append({"event": "run", "run": run,
+                          "labels": [step.label for step in steps]})
+            if not self.resume:
+                return set()
+            skip = set()
+            seen = {}
+            for index, step in enumerate(steps):
+                n = seen[step.label] = seen.get(step.label, -1) + 1
+                valid = (run, step.label, n) in self.valid
+                io = graph.step_io(step)
+                if (run, index) < self.boundary:
+                    rerun = not valid
+                else:
+                    rerun = (not valid or touches_ms(io) or self.dirty is None
+                             or graph.conflicts((set(), self.dirty), io))
+                if not rerun:
+                    skip.add(index)
+                elif io is graph.BARRIER:
+                    # May have written anything: rerun everything after it
+                    self.dirty = None
+                elif self.dirty is not None:
+                    self.dirty |= io[1]
+            return skip
+
+    def before_step(self, step):
+        pass
+
+    def after_step(self, step, status):
+        with self.lock:
+            run = self.runs - 1
+            n = self.counts[step.label] = self.counts.get(step.label, -1) + 1
+            if status == "resumed":
+                found = self.valid[(run, step.label, n)]["outputs"]
+            elif status == "failed":
+                found = []
+            else:
+                found = outputs(graph.step_io(step))
+            self._append({"event": "step", "run": run, "label": step.label,
+                          "n": n, "status": status, "outputs": found})
+
+    def checkpoint(self, snapshots, name):
+        """
+        Take MS snapshot `name` at this point of the script. When resuming,
+        snapshots from before the restart point are kept as they are and the
+        one to restart from is restored instead. Returns the snapshot path.
+        """
+        position = (self.runs, name)
+        if self.resume and position == self.restore:
+            restored = snapshots.restore(name)
+            print("Restored %s from snapshot %s (%.1f MB copied back)" %
+                  (snapshots.ms, name, restored / 2.0**20))
+            path = snapshots.path(name)
+        elif (self.resume and self.restore is not None and
+              position[0] < self.restore[0] and name in snapshots.names()):
+            path = snapshots.path(name)
+        else:
+            path = snapshots.take(name)
+        # Only recorded once the snapshot is complete
+        with self.lock:
+            self._append({"event": "checkpoint", "run": self.runs,
+                          "name": name})
+        return path
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in backend that runs no containers, for profiling and regression
+testing the recipes (scheduling, caching, I/O) on a laptop.
+
+MockBackend takes the place of every cab with an IO rule in gcpipe.graph.
+A mock step reads the MS columns the rule says the step reads, and produces
+what it says it writes, in formats the in-process steps downstream accept:
+
+- MS columns are rewritten in place (new ones added first). MODEL_DATA and
+  simulator output are unit visibilities, CORRECTED_DATA is a copy of the
+  input column, an msutils copycol copies fromcol, anything else keeps its
+  contents.
+- calibration tables are unit-gain K, B or G tables of the MS's antennas,
+  spectral windows and selected fields,
+- wsclean image prefixes get noise images with a few point sources, pybdsm
+  outfiles and other .lsm.html files a small Tigger sky model,
+  tigger_restore a copy of its input image, other FITS files a blank image
+  and anything else an empty file.
+
+On top of that every step can be given a synthetic load: latency (sleep,
+reported as container set-up), CPU seconds (a busy loop) and extra bytes
+written to a scratch file. Loads are given per cab, with "*" as the default
+for cabs that are not listed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from gcpipe import columns, graph
+from gcpipe.fitsio import write_image
+from gcpipe.skymodel import DTYPE, SkyModel
+
+LOAD_KEYS = ("latency", "cpu", "write_bytes")
+
+# Files wsclean writes for a prefix
+WSCLEAN_IMAGES = ("-image.fits", "-residual.fits", "-model.fits",
+                  "-psf.fits", "-dirty.fits")
+
+CALTABLE_KINDS = {
+    "cab/casa_bandpass"  : "B",
+    "cab/casa_fluxscale" : "G",
+}
+
+CAL_COLUMNS = ("TIME", "INTERVAL", "FIELD_ID", "SPECTRAL_WINDOW_ID",
+               "ANTENNA1", "ANTENNA2", "SCAN_NUMBER", "OBSERVATION_ID")
+
+
+def _busy(seconds):
+    """Keep a core busy for seconds"""
+    block = np.random.random((64, 64))
+    end = time.time() + seconds
+    while time.time() < end:
+        block = np.dot(block, block)
+        block /= np.abs(block).max() or 1
+
+
+def _scratch_write(nbytes, directory=None):
+    fd, name = tempfile.mkstemp(prefix="gcpipe-mock-", dir=directory)
+    try:
+        chunk = np.zeros(min(nbytes, 2**24), np.uint8).tobytes()
+        with os.fdopen(fd, "wb") as stdw:
+            left = nbytes
+            while left > 0:
+                stdw.write(chunk[:left])
+                left -= len(chunk)
+            stdw.flush()
+            os.fsync(stdw.fileno())
+    finally:
+        os.remove(name)
+
+
+def column_source(step, name):
+    """
+    What a mock step writes to column name of its MS: "ones", "zeros", the
+    name of a column to copy, or None to keep the contents.
+    """
+    config = step.config
+    if step.cab == "cab/msutils" and config.get("command") == "copycol":
+        return config["fromcol"]
+    if step.cab == "cab/simulator" or name == "MODEL_DATA":
+        return "ones"
+    if name == "CORRECTED_DATA":
+        return config.get("column", "DATA")
+    return None
+
+
+def caltable_kind(step):
+    """Type (K, B, G or T) of the calibration table a step writes, if any"""
+    if step.cab == "cab/casa_gaincal":
+        return step.config.get("gaintype", "G")
+    return CALTABLE_KINDS.get(step.cab)
+
+
+def _template(name):
+    if name.endswith("_ROW"):
+        return "FLAG_ROW"
+    if name.startswith("BITFLAG") or name == "FLAG":
+        return "FLAG"
+    return "DATA"
+
+
+def write_column(ms, name, source, chunk_bytes=columns.CHUNK_BYTES):
+    """Rewrite (or add) column name of ms from source (see column_source)"""
+    import pyrap.tables as pt
+
+    tab = pt.table(ms, readonly=False, ack=False)
+    try:
+        if name not in tab.colnames():
+            columns.add_column_like(tab, _template(name), name)
+            if source is None:
+                source = "zeros"
+        per_block = columns.rows_per_chunk(tab, "DATA", chunk_bytes)
+        for start, nrow in columns.row_blocks(tab.nrows(), per_block):
+            if source in ("ones", "zeros"):
+                values = tab.getcol(_template(name), start, nrow)
+                values = (np.ones_like(values) if source == "ones" else
+                          np.zeros_like(values))
+            else:
+                values = tab.getcol(source or name, start, nrow)
+            tab.putcol(name, values, start, nrow)
+    finally:
+        tab.close()
+
+
+def read_column(ms, name, chunk_bytes=columns.CHUNK_BYTES):
+    import pyrap.tables as pt
+
+    tab = pt.table(ms, ack=False)
+    try:
+        if name not in tab.colnames():
+            return
+        per_block = columns.rows_per_chunk(tab, name, chunk_bytes)
+        for start, nrow in columns.row_blocks(tab.nrows(), per_block):
+            tab.getcol(name, start, nrow)
+    finally:
+        tab.close()
+
+
+def write_caltable(path, ms, kind, field=""):
+    """A unit-gain CASA calibration table of type kind (K, B or G) for ms"""
+    import pyrap.tables as pt
+    from gcpipe.visstats import MSInfo, parse_fields
+
+    info = MSInfo(ms)
+    sub = pt.table(os.path.join(ms, "ANTENNA"), ack=False)
+    nant = sub.nrows()
+    sub.close()
+    tab = pt.table(ms, ack=False)
+    try:
+        meta = dict((name, tab.getcol(name)) for name in
+                    ("TIME", "FIELD_ID", "DATA_DESC_ID", "SCAN_NUMBER"))
+    finally:
+        tab.close()
+    fields = parse_fields(field, info.fields) if field else None
+    rows = []
+    for fid, ddid in sorted(set(zip(meta["FIELD_ID"].tolist(),
+                                    meta["DATA_DESC_ID"].tolist()))):
+        if fields and fid not in fields:
+            continue
+        select = (meta["FIELD_ID"] == fid) & (meta["DATA_DESC_ID"] == ddid)
+        time_ = meta["TIME"][select].mean()
+        scan = meta["SCAN_NUMBER"][select][0]
+        for ant in range(nant):
+            rows.append((time_, 0.0, fid, info.ddid_spw[ddid], ant, -1,
+                         scan, 0))
+    spw = info.ddid_spw[meta["DATA_DESC_ID"][0]] if len(meta["TIME"]) else 0
+    nchan = len(info.freqs[spw]) if kind == "B" else 1
+    column = "FPARAM" if kind == "K" else "CPARAM"
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    descs = [pt.makescacoldesc(name, 0.0 if name in ("TIME", "INTERVAL")
+                               else 0) for name in CAL_COLUMNS]
+    descs += [pt.makearrcoldesc(column, 0.0 if kind == "K" else 0j, ndim=2),
+              pt.makearrcoldesc("PARAMERR", 0.0, ndim=2),
+              pt.makearrcoldesc("FLAG", False, ndim=2),
+              pt.makearrcoldesc("SNR", 0.0, ndim=2),
+              pt.makearrcoldesc("WEIGHT", 0.0, ndim=2)]
+    cal = pt.table(path, pt.maketabdesc(descs), nrow=len(rows), ack=False)
+    try:
+        values = np.array(rows)
+        for index, name in enumerate(CAL_COLUMNS):
+            cal.putcol(name, values[:, index].astype(
+                np.float64 if name in ("TIME", "INTERVAL") else np.int32))
+        shape = (len(rows), nchan, 2)
+        cal.putcol(column, np.zeros(shape) if kind == "K" else
+                   np.ones(shape, np.complex64))
+        cal.putcol("PARAMERR", np.zeros(shape))
+        cal.putcol("FLAG", np.zeros(shape, bool))
+        cal.putcol("SNR", np.full(shape, 100.0))
+        cal.putcol("WEIGHT", np.ones(shape))
+        cal.putkeyword("VisCal", "%s Jones" % kind)
+        cal.putkeyword("ParType", "Float" if kind == "K" else "Complex")
+        cal.putkeyword("MSName", os.path.basename(ms))
+        for sub in ("ANTENNA", "FIELD", "SPECTRAL_WINDOW", "OBSERVATION"):
+            source = os.path.join(ms, sub)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(path, sub))
+                cal.putkeyword(sub, "Table: " + os.path.join(path, sub))
+    finally:
+        cal.close()
+
+
+def write_images(prefix, npix, sources=5, seed=None):
+    """Noise images with a few point sources for a wsclean prefix"""
+    rng = np.random.RandomState(seed)
+    image = rng.normal(0, 1e-4, (npix, npix)).astype(np.float32)
+    model = np.zeros_like(image)
+    for y, x in rng.randint(npix // 4, 3 * npix // 4, (sources, 2)):
+        flux = rng.uniform(1e-3, 1e-2)
+        image[y, x] += flux
+        model[y, x] = flux
+    for suffix in WSCLEAN_IMAGES:
+        data = {"-model.fits": model, "-psf.fits": None}.get(suffix, image)
+        if data is None:
+            data = np.zeros_like(image)
+            data[npix // 2, npix // 2] = 1
+        write_image(prefix + suffix, data[None, None])
+
+
+def write_skymodel(path, ms=None, sources=5, seed=None):
+    """A small Tigger sky model around the first field of ms"""
+    ra0 = dec0 = 0.0
+    if ms and os.path.isdir(os.path.join(ms, "FIELD")):
+        import pyrap.tables as pt
+        sub = pt.table(os.path.join(ms, "FIELD"), ack=False)
+        ra0, dec0 = sub.getcell("PHASE_DIR", 0)[0]
+        sub.close()
+    rng = np.random.RandomState(seed)
+    model = np.zeros(sources, DTYPE)
+    model["name"] = ["S%d" % index for index in range(sources)]
+    model["ra"] = ra0 + rng.uniform(-1e-3, 1e-3, sources)
+    model["dec"] = dec0 + rng.uniform(-1e-3, 1e-3, sources)
+    model["I"] = rng.uniform(1e-3, 1e-2, sources)
+    model["tags"] = [{} for _ in range(sources)]
+    SkyModel(model, ra0=ra0, dec0=dec0).save(path)
+
+
+class MockBackend(object):
+    """
+    Runs cab steps as mocks; see the module description. load maps cab
+    names (or "*") to dicts of LOAD_KEYS; npix caps the image size.
+    """
+
+    def __init__(self, ms_dir=None, load=None, npix=256, scratch=None,
+                 chunk_bytes=columns.CHUNK_BYTES):
+        self.ms_dir = ms_dir
+        self.load = dict(load or {})
+        self.npix = npix
+        self.scratch = scratch
+        self.chunk_bytes = chunk_bytes
+
+    def _load(self, step):
+        load = dict((key, 0) for key in LOAD_KEYS)
+        load.update(self.load.get("*", {}))
+        load.update(self.load.get(step.cab, {}))
+        return load
+
+    def run(self, step):
+        load = self._load(step)
+        time.sleep(load["latency"])
+        step.timings["container_setup"] = load["latency"]
+        io = graph.step_io(step)
+        if io is graph.BARRIER:
+            print("%s: no IO rule for %s, nothing to mock" % (step.label,
+                                                               step.cab))
+            reads = writes = set()
+        else:
+            reads, writes = io
+        for resource in sorted(reads):
+            if (resource[0] == "column" and resource not in writes and
+                    os.path.isdir(resource[1])):
+                read_column(resource[1], resource[2], self.chunk_bytes)
+        _busy(load["cpu"])
+        if load["write_bytes"]:
+            _scratch_write(int(load["write_bytes"]), self.scratch)
+        for resource in sorted(writes):
+            self._produce(step, resource)
+
+    def _produce(self, step, resource):
+        kind, path = resource[:2]
+        if kind == "column":
+            if os.path.isdir(path):
+                write_column(path, resource[2],
+                             column_source(step, resource[2]),
+                             self.chunk_bytes)
+            return
+        if kind == "table":
+            return
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if kind == "prefix":
+            if step.cab == "cab/wsclean":
+                npix = min(graph.as_list(step.config.get("npix",
+                                                         self.npix))[0],
+                           self.npix)
+                write_images(path, npix)
+            elif step.cab == "cab/pybdsm":
+                write_skymodel(path if path.endswith(".lsm.html") else
+                               path + ".lsm.html", step.ms)
+            return
+        kind = caltable_kind(step)
+        if kind is not None:
+            if step.ms and os.path.isdir(step.ms):
+                write_caltable(path, step.ms, kind,
+                               step.config.get("field", ""))
+            return
+        if step.cab == "cab/tigger_restore":
+            source = step.path(step.config["input-image"])
+            if os.path.exists(source):
+                shutil.copy(source, path)
+                return
+        if path.endswith(".lsm.html"):
+            write_skymodel(path, step.ms)
+        elif path.endswith(".fits"):
+            write_image(path, np.zeros((1, 1, self.npix, self.npix)))
+        else:
+            open(path, "a").close()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Render several plotcal style figures from one read of a calibration table.
+
+Each entry of `plots` is a dict with the plotcal parameters that differ
+between figures (poln, xaxis, yaxis, figfile); subplot and iteration are
+shared. The table is read once into NumPy arrays and the figures are
+rasterised by a pool of worker processes.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from gcpipe import graph
+from gcpipe.scheduler import forks
+
+POLN = {
+    "R" : [0],
+    "X" : [0],
+    "L" : [1],
+    "Y" : [1],
+}
+
+YAXES = {
+    "amp"   : (np.abs, "Amplitude"),
+    "phase" : (lambda v: np.degrees(np.angle(v)), "Phase (deg)"),
+    "real"  : (np.real, "Real"),
+    "imag"  : (np.imag, "Imaginary"),
+    "delay" : (np.real, "Delay (ns)"),
+}
+
+XLABELS = {
+    "chan" : "Channel",
+    "freq" : "Frequency (GHz)",
+    "time" : "Time (hours from start)",
+}
+
+
+class CalTable(object):
+    """The columns of a CASA calibration table needed for plotting"""
+
+    def __init__(self, path):
+        import pyrap.tables as pt
+        self.path = path
+        tab = pt.table(path, ack=False)
+        try:
+            self.time = tab.getcol("TIME")
+            self.antenna = tab.getcol("ANTENNA1")
+            self.spw = tab.getcol("SPECTRAL_WINDOW_ID")
+            column = "CPARAM" if "CPARAM" in tab.colnames() else "FPARAM"
+            self.param = tab.getcol(column)
+            self.flag = tab.getcol("FLAG")
+        finally:
+            tab.close()
+        sub = pt.table(os.path.join(path, "ANTENNA"), ack=False)
+        self.names = sub.getcol("NAME")
+        sub.close()
+        sub = pt.table(os.path.join(path, "SPECTRAL_WINDOW"), ack=False)
+        self.freqs = [sub.getcell("CHAN_FREQ", i) for i in range(sub.nrows())]
+        sub.close()
+
+    def xvalues(self, xaxis):
+        """x coordinate of every (row, channel) sample"""
+        nrow, nchan = self.param.shape[:2]
+        if xaxis == "chan":
+            return np.tile(np.arange(nchan), (nrow, 1))
+        if xaxis == "freq":
+            return np.array([self.freqs[spw][:nchan] for spw in self.spw]) / 1e9
+        if xaxis == "time":
+            hours = (self.time - self.time.min()) / 3600.
+            return np.repeat(hours[:, None], nchan, axis=1)
+        raise ValueError("Unsupported plotcal xaxis '%s'" % xaxis)
+
+    def panels(self, poln, xaxis, yaxis, iteration):
+        """List of (title, x, y) with the unflagged samples of each panel"""
+        func = YAXES[yaxis][0]
+        corrs = POLN.get(poln, range(self.param.shape[2]))
+        x = self.xvalues(xaxis)
+        groups = [("", np.ones(len(self.antenna), bool))]
+        if iteration == "antenna":
+            groups = [(self.names[ant], self.antenna == ant)
+                      for ant in np.unique(self.antenna)]
+        panels = []
+        for title, rows in groups:
+            xs, ys = [], []
+            for corr in corrs:
+                good = ~self.flag[rows, :, corr]
+                xs.append(x[rows][good])
+                ys.append(func(self.param[rows, :, corr][good]))
+            panels.append((title, np.concatenate(xs), np.concatenate(ys)))
+        return panels
+
+
+def _layout(subplot):
+    """plotcal subplot code (e.g. 655) to (rows, columns)"""
+    code = str(subplot)
+    if len(code) != 3:
+        return 1, 1
+    return int(code[0]), int(code[1])
+
+
+def _pages(figfile, npages):
+    stem, ext = os.path.splitext(figfile)
+    return [figfile] + ["%s-%d%s" % (stem, page + 1, ext)
+                        for page in range(1, npages)]
+
+
+def _render(job):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    figfile, title, xlabel, ylabel, panels, (nrows, ncols) = job
+    per_page = nrows * ncols
+    npages = max(1, (len(panels) + per_page - 1) // per_page)
+    for page, name in enumerate(_pages(figfile, npages)):
+        fig, axes = plt.subplots(nrows, ncols, squeeze=False,
+                                 figsize=(3 * ncols, 2.2 * nrows))
+        for ax, (label, x, y) in zip(axes.flat,
+                                     panels[page * per_page:][:per_page]):
+            ax.plot(x, y, ".", markersize=1.5)
+            ax.set_title(label, fontsize=8)
+            ax.tick_params(labelsize=6)
+        for ax in axes.flat[len(panels) - page * per_page:]:
+            ax.set_visible(False)
+        fig.suptitle(title)
+        fig.text(0.5, 0.01, xlabel, ha="center")
+        fig.text(0.01, 0.5, ylabel, va="center", rotation="vertical")
+        fig.savefig(name, dpi=100)
+        plt.close(fig)
+    return figfile
+
+
+@forks()
+def plotcal(caltable, plots, subplot=655, iteration="antenna", workers=4):
+    """
+    Render every figure in plots (dicts with poln, xaxis, yaxis and figfile)
+    from caltable.
+    """
+    cal = CalTable(caltable)
+    jobs = []
+    for plot in plots:
+        yaxis = plot.get("yaxis", "amp")
+        xaxis = plot.get("xaxis", "time")
+        title = "%s %s %s" % (os.path.basename(caltable),
+                              plot.get("poln", ""), yaxis)
+        panels = cal.panels(plot.get("poln", ""), xaxis, yaxis, iteration)
+        jobs.append((plot["figfile"], title, XLABELS[xaxis], YAXES[yaxis][1],
+                     panels, _layout(subplot)))
+
+    if workers <= 1 or len(jobs) <= 1:
+        return [_render(job) for job in jobs]
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(_render, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@graph.register_io(plotcal)
+def _plotcal_io(step):
+    figfiles = set(("file", step.path(plot["figfile"]))
+                   for plot in step.config["plots"])
+    return graph.files(step, "caltable"), figfiles
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+"""
+Warm containers for repeated cab invocations.
+
+StimelaBackend starts a fresh container for every step, so every CASA task
+pays for a container start and a full CASA import. ContainerPool keeps one
+long-lived container per cab family (CASA tasks, wsclean) instead, started
+with `docker run -i` on the first step of the family. A small server inside
+reads one JSON request per line on stdin, runs the task (a CASA task in the
+server's own interpreter, so imports are paid once, or a command line
+tool), and answers on stdout with a line starting with MARKER; anything
+else the task prints is passed through, prefixed with the step label.
+
+A cab is served by the pool if a translation is registered for it: a rule
+turning a step into (family, request), following the parameter conventions
+of the stimela cab. Other cabs, and every cab if docker is not available,
+run through the fallback backend (stimela by default). Up to `size`
+containers are started per family when steps run concurrently.
+
+The containers see the working directory, ms_dir and the steps' input and
+output directories at their own paths. Call close() (Recipe.close does) to
+shut them down; they are also stopped when the interpreter exits.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import atexit
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from gcpipe import graph
+
+MARKER = "@@gcpipe-pool@@ "
+
+FAMILIES = {
+    "casa"    : {"image"   : "stimela/casa:latest",
+                 "command" : ["casa", "--nogui", "--agg", "--nologger",
+                              "--log2term", "-c"]},
+    "wsclean" : {"image"   : "stimela/wsclean:latest",
+                 "command" : ["python", "-u"]},
+}
+
+# Runs inside the containers; must work with the python 2 of older images
+SERVER = r'''
+import json, subprocess, sys, traceback
+MARKER = %(marker)r
+
+def task(name):
+    if name in globals():
+        return globals()[name]
+    import casatasks
+    return getattr(casatasks, name)
+
+def reply(message):
+    sys.stdout.flush()
+    sys.stdout.write(MARKER + json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+try:
+    import casatasks
+except ImportError:
+    pass
+reply({"status": "ready"})
+for line in iter(sys.stdin.readline, ""):
+    request = json.loads(line)
+    try:
+        if "argv" in request:
+            sys.stdout.flush()
+            code = subprocess.call(request["argv"])
+            if code:
+                raise RuntimeError("%%s exited with %%d" %% (
+                    request["argv"][0], code))
+        else:
+            args = dict((str(key), value)
+                        for key, value in request["args"].items())
+            result = task(request["task"])(**args)
+            if result is False:
+                raise RuntimeError("%%s failed" %% request["task"])
+        reply({"status": "ok"})
+    except Exception:
+        reply({"status": "error", "message": traceback.format_exc()})
+''' % {"marker": MARKER}
+
+TRANSLATIONS = {}
+
+
+def register_translation(*cabs):
+    """Decorator registering a step -> (family, request) rule for cabs"""
+    def wrapper(rule):
+        for cab in cabs:
+            TRANSLATIONS[cab] = rule
+        return rule
+    return wrapper
+
+
+CASA_TASKS = {
+    "cab/casa_setjy"     : "setjy",
+    "cab/casa_gaincal"   : "gaincal",
+    "cab/casa_bandpass"  : "bandpass",
+    "cab/casa_fluxscale" : "fluxscale",
+    "cab/casa_applycal"  : "applycal",
+    "cab/casa_flagdata"  : "flagdata",
+    "cab/casa_plotcal"   : "plotcal",
+    "cab/casa_plotms"    : "plotms",
+}
+
+# CASA task parameters naming files in the output directory
+CASA_FILES = ("caltable", "gaintable", "fluxtable", "figfile", "plotfile")
+
+
+@register_translation(*CASA_TASKS)
+def _casa(step):
+    args = {}
+    for key, value in step.resolved_config().items():
+        if key in graph.MS_KEYS:
+            key = "vis"
+        elif key in CASA_FILES and value:
+            # Plain names live in the output directory, as in the cabs
+            paths = [step.path(item) if item else item
+                     for item in graph.as_list(step.config[key])]
+            value = paths if isinstance(value, (list, tuple)) else paths[0]
+        args[key] = value
+    return "casa", {"task": CASA_TASKS[step.cab], "args": args}
+
+
+# stimela wsclean cab parameters that are not wsclean option names
+WSCLEAN_OPTIONS = {
+    "column"           : "data-column",
+    "prefix"           : "name",
+    "npix"             : "size",
+    "cellsize"         : "scale",
+    "clean_iterations" : "niter",
+    "channelrange"     : "channel-range",
+    "stokes"           : "pol",
+    "fitsmask"         : "fits-mask",
+}
+
+
+@register_translation("cab/wsclean")
+def _wsclean(step):
+    config = step.resolved_config()
+    argv = ["wsclean"]
+    for key, value in sorted(config.items()):
+        if key in graph.MS_KEYS or value is None or value is False:
+            continue
+        option = WSCLEAN_OPTIONS.get(key, key)
+        argv.append("-" + option)
+        if value is True:
+            continue
+        if key == "prefix":
+            # Plain names live in the output directory, as in the cab
+            value = step.path(step.config[key])
+        values = graph.as_list(value)
+        if key in ("npix", "trim") and len(values) == 1:
+            values *= 2
+        elif key == "cellsize":
+            values = ["%gasec" % values[0]]
+        elif key == "weight":
+            values = str(value).split()
+        argv.extend(str(item) for item in values)
+    argv.extend(graph.as_list(step.ms))
+    return "wsclean", {"argv": argv}
+
+
+class Worker(object):
+    """One long-lived container of a family"""
+
+    def __init__(self, family, mounts, server):
+        spec = FAMILIES[family]
+        argv = ["docker", "run", "-i", "--rm", "-w", os.getcwd(),
+                "-v", "%s:/gcpipe-pool:ro" % server]
+        if hasattr(os, "getuid"):
+            argv += ["--user", "%d:%d" % (os.getuid(), os.getgid())]
+        for path in mounts:
+            argv += ["-v", "%s:%s" % (path, path)]
+        argv += [spec["image"]] + spec["command"] + [
+            "/gcpipe-pool/server.py"]
+        self.family = family
+        self.process = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True, bufsize=1)
+        reply = self._reply(family)
+        if reply.get("status") != "ready":
+            self.close()
+            raise RuntimeError("%s container did not start" % family)
+
+    def _reply(self, label):
+        """Pass output through until the server's reply"""
+        for line in iter(self.process.stdout.readline, ""):
+            if line.startswith(MARKER):
+                return json.loads(line[len(MARKER):])
+            print("%s: %s" % (label, line.rstrip("\n")))
+        return {"status": "error",
+                "message": "%s container exited" % self.family}
+
+    def call(self, request, label):
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+        return self._reply(label)
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
+class ContainerPool(object):
+    """
+    Backend running the steps of cabs with a registered translation in warm
+    containers; see the module description.
+    """
+
+    def __init__(self, ms_dir=None, size=1, fallback=None):
+        from gcpipe.recipe import StimelaBackend
+        self.ms_dir = ms_dir
+        self.size = size
+        self.fallback = fallback or StimelaBackend(ms_dir=ms_dir)
+        self.idle = {}
+        self.started = {}
+        self.condition = threading.Condition()
+        self.server = None
+        self.available = self._docker()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _docker():
+        try:
+            with open(os.devnull, "w") as null:
+                return subprocess.call(["docker", "info"], stdout=null,
+                                       stderr=null) == 0
+        except OSError:
+            return False
+
+    def run(self, step):
+        rule = TRANSLATIONS.get(step.cab)
+        if rule is None or not self.available:
+            return self.fallback.run(step)
+        family, request = rule(step)
+        start = time.time()
+        key = (family, self._mounts(step))
+        worker = self._checkout(key)
+        step.timings["container_setup"] = time.time() - start
+        try:
+            reply = worker.call(request, step.label)
+        finally:
+            self._checkin(key, worker)
+        if reply.get("status") != "ok":
+            raise RuntimeError("%s failed in the %s container:\n%s" % (
+                step.label, family, reply.get("message", "")))
+
+    def _mounts(self, step):
+        paths = [os.getcwd(), self.ms_dir, step.input, step.output]
+        return tuple(sorted(set(os.path.abspath(path) for path in paths
+                                if path)))
+
+    def _checkout(self, key):
+        with self.condition:
+            while True:
+                idle = self.idle.setdefault(key, [])
+                while idle and not idle[-1].alive:
+                    idle.pop()
+                    self.started[key] -= 1
+                if idle:
+                    return idle.pop()
+                if self.started.get(key, 0) < self.size:
+                    self.started[key] = self.started.get(key, 0) + 1
+                    break
+                self.condition.wait()
+        try:
+            return Worker(key[0], key[1], self._server())
+        except Exception:
+            with self.condition:
+                self.started[key] -= 1
+                self.condition.notify_all()
+            raise
+
+    def _checkin(self, key, worker):
+        with self.condition:
+            if worker.alive:
+                self.idle.setdefault(key, []).append(worker)
+            else:
+                self.started[key] -= 1
+            self.condition.notify_all()
+
+    def _server(self):
+        with self.condition:
+            if self.server is None:
+                self.server = tempfile.mkdtemp(prefix="gcpipe-pool-")
+                with open(os.path.join(self.server, "server.py"), "w") as stdw:
+                    stdw.write(SERVER)
+            return self.server
+
+    def close(self):
+        """Stop all containers"""
+        with self.condition:
+            workers = [worker for idle in self.idle.values()
+                       for worker in idle]
+            self.idle, self.started = {}, {}
+            server, self.server = self.server, None
+        for worker in workers:
+            worker.close()
+        if server is not None:
+            shutil.rmtree(server, ignore_errors=True)
+        close = getattr(self.fallback, "close", None)
+        if close is not None:
+            close()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+A drop-in replacement for stimela.Recipe that schedules steps as a graph.
+
+Steps are added with the same call signature as stimela.Recipe.add. When run,
+the dependencies between the requested steps are derived from their declared
+inputs and outputs (see gcpipe.graph) and independent steps are executed
+concurrently, up to `workers` at a time. Each cab step is still executed by
+stimela, in a single-step stimela recipe of its own. Python callables can be
+added as steps as well; they are called in-process with the step config as
+keyword arguments. Those that fork a process pool run with no other step
+alongside (see gcpipe.scheduler).
+
+If a gcpipe.cache.StepCache is given, steps whose inputs and parameters are
+unchanged since a previous run are skipped.
+
+Steps may also be declared rather than added: a declared step is built, by a
+callable that adds it, only when its label is first run or looked up, so
+steps a run leaves out cost nothing (see gcpipe.config).
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import inspect
+import os
+
+from gcpipe import graph
+from gcpipe.scheduler import FORKS, run_graph
+
+SUFFIX_DIRS = ("input", "output")
+
+# Returned by Recipe.execute for steps skipped by the cache
+CACHED = object()
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def _makedirs(path):
+    """Create directory path if missing (concurrent steps may race)"""
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+def _default(function, name):
+    """Default value of argument name of function (None if it has none)"""
+    try:
+        spec = inspect.getfullargspec(function)
+    except AttributeError:
+        spec = inspect.getargspec(function)
+    defaults = spec.defaults or ()
+    return dict(zip(spec.args[len(spec.args) - len(defaults):],
+                    defaults)).get(name)
+
+
+class Step(object):
+    """One recipe.add call"""
+
+    def __init__(self, cab, name, config, input=None, output=None,
+                 label=None, ms_dir=None):
+        self.cab = cab
+        self.name = name
+        self.config = dict(config)
+        self.input = input
+        self.output = output
+        self.ms_dir = ms_dir
+        self.full_label = label or name
+        self.label = self.full_label.split("::")[0].strip()
+        # Filled in by backends while the step runs (e.g. container_setup)
+        self.timings = {}
+
+    def __repr__(self):
+        return "<Step %s (%s)>" % (self.label, self.cab_name)
+
+    @property
+    def cab_name(self):
+        return getattr(self.cab, "__name__", self.cab)
+
+    @property
+    def ms(self):
+        """Path to the measurement set this step works on, if any"""
+        for key in graph.MS_KEYS:
+            if self.config.get(key):
+                return os.path.join(self.ms_dir or "", self.config[key])
+        return None
+
+    @property
+    def output_ms(self):
+        """Path to the measurement set this step creates, if any"""
+        for key in graph.OUTPUT_MS_KEYS:
+            if self.config.get(key):
+                return os.path.join(self.ms_dir or "", self.config[key])
+        return None
+
+    def path(self, value):
+        """
+        Resolve a stimela style file argument ('name:output', 'name:input')
+        to a path. Plain names are taken to live in the output directory.
+        """
+        name, _, where = value.rpartition(":")
+        if name and where in SUFFIX_DIRS:
+            return os.path.join(getattr(self, where) or "", name)
+        return os.path.join(self.output or "", value)
+
+    @property
+    def forks(self):
+        """Whether the step forks a process pool (see gcpipe.scheduler)"""
+        argument = FORKS.get(self.cab) if callable(self.cab) else None
+        if argument is None:
+            return False
+        processes = self.config.get(argument, _default(self.cab, argument))
+        return (processes or 1) > 1
+
+    def resolved_config(self):
+        """The config with MS and file arguments turned into real paths"""
+        config = self._resolve(self.config)
+        for key in graph.MS_KEYS:
+            if config.get(key):
+                config[key] = self.ms
+        for key in graph.OUTPUT_MS_KEYS:
+            if config.get(key):
+                config[key] = self.output_ms
+        return config
+
+    def _resolve(self, value):
+        if isinstance(value, dict):
+            return dict((key, self._resolve(item))
+                        for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self._resolve(item) for item in value]
+        if (isinstance(value, string_types) and
+                value.rpartition(":")[2] in SUFFIX_DIRS):
+            return self.path(value)
+        return value
+
+
+class StimelaBackend(object):
+    """Runs each cab step as a single-step stimela recipe"""
+
+    def __init__(self, ms_dir=None):
+        self.ms_dir = ms_dir
+
+    def run(self, step):
+        import stimela
+        # The container is started inside recipe.run, so its set-up time
+        # is not known here
+        recipe = stimela.Recipe(step.full_label, ms_dir=self.ms_dir)
+        recipe.add(step.cab, step.name, step.config,
+                   input=step.input, output=step.output,
+                   label=step.full_label)
+        recipe.run([step.label])
+
+
+class Recipe(object):
+    """
+    Collects steps like stimela.Recipe and runs them as a dependency graph.
+
+    Steps are referred to by their label, i.e. the part of the `label`
+    argument before '::'. Adding a step with an existing label replaces it.
+    declare(label, build) registers a step that build(recipe) adds on first
+    use.
+
+    hooks are objects with before_step(step) and after_step(step, status)
+    methods, called around every step; status is "done", "cached",
+    "resumed" (skipped by the journal) or "failed". A gcpipe.Journal given
+    as journal records every step and decides which ones a resumed run skips.
+    """
+
+    def __init__(self, name, ms_dir=None, workers=1, backend=None,
+                 cache=None, hooks=None, journal=None):
+        self.name = name
+        self.ms_dir = ms_dir
+        self.workers = workers
+        self.backend = backend or StimelaBackend(ms_dir=ms_dir)
+        self.cache = cache
+        self.journal = journal
+        self.hooks = list(hooks or [])
+        if journal is not None:
+            self.hooks.append(journal)
+        self.steps = {}
+        self.order = []
+        self.declared = {}
+
+    def add(self, cab, name, config, input=None, output=None, label=None):
+        step = Step(cab, name, config, input=input, output=output,
+                    label=label, ms_dir=self.ms_dir)
+        if step.label not in self.steps and step.label not in self.declared:
+            self.order.append(step.label)
+        self.declared.pop(step.label, None)
+        self.steps[step.label] = step
+        return step
+
+    def declare(self, label, build):
+        """Register a step that build(recipe) adds when label is first used"""
+        if label not in self.steps and label not in self.declared:
+            self.order.append(label)
+        self.steps.pop(label, None)
+        self.declared[label] = build
+
+    def get(self, labels=None):
+        """Steps for the given labels (all steps, in order added, if None)"""
+        if labels is None:
+            labels = list(self.order)
+        for label in labels:
+            build = self.declared.get(label)
+            if build is not None:
+                # add() takes the label off declared, keeping its place
+                build(self)
+                self.declared.pop(label, None)
+        missing = [label for label in labels if label not in self.steps]
+        if missing:
+            raise KeyError("Unknown step label(s): %s" % ", ".join(missing))
+        return [self.steps[label] for label in labels]
+
+    def execute(self, step, session=None, resumed=False):
+        step.timings = {}
+        for hook in self.hooks:
+            hook.before_step(step)
+        status = "failed"
+        result = None
+        try:
+            if resumed:
+                print("%s: finished in the previous run, skipping" %
+                      step.label)
+                status = "resumed"
+            else:
+                result = self._execute(step, session)
+                status = "cached" if result is CACHED else "done"
+        finally:
+            for hook in self.hooks:
+                hook.after_step(step, status)
+        return result
+
+    def _execute(self, step, session):
+        entry = session.begin(step) if session else None
+        if entry and entry.hit:
+            print("%s: inputs unchanged, using cached outputs" % step.label)
+            return CACHED
+        if callable(step.cab):
+            # stimela creates the output directory of cab steps only
+            _makedirs(step.output)
+            result = step.cab(**step.resolved_config())
+        else:
+            result = self.backend.run(step)
+        if entry:
+            session.commit(entry)
+        return result
+
+    def run(self, labels=None, workers=None):
+        """
+        Run the steps named in labels. A label may be listed more than once,
+        in which case the step runs again at that point in the sequence.
+        """
+        steps = self.get(labels)
+        deps = graph.build_graph(steps)
+        session = self.cache.session() if self.cache else None
+        skip = self.journal.plan(steps) if self.journal else set()
+        run_graph([step.label for step in steps], deps,
+                  lambda index: self.execute(steps[index], session,
+                                             resumed=index in skip),
+                  workers=workers or self.workers,
+                  exclusive=set(index for index, step in enumerate(steps)
+                                if step.forks))
+
+    def close(self):
+        """Release the backend's resources (e.g. warm containers)"""
+        close = getattr(self.backend, "close", None)
+        if close is not None:
+            close()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run a dependency graph of steps with a bounded number of workers.
+
+Steps run in threads of this process. Cabs that fork a process pool of their
+own are marked with the `forks` decorator: forking while other threads hold
+locks (casacore, BLAS, stdout) can leave the children deadlocked on them, so
+the recipe runs those steps on their own, with no other step alongside.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import traceback
+from multiprocessing.pool import ThreadPool
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class StepFailed(RuntimeError):
+    """Raised when a step of the graph fails; carries the step label"""
+
+    def __init__(self, label, details):
+        RuntimeError.__init__(self, "Step '%s' failed\n%s" % (label, details))
+        self.label = label
+
+
+# Callable cabs that fork a multiprocessing.Pool, by the name of the argument
+# giving its number of processes
+FORKS = {}
+
+
+def forks(argument="workers"):
+    """Decorator marking a callable cab that forks `argument` processes"""
+    def mark(cab):
+        FORKS[cab] = argument
+        return cab
+    return mark
+
+
+def _call(execute, index):
+    try:
+        execute(index)
+        return index, None
+    except Exception:
+        return index, traceback.format_exc()
+
+
+def run_graph(labels, deps, execute, workers=1, exclusive=()):
+    """
+    Call execute(i) for every node once all nodes in deps[i] have finished.
+
+    Ready nodes are started lowest index first, so with workers=1 the original
+    step order is preserved exactly. Nodes in exclusive run with no other
+    node alongside: when one is next, no further nodes are started until
+    the running ones have finished. On the first failure no new nodes are
+    started, running ones are allowed to finish and StepFailed is raised.
+    """
+    if workers <= 1:
+        for index in range(len(labels)):
+            _, error = _call(execute, index)
+            if error:
+                raise StepFailed(labels[index], error)
+        return
+
+    waiting = dict((i, set(dep)) for i, dep in enumerate(deps))
+    dependents = [[] for _ in labels]
+    for i, dep in enumerate(deps):
+        for j in dep:
+            dependents[j].append(i)
+
+    ready = sorted(i for i, dep in waiting.items() if not dep)
+    finished = queue.Queue()
+    pool = ThreadPool(workers)
+    running = 0
+    alone = False
+    failure = None
+    try:
+        while ready or running:
+            while (ready and running < workers and failure is None and
+                   not alone):
+                if ready[0] in exclusive:
+                    if running:
+                        break
+                    alone = True
+                index = ready.pop(0)
+                del waiting[index]
+                pool.apply_async(_call, (execute, index),
+                                 callback=finished.put)
+                running += 1
+            if not running:
+                break
+            # A timeout keeps the main thread responsive to KeyboardInterrupt
+            while True:
+                try:
+                    index, error = finished.get(timeout=1)
+                    break
+                except queue.Empty:
+                    continue
+            running -= 1
+            alone = False
+            if error:
+                if failure is None:
+                    failure = StepFailed(labels[index], error)
+                continue
+            for child in dependents[index]:
+                if child in waiting:
+                    waiting[child].discard(index)
+                    if not waiting[child]:
+                        ready.append(child)
+            ready.sort()
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    if failure is not None:
+        raise failure
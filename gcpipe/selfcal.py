@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+"""
+Self-calibration loop for the 2gc script.
+
+Every round images the (residual) target field with a shallow clean, makes a
+clean mask from that image, cleans again within the mask, extracts a sky
+model from the masked image and calibrates against that model with MeqTrees,
+subtracting it. The models of all rounds are merged into a master LSM
+(gcpipe.merge_lsm), components found again in a later round within
+match_radius arcsec adding to the flux of the earlier one.
+
+The per-round parameters come from a schedule, a list with one dict per
+round:
+
+    {
+        "mask"               : {...},   # gcpipe.cleanmask parameters (sigma)
+        "extract"            : {...},   # cab/pybdsm parameters (thresh_*)
+        "calibrate"          : {...},   # cab/calibrator parameters
+        "before_calibration" : [...],   # labels of extra recipe steps
+    }
+
+With fuse_imaging, the masked clean continues the shallow one (wsclean
+-continue with the same prefix, reusing its PSF) instead of imaging from
+scratch: the PSF, the dirty image and the clean components of the shallow
+pass are kept, so only the residual has to be gridded again. The mask is
+made from the shallow image before it is overwritten.
+
+From the second round on, the masked image of the round is compared with
+that of the previous round before calibrating. If the metric did not improve
+by more than `tolerance` (a fraction) the loop stops, so a round that would
+add nothing costs one imaging pass instead of imaging plus calibration.
+Metrics are
+
+    rms            robust RMS of the residual image (lower is better)
+    dynamic_range  brightest source over that RMS (higher is better)
+    lsm_flux       flux of the round's sky model as a fraction of the master
+                   LSM of the earlier rounds (stops when it falls below
+                   tolerance)
+
+The calibrator subtracts each round's model (CORR_RES), so the images of
+later rounds show only what is left of the sky. The brightest source of
+dynamic_range is therefore taken from the master LSM with the round's model
+merged in, not from the restored image alone.
+
+Image statistics come from gcpipe.fitsio and are cached next to the images.
+With fixed_rms, the robust RMS of the masked clean's residual is also handed
+to pybdsm as rms_value, so the source finder thresholds against it instead
+of computing an rms map of its own.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from gcpipe.cleanmask import cleanmask
+from gcpipe.columns import copycol
+from gcpipe.fitsio import image_stats
+from gcpipe.skymodel import MATCH_RADIUS, SkyModel, lsm_flux, merge_lsm
+
+METRICS = ("rms", "dynamic_range", "lsm_flux")
+
+
+class SelfcalLoop(object):
+    """
+    Adds the steps of up to len(schedule) self-cal rounds to recipe and runs
+    them round by round. imaging, mask, extract and calibrate are the
+    parameters shared by all rounds; the schedule entries are merged on top.
+    workers is the number of processes of the column copies.
+    """
+
+    def __init__(self, recipe, ms, prefix, schedule, imaging, calibrate,
+                 mask=None, extract=None, metric="rms", tolerance=0.05,
+                 shallow_threshold=10, deep_threshold=1.5, fuse_imaging=False,
+                 fixed_rms=False, match_radius=MATCH_RADIUS, journal=None,
+                 snapshots=None, workers=1, input=None, output=None):
+        if metric not in METRICS:
+            raise ValueError("Unknown self-cal metric '%s'" % metric)
+        self.recipe = recipe
+        self.ms = ms
+        self.prefix = prefix
+        self.schedule = schedule
+        self.imaging = imaging
+        self.calibrate = calibrate
+        self.mask = mask or {}
+        self.extract = extract or {}
+        self.metric = metric
+        self.tolerance = tolerance
+        self.shallow_threshold = shallow_threshold
+        self.deep_threshold = deep_threshold
+        self.fuse_imaging = fuse_imaging
+        self.fixed_rms = fixed_rms
+        self.match_radius = match_radius
+        self.journal = journal
+        self.snapshots = snapshots
+        self.workers = workers
+        self.input = input
+        self.output = output
+        self.values = []
+        self.rounds = 0
+        self.master = None
+        self.image = None
+
+    def _add(self, cab, name, config, label):
+        return self.recipe.add(cab, name, config, input=self.input,
+                               output=self.output, label=label)
+
+    def add_round(self, index):
+        """
+        Add the steps of round `index`; returns the labels of the imaging,
+        source finding and calibration parts.
+        """
+        params = self.schedule[index]
+        shallow = "%s-image%d" % (self.prefix, 2 * index)
+        deep = "%s-image%d" % (self.prefix, 2 * index + 1)
+        if self.fuse_imaging:
+            deep = shallow
+        maskname = "%s-mask%d.fits" % (self.prefix, index)
+        lsm = "%s-LSM%d" % (self.prefix, index)
+        master = "%s-LSM-master%d" % (self.prefix, index)
+
+        config = dict(self.imaging, msname=self.ms,
+                      prefix="%s:output" % shallow)
+        config["auto-threshold"] = self.shallow_threshold
+        self._add("cab/wsclean", "image_target_field_r%d" % (2 * index),
+                  config, "image_target_field_r%d:: Shallow image, round %d"
+                  % (2 * index, index))
+
+        config = dict(self.mask, image="%s-image.fits:output" % shallow,
+                      output="%s:output" % maskname)
+        config.update(params.get("mask", {}))
+        self._add(cleanmask, "mask%d" % index, config,
+                  "mask%d:: Make mask, round %d" % (index, index))
+
+        config = dict(self.imaging, msname=self.ms,
+                      prefix="%s:output" % deep,
+                      fitsmask="%s:output" % maskname)
+        config["auto-threshold"] = self.deep_threshold
+        if self.fuse_imaging:
+            config["continue"] = True
+            config["reuse-psf"] = "%s:output" % shallow
+        step = self._add("cab/wsclean", "image_target_field_r%d" %
+                         (2 * index + 1), config,
+                         "image_target_field_r%d:: Masked image, round %d"
+                         % (2 * index + 1, index))
+
+        config = dict(self.extract, image="%s-image.fits:output" % deep,
+                      outfile="%s:output" % lsm, port2tigger=True,
+                      clobber=True)
+        config.update(params.get("extract", {}))
+        self.extract_step = self._add(
+            "cab/pybdsm", "extract_model_r%d" % index, config,
+            "extract_model_r%d:: Extract sky model, round %d" % (index, index))
+
+        imaging = ["image_target_field_r%d" % (2 * index), "mask%d" % index,
+                   "image_target_field_r%d" % (2 * index + 1)]
+        extraction = ["extract_model_r%d" % index]
+        calibration = list(params.get("before_calibration", []))
+
+        if self.master is not None:
+            self._add(merge_lsm, "stitch_lsm_r%d" % index, {
+                "skymodel" : "%s.lsm.html:output" % self.master,
+                "append"   : "%s.lsm.html:output" % lsm,
+                "output"   : "%s.lsm.html:output" % master,
+                "radius"   : self.match_radius,
+            }, "stitch_lsm_r%d:: Add round %d model to master LSM"
+                % (index, index))
+            calibration.append("stitch_lsm_r%d" % index)
+
+        # Copied, not renamed: the calibrator only rewrites CORRECTED_DATA
+        # of the target field, the calibrator fields keep theirs
+        self._add(copycol, "move_corrdata_to_data", {
+            "msname"  : self.ms,
+            "fromcol" : "CORRECTED_DATA",
+            "tocol"   : "DATA",
+            "workers" : self.workers,
+        }, "move_corrdata_to_data:: Copy CORRECTED_DATA to DATA")
+
+        config = dict(self.calibrate, msname=self.ms,
+                      skymodel="%s.lsm.html:output" % lsm)
+        config["label"] = config["prefix"] = "pcorr_r%d" % index
+        config["save-config"] = "selfcal_round%d" % index
+        config.update(params.get("calibrate", {}))
+        self._add("cab/calibrator", "calibrator_Gjones_subtract_r%d" % index,
+                  config, "calibrator_Gjones_subtract_r%d:: Calibrate and "
+                  "subtract round %d model" % (index, index))
+        calibration += ["move_corrdata_to_data",
+                        "calibrator_Gjones_subtract_r%d" % index]
+
+        self.paths = {
+            "image"    : step.path("%s-image.fits:output" % deep),
+            "residual" : step.path("%s-residual.fits:output" % deep),
+            "lsm"      : step.path("%s.lsm.html:output" % lsm),
+            "master"   : (step.path("%s.lsm.html:output" % self.master)
+                          if self.master else None),
+        }
+        self.names = {"image": deep, "lsm": lsm,
+                      "master": master if self.master else lsm}
+        return imaging, extraction, calibration
+
+    def measure(self):
+        """Metric of the current round's masked image"""
+        if self.metric == "lsm_flux":
+            # Relative to the master before this round's model is merged
+            if self.paths["master"] is None:
+                return 1.0
+            total = lsm_flux(self.paths["master"])
+            return lsm_flux(self.paths["lsm"]) / total if total else 1.0
+        rms = image_stats(self.paths["residual"]).get("robust_rms", 0.0)
+        if self.metric == "rms":
+            return rms
+        model = SkyModel.load(self.paths["lsm"])
+        if self.paths["master"] is not None:
+            master = SkyModel.load(self.paths["master"])
+            master.merge(model, radius=self.match_radius)
+            model = master
+        peak = max(model.sources["I"].max() if len(model) else 0.0,
+                   image_stats(self.paths["image"]).get("max", 0.0))
+        return peak / rms if rms else 0.0
+
+    def converged(self):
+        """True if the last round did not improve on the one before"""
+        if self.metric == "lsm_flux":
+            return len(self.values) > 1 and self.values[-1] < self.tolerance
+        if len(self.values) < 2:
+            return False
+        previous, current = self.values[-2:]
+        if self.metric == "rms":
+            return current > previous * (1 - self.tolerance)
+        return current < previous * (1 + self.tolerance)
+
+    def run(self):
+        """Run the rounds; returns the number of calibrated rounds"""
+        for index in range(len(self.schedule)):
+            imaging, extraction, calibration = self.add_round(index)
+            self.recipe.run(imaging)
+            if self.fixed_rms:
+                rms = image_stats(self.paths["residual"]).get("robust_rms")
+                if rms:
+                    self.extract_step.config.update(rms_map=False,
+                                                    rms_value=rms)
+            self.recipe.run(extraction)
+            self.image = self.names["image"]
+            self.values.append(self.measure())
+            print("Self-cal round %d: %s = %.4g" % (index, self.metric,
+                                                    self.values[-1]))
+            if self.converged():
+                print("Self-cal converged, stopping before calibrating "
+                      "round %d" % index)
+                break
+            self.recipe.run(calibration)
+            self.master = self.names["master"]
+            self.rounds = index + 1
+            if self.snapshots is None:
+                continue
+            name = "SELFCAL%d" % self.rounds
+            if self.journal is not None:
+                self.journal.checkpoint(self.snapshots, name)
+            else:
+                self.snapshots.take(name)
+            print(self.snapshots.summary(name))
+        return self.rounds
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+"""
+Array-backed sky models, replacing `cab/tigger_convert` for stitching LSMs.
+
+A SkyModel keeps its components in one NumPy structured array (see DTYPE):
+position in radians, Stokes fluxes, spectral index and Gaussian shape, plus a
+dict of any other Tigger tags per component. Positions are indexed with a
+KD-tree on unit vectors (scipy.spatial; without it, a brute-force search in
+declination bands, in blocks of bounded size) so that merging a model into another cross-matches every
+component within a radius instead of appending duplicates.
+
+Models are read from and written to Tigger's `.lsm.html` format (source list
+and reference frequency / field centre; plot styles are left to Tigger's
+defaults and the *_err attributes are not kept). A hidden `.<name>.npz` copy
+of the arrays is written next to every model saved, and used instead of
+parsing the HTML again as long as the HTML has not changed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import ast
+import os
+import re
+
+import numpy as np
+
+from gcpipe import graph
+from gcpipe.cache import stat_fingerprint
+
+# Default cross-match radius, arcsec
+MATCH_RADIUS = 5.0
+
+DTYPE = np.dtype([
+    ("name", "U64"),
+    ("ra", "f8"), ("dec", "f8"),
+    ("I", "f8"), ("Q", "f8"), ("U", "f8"), ("V", "f8"),
+    ("spi", "f8"), ("freq0", "f8"),
+    ("ex", "f8"), ("ey", "f8"), ("pa", "f8"),
+    ("tags", "O"),
+])
+
+# Distances computed at a time by the brute-force match (128 MB of float64)
+MATCH_CELLS = 2**24
+
+_TAG = re.compile(r"<(/?)(\w+)([^>]*)>")
+_ATTR = re.compile(r"""(mdl\w+)\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""", re.I)
+
+
+def _unit(ra, dec):
+    """Unit vectors (n, 3) for positions in radians"""
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra),
+                            np.sin(dec)])
+
+
+def _chord(radius):
+    """Unit-vector distance for an angle in arcsec"""
+    return 2 * np.sin(np.radians(radius / 3600.0) / 2)
+
+
+def _literal(text):
+    """Python value of an mdlval (numbers first, they are most of them)"""
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return ast.literal_eval(text)
+
+
+def _parse(text):
+    """
+    Objects of a Tigger lsm.html as nested (type, args, kws) tuples, or
+    plain values for mdlval items, following Tigger's ModelHTML reader.
+    """
+    tags, stack, top = [], [], []
+
+    def add(attr, obj):
+        if not stack:
+            if not attr:
+                top.append(obj)
+        elif attr:
+            stack[-1][3][attr] = obj
+        else:
+            stack[-1][2].append(obj)
+
+    def close():
+        attr, kind, args, kws = stack.pop()
+        add(attr, (kind, args, kws))
+
+    for match in _TAG.finditer(text):
+        closing, tag = match.group(1), match.group(2).upper()
+        if closing:
+            while tags:
+                name, opened = tags.pop()
+                if opened:
+                    close()
+                if name == tag:
+                    break
+            continue
+        tags.append([tag, False])
+        if "mdl" not in match.group(3):
+            continue
+        attrs = dict((key.lower(), value[1:-1].replace("&quot;", '"')
+                      if value[:1] in "\"'" else value)
+                     for key, value in _ATTR.findall(match.group(3)))
+        kind = attrs.get("mdltype")
+        if not kind:
+            continue
+        attr = attrs.get("mdlattr")
+        if attr and not stack:
+            continue
+        if "mdlval" in attrs:
+            try:
+                add(attr, _literal(attrs["mdlval"]))
+            except (ValueError, SyntaxError):
+                pass
+        else:
+            tags[-1][1] = True
+            stack.append([attr, kind, [], {}])
+    while stack:
+        close()
+    return top
+
+
+def _record(obj):
+    """One DTYPE row from a parsed Tigger Source"""
+    _, args, kws = obj
+    row = dict(name=args[0], Q=0.0, U=0.0, V=0.0, spi=0.0, freq0=0.0,
+               ex=0.0, ey=0.0, pa=0.0, tags={})
+    row["ra"], row["dec"] = args[1][1][:2]
+    flux = args[2][1]
+    row["I"] = flux[0]
+    if len(flux) >= 4:
+        row["Q"], row["U"], row["V"] = flux[1:4]
+    if len(flux) >= 6:
+        row["tags"]["rm"], row["tags"]["rm_freq0"] = flux[4:6]
+    for key, value in kws.items():
+        if key == "shape" and value[0] == "Gaussian":
+            row["ex"], row["ey"], row["pa"] = value[1][:3]
+        elif key == "spectrum" and value[0] == "SpectralIndex":
+            row["spi"], row["freq0"] = value[1][:2]
+        elif not isinstance(value, tuple):
+            row["tags"][key] = value
+    return tuple(row[name] for name in DTYPE.names)
+
+
+def _value(attr, value, mandatory=False, tag="A"):
+    """Tigger markup for a plain value"""
+    if isinstance(value, (str, type(u""))):
+        kind, text = "str", "'%s'" % value.replace("'", "\\'")
+    else:
+        kind = "bool" if isinstance(value, bool) else (
+            "int" if isinstance(value, (int, np.integer)) else "float")
+        text = repr(value.item() if hasattr(value, "item") else value)
+    return "<%s mdltype=%s %smdlval=\"%s\"><A>%s:%s</A> </%s> " % (
+        tag, kind, "" if mandatory else "mdlattr=\"%s\" " % attr,
+        text.replace("\"", "&quot;"), attr, value, tag)
+
+
+def _item(kind, names, values, attr=None):
+    markup = "<TD mdltype=%s %s>" % (kind, "mdlattr=\"%s\" " % attr
+                                     if attr else "")
+    if attr:
+        markup += "<A>%s:</A> " % attr
+    for name, value in zip(names, values):
+        markup += _value(name, float(value), mandatory=True)
+    return markup + "</TD> "
+
+
+class SkyModel(object):
+    """
+    Components in a DTYPE structured array; freq0 (Hz), ra0 and dec0
+    (radians) are the model's reference frequency and field centre.
+    """
+
+    def __init__(self, sources=None, freq0=None, ra0=None, dec0=None):
+        self.sources = np.zeros(0, DTYPE) if sources is None else sources
+        self.freq0 = freq0
+        self.ra0 = ra0
+        self.dec0 = dec0
+        self._tree = None
+
+    def __len__(self):
+        return len(self.sources)
+
+    @property
+    def flux(self):
+        """Total Stokes I flux"""
+        return float(self.sources["I"].sum())
+
+    @classmethod
+    def from_html(cls, path):
+        with open(path) as stdr:
+            top = _parse(stdr.read())
+        if not top or top[0][0] != "SkyModel":
+            raise ValueError("%s: not a Tigger sky model" % path)
+        _, args, kws = top[0]
+        rows = [_record(obj) for obj in args
+                if isinstance(obj, tuple) and obj[0] == "Source"]
+        return cls(np.array(rows, DTYPE), freq0=kws.get("freq0"),
+                   ra0=kws.get("ra0"), dec0=kws.get("dec0"))
+
+    @staticmethod
+    def _cache(path):
+        head, tail = os.path.split(path)
+        return os.path.join(head, ".%s.npz" % tail)
+
+    @classmethod
+    def load(cls, path):
+        """Read an lsm.html, from its array copy if that is up to date"""
+        cache = cls._cache(path)
+        if os.path.exists(cache):
+            stored = np.load(cache, allow_pickle=True)
+            if str(stored["fingerprint"]) == stat_fingerprint([path]):
+                header = stored["header"].tolist()
+                return cls(stored["sources"], **header)
+        return cls.from_html(path)
+
+    def save(self, path):
+        """Write as a Tigger lsm.html (plus the array copy)"""
+        lines = ["<HTML><BODY mdltype=SkyModel>",
+                 "<H1>Source list</H1>",
+                 "<TABLE BORDER=1 FRAME=box RULES=all CELLPADDING=5>"]
+        names = DTYPE.names
+        # Plain Python rows are much faster to format than record scalars
+        for values in self.sources.tolist():
+            src = dict(zip(names, values))
+            row = "<TR mdltype=Source >"
+            row += _value("name", src["name"], mandatory=True, tag="TD")
+            row += _item("Position", ("ra", "dec"), (src["ra"], src["dec"]))
+            tags = dict(src["tags"] or {})
+            if "rm" in tags:
+                row += _item("PolarizationWithRM",
+                             ("I", "Q", "U", "V", "rm", "freq0"),
+                             [src[k] for k in "IQUV"] +
+                             [tags.pop("rm"), tags.pop("rm_freq0")])
+            elif src["Q"] or src["U"] or src["V"]:
+                row += _item("Polarization", "IQUV",
+                             [src[k] for k in "IQUV"])
+            else:
+                row += _item("Flux", "I", [src["I"]])
+            if src["ex"] or src["ey"]:
+                row += _item("Gaussian", ("ex", "ey", "pa"),
+                             (src["ex"], src["ey"], src["pa"]), attr="shape")
+            if src["freq0"]:
+                row += _item("SpectralIndex", ("spi", "freq0"),
+                             (src["spi"], src["freq0"]), attr="spectrum")
+            for key, value in sorted(tags.items()):
+                row += _value(key, value, tag="TD")
+            lines.append(row + "</TR>")
+        lines += ["</TABLE>", "<H1>Other properties</H1>"]
+        for attr in ("freq0", "ra0", "dec0"):
+            if getattr(self, attr) is not None:
+                lines.append("<P>%s</P>" % _value(attr,
+                                                  float(getattr(self, attr))))
+        lines.append("</BODY></HTML>")
+        with open(path + ".tmp", "w") as stdw:
+            stdw.write("\n".join(lines) + "\n")
+        os.rename(path + ".tmp", path)
+
+        cache = self._cache(path)
+        with open(cache + ".tmp", "wb") as stdw:
+            np.savez(stdw, sources=self.sources,
+                     fingerprint=stat_fingerprint([path]),
+                     header=np.array(dict(freq0=self.freq0, ra0=self.ra0,
+                                          dec0=self.dec0), dtype=object))
+        os.rename(cache + ".tmp", cache)
+
+    def match(self, ra, dec, radius=MATCH_RADIUS):
+        """
+        Index of the nearest component within radius (arcsec) of every
+        position (radians), -1 where there is none.
+        """
+        points = _unit(np.atleast_1d(ra), np.atleast_1d(dec))
+        limit = _chord(radius)
+        found = np.full(len(points), -1, dtype=int)
+        if not len(self) or not len(points):
+            return found
+        units = _unit(self.sources["ra"], self.sources["dec"])
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            cKDTree = None
+        if cKDTree is not None:
+            if self._tree is None:
+                self._tree = cKDTree(units)
+            distance, index = self._tree.query(points,
+                                               distance_upper_bound=limit)
+            hit = np.isfinite(distance)
+            found[hit] = index[hit]
+            return found
+        # Without scipy: positions in order of declination, each block
+        # compared with the components in its declination band only (z
+        # differs by at most the chord), never more than MATCH_CELLS pairs
+        by_z = np.argsort(units[:, 2], kind="mergesort")
+        zs = units[by_z, 2]
+        order = np.argsort(points[:, 2], kind="mergesort")
+        rows = max(1, MATCH_CELLS // len(units))
+        for start in range(0, len(points), rows):
+            chosen = order[start:start + rows]
+            block = points[chosen]
+            first = np.searchsorted(zs, block[:, 2].min() - limit, "left")
+            last = np.searchsorted(zs, block[:, 2].max() + limit, "right")
+            if last <= first:
+                continue
+            candidates = by_z[first:last]
+            # |a - b|^2 = 2 - 2 a.b for unit vectors
+            distance = block.dot(units[candidates].T)
+            distance *= -2
+            distance += 2
+            index = distance.argmin(axis=1)
+            hit = distance[np.arange(len(block)), index] <= limit ** 2
+            found[chosen[hit]] = candidates[index[hit]]
+        return found
+
+    def merge(self, other, radius=MATCH_RADIUS, combine="sum"):
+        """
+        Add the components of SkyModel other. A component within radius
+        (arcsec) of one already present is not added again: with combine
+        "sum" its fluxes are added to that component, with "replace" it takes
+        that component's place and with "keep" it is dropped. Returns the
+        number of components matched.
+        """
+        if combine not in ("sum", "replace", "keep"):
+            raise ValueError("Unknown combine mode '%s'" % combine)
+        incoming = other.sources
+        index = self.match(incoming["ra"], incoming["dec"], radius)
+        hit = index >= 0
+        if combine == "sum":
+            # Several incoming components may match the same one
+            for name in ("I", "Q", "U", "V"):
+                np.add.at(self.sources[name], index[hit], incoming[name][hit])
+        elif combine == "replace":
+            self.sources[index[hit]] = incoming[hit]
+        self.sources = np.concatenate([self.sources, incoming[~hit]])
+        self._tree = None
+        for attr in ("freq0", "ra0", "dec0"):
+            if getattr(self, attr) is None:
+                setattr(self, attr, getattr(other, attr))
+        return int(hit.sum())
+
+
+def lsm_flux(path):
+    """Total Stokes I flux of a Tigger lsm.html sky model"""
+    return SkyModel.load(path).flux
+
+
+def merge_lsm(skymodel, append, output, radius=MATCH_RADIUS, combine="sum"):
+    """
+    Merge the lsm.html models in append (a path or list of paths) into
+    skymodel, cross-matching within radius arcsec, and write output.
+    """
+    model = SkyModel.load(skymodel)
+    for path in graph.as_list(append):
+        added = SkyModel.load(path)
+        matched = model.merge(added, radius=radius, combine=combine)
+        print("%s: %d of %d components matched within %.1f arcsec" % (
+            os.path.basename(path), matched, len(added), radius))
+    model.save(output)
+    print("%s: %d components, %.4g Jy" % (os.path.basename(output),
+                                          len(model), model.flux))
+    return output
+
+
+@graph.register_io(merge_lsm)
+def _merge_lsm_io(step):
+    return graph.files(step, "skymodel", "append"), graph.files(step, "output")
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copy-on-write snapshots of a measurement set.
+
+A casacore table keeps each storage manager in its own set of files (one per
+column for the tiled managers that hold DATA, CORRECTED_DATA, FLAG, BITFLAG,
+...), so the files of a table change only when the columns they hold change.
+A snapshot stores every file of the MS; files that are identical (same size
+and modification time) to a file already held by an earlier snapshot are hard
+linked to it, everything else is copied, as a reflink where the filesystem
+supports it. Snapshot files are never modified in place, so sharing them
+between snapshots is safe. The live MS never shares files with a snapshot.
+
+Restoring copies back only the files that differ from the snapshot and
+removes files (e.g. columns) added since.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import shutil
+import subprocess
+import time
+
+INDEX = "index.json"
+
+
+def _signature(info):
+    return [info.st_size, repr(info.st_mtime)]
+
+
+def _files(path):
+    """Relative paths of all files below path"""
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            yield os.path.relpath(os.path.join(root, name), path)
+
+
+def _copy(src, dst):
+    """Copy preserving timestamps, sharing blocks where the filesystem can"""
+    try:
+        subprocess.check_call(["cp", "--reflink=auto",
+                               "--preserve=mode,timestamps", src, dst])
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copy2(src, dst)
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+class MSSnapshots(object):
+    """
+    Snapshots of measurement set `ms`, kept in directory `root`
+    (<ms>.snapshots by default).
+    """
+
+    def __init__(self, ms, root=None):
+        self.ms = os.path.normpath(ms)
+        self.root = root or self.ms + ".snapshots"
+
+    def _load(self):
+        name = os.path.join(self.root, INDEX)
+        if not os.path.exists(name):
+            return {"snapshots": []}
+        with open(name) as stdr:
+            return json.load(stdr)
+
+    def _save(self, index):
+        name = os.path.join(self.root, INDEX)
+        with open(name + ".tmp", "w") as stdw:
+            json.dump(index, stdw, indent=1)
+        os.rename(name + ".tmp", name)
+
+    def names(self):
+        return [snap["name"] for snap in self._load()["snapshots"]]
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def _find(self, index, name):
+        for snap in index["snapshots"]:
+            if snap["name"] == name:
+                return snap
+        raise KeyError("No snapshot '%s' of %s" % (name, self.ms))
+
+    def take(self, name):
+        """Snapshot the current state of the MS; returns the snapshot path"""
+        _makedirs(self.root)
+        index = self._load()
+
+        # Every file already held by a snapshot, by content signature
+        held = {}
+        for snap in index["snapshots"]:
+            for rel, sig in snap["files"].items():
+                held[(rel, tuple(sig))] = os.path.join(self.path(snap["name"]),
+                                                      rel)
+
+        tmp = self.path(name + ".tmp")
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        files = {}
+        copied = linked = 0
+        for rel in _files(self.ms):
+            src = os.path.join(self.ms, rel)
+            dst = os.path.join(tmp, rel)
+            _makedirs(os.path.dirname(dst))
+            info = os.stat(src)
+            sig = _signature(info)
+            files[rel] = sig
+            if (rel, tuple(sig)) in held:
+                os.link(held[(rel, tuple(sig))], dst)
+                linked += info.st_size
+            else:
+                _copy(src, dst)
+                copied += info.st_size
+
+        if os.path.exists(self.path(name)):
+            shutil.rmtree(self.path(name))
+        os.rename(tmp, self.path(name))
+        index["snapshots"] = [snap for snap in index["snapshots"]
+                              if snap["name"] != name]
+        index["snapshots"].append({
+            "name"    : name,
+            "created" : time.time(),
+            "files"   : files,
+            "copied"  : copied,
+            "linked"  : linked,
+        })
+        self._save(index)
+        return self.path(name)
+
+    def restore(self, name):
+        """Bring the MS back to the state of snapshot `name`"""
+        snap = self._find(self._load(), name)
+        source = self.path(name)
+        files = snap["files"]
+
+        for rel in list(_files(self.ms)):
+            if rel not in files:
+                os.remove(os.path.join(self.ms, rel))
+        for root, dirs, _ in os.walk(self.ms, topdown=False):
+            for sub in dirs:
+                path = os.path.join(root, sub)
+                if not os.listdir(path):
+                    os.rmdir(path)
+
+        restored = 0
+        for rel, sig in files.items():
+            dst = os.path.join(self.ms, rel)
+            if os.path.exists(dst) and _signature(os.stat(dst)) == sig:
+                continue
+            _makedirs(os.path.dirname(dst))
+            _copy(os.path.join(source, rel), dst + ".tmp")
+            os.rename(dst + ".tmp", dst)
+            restored += os.path.getsize(dst)
+        return restored
+
+    def remove(self, name):
+        index = self._load()
+        self._find(index, name)
+        shutil.rmtree(self.path(name))
+        index["snapshots"] = [snap for snap in index["snapshots"]
+                              if snap["name"] != name]
+        self._save(index)
+
+    def summary(self, name):
+        """One line description of how much a snapshot cost"""
+        snap = self._find(self._load(), name)
+        return "%s: %.1f MB copied, %.1f MB shared with earlier snapshots" % (
+            name, snap["copied"] / 2.0**20, snap["linked"] / 2.0**20)
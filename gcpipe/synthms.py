@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic GMRT-like measurement sets of any size, for scaling benchmarks.
+
+make_gmrt_ms writes a valid MS of the 30 GMRT antennas (central square plus
+the three arms, at approximate positions), one spectral window of `nchan`
+channels, RR and LL correlations, and a schedule of scans on a bandpass
+calibrator, a phase calibrator and a target. Visibilities are the point
+sources of each field plus Gaussian noise, with optional narrowband and
+broadband RFI; UVW follow the hour angle of each field.
+
+The main table is written in blocks of whole time slots of about chunk_bytes
+of DATA, with one putcol per column per block. Generating stays cheap next to
+the writes: noise is drawn once for NOISE_ROWS rows and reused at random
+offsets, and the source fringes are products of a coarse and a fine channel
+phasor rather than an exponential per visibility.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+
+import numpy as np
+
+from gcpipe import columns
+
+C = 299792458.0
+SIDEREAL_DAY = 86164.0905
+
+# Array centre: latitude, longitude (degrees), height (m)
+GMRT_SITE = (19.0965, 74.0497, 650.0)
+
+CENTRAL = ("C00", "C01", "C02", "C03", "C04", "C05", "C06", "C08", "C09",
+           "C10", "C11", "C12", "C13", "C14")
+
+# Arm antennas: (name, distance from the centre in km), by arm azimuth (deg)
+ARMS = {
+    60.0  : (("E02", 2.4), ("E03", 4.6), ("E04", 7.2), ("E05", 10.1),
+             ("E06", 14.0)),
+    180.0 : (("S01", 1.6), ("S02", 3.8), ("S03", 6.3), ("S04", 9.3),
+             ("S06", 14.0)),
+    300.0 : (("W01", 1.5), ("W02", 3.4), ("W03", 5.6), ("W04", 8.4),
+             ("W05", 11.2), ("W06", 14.0)),
+}
+
+# name, RA and Dec (degrees), point sources (l, m in arcmin, flux in Jy)
+FIELDS = (
+    ("3C48",   24.4221, 33.1598, [(0.0, 0.0, 42.0)]),
+    ("3C091",  54.4300, 50.7633, [(0.0, 0.0, 9.0)]),
+    ("GALSYN", 45.0000, 45.0000, [(3.0, -2.0, 0.8), (-10.0, 6.0, 0.3),
+                                  (14.0, 9.0, 0.1)]),
+)
+
+# (field index, seconds): calibrators bracketing two target scans
+SCHEDULE = ((0, 600), (1, 300), (2, 1800), (1, 300), (2, 1800), (1, 300),
+            (0, 600))
+
+CORR_TYPES = (5, 8)   # RR, LL
+
+# Rows of noise drawn; blocks take theirs from it at random offsets
+NOISE_ROWS = 4096
+
+
+def gmrt_layout(seed=0):
+    """(names, east/north/up offsets (m) from the array centre)"""
+    rng = np.random.RandomState(seed)
+    names = list(CENTRAL)
+    # The central square is about a kilometre across
+    enu = [list(rng.uniform(-500, 500, 2)) + [0.0] for _ in CENTRAL]
+    for azimuth, antennas in sorted(ARMS.items()):
+        angle = np.radians(azimuth)
+        for name, distance in antennas:
+            names.append(name)
+            enu.append([1e3 * distance * np.sin(angle),
+                        1e3 * distance * np.cos(angle), 0.0])
+    return names, np.array(enu)
+
+
+def itrf(enu, site=GMRT_SITE):
+    """ITRF positions (m) of east/north/up offsets from site"""
+    lat, lon, height = np.radians(site[0]), np.radians(site[1]), site[2]
+    a, f = 6378137.0, 1 / 298.257223563
+    e2 = f * (2 - f)
+    n = a / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    centre = np.array([(n + height) * np.cos(lat) * np.cos(lon),
+                       (n + height) * np.cos(lat) * np.sin(lon),
+                       (n * (1 - e2) + height) * np.sin(lat)])
+    east = np.array([-np.sin(lon), np.cos(lon), 0])
+    north = np.array([-np.sin(lat) * np.cos(lon),
+                      -np.sin(lat) * np.sin(lon), np.cos(lat)])
+    up = np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                   np.sin(lat)])
+    return centre + np.outer(enu[:, 0], east) + np.outer(
+        enu[:, 1], north) + np.outer(enu[:, 2], up)
+
+
+def equatorial(enu, latitude=GMRT_SITE[0]):
+    """Local equatorial X, Y, Z (m) of east/north/up offsets"""
+    lat = np.radians(latitude)
+    east, north, up = enu[:, 0], enu[:, 1], enu[:, 2]
+    return np.stack([-np.sin(lat) * north + np.cos(lat) * up, east,
+                     np.cos(lat) * north + np.sin(lat) * up], axis=1)
+
+
+def uvw(xyz, hour_angle, dec):
+    """UVW (row, 3) of baseline vectors xyz (row, 3) at hour angles (row)"""
+    sh, ch = np.sin(hour_angle), np.cos(hour_angle)
+    sd, cd = np.sin(dec), np.cos(dec)
+    x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    return np.stack([sh * x + ch * y,
+                     -sd * ch * x + sd * sh * y + cd * z,
+                     cd * ch * x - cd * sh * y + sd * z], axis=1)
+
+
+def fringe(delay, freq0, width, nchan, tile=64):
+    """
+    exp(-2 pi i delay (freq0 + k width)) for channels k < nchan and delays
+    (row) in seconds, as products of coarse and fine channel phasors.
+    """
+    ncoarse = -(-nchan // tile)
+    coarse = np.exp(-2j * np.pi * np.outer(
+        delay, freq0 + np.arange(ncoarse) * tile * width)).astype(np.complex64)
+    fine = np.exp(-2j * np.pi * np.outer(
+        delay, np.arange(tile) * width)).astype(np.complex64)
+    return (coarse[:, :, None] * fine[:, None, :]).reshape(
+        len(delay), -1)[:, :nchan]
+
+
+def _data_desc(name, nchan, ncorr):
+    """Fixed shape, tiled column (single precision, as in real MSs)"""
+    import pyrap.tables as pt
+    value, valuetype = {
+        "FLAG"            : (False, "boolean"),
+        "WEIGHT_SPECTRUM" : (1.0, "float"),
+    }.get(name, (0j, "complex"))
+    return pt.makearrcoldesc(name, value, shape=[nchan, ncorr],
+                             valuetype=valuetype,
+                             datamanagertype="TiledColumnStMan",
+                             datamanagergroup=name)
+
+
+def _subtables(path, names, enu, fields, freqs, width, times):
+    import pyrap.tables as pt
+
+    def open_sub(name, nrow):
+        sub = pt.table(os.path.join(path, name), readonly=False, ack=False)
+        sub.addrows(nrow)
+        return sub
+
+    nant = len(names)
+    sub = open_sub("ANTENNA", nant)
+    sub.putcol("NAME", names)
+    sub.putcol("STATION", names)
+    sub.putcol("POSITION", itrf(enu))
+    sub.putcol("DISH_DIAMETER", np.full(nant, 45.0))
+    sub.putcol("MOUNT", ["alt-az"] * nant)
+    sub.putcol("TYPE", ["GROUND-BASED"] * nant)
+    sub.close()
+
+    sub = open_sub("FEED", nant)
+    sub.putcol("ANTENNA_ID", np.arange(nant))
+    sub.putcol("FEED_ID", np.zeros(nant, int))
+    sub.putcol("SPECTRAL_WINDOW_ID", np.full(nant, -1))
+    sub.putcol("NUM_RECEPTORS", np.full(nant, 2))
+    sub.putcol("POLARIZATION_TYPE", np.array([["R", "L"]] * nant))
+    sub.putcol("POL_RESPONSE", np.tile(np.eye(2, dtype=np.complex64),
+                                       (nant, 1, 1)))
+    sub.putcol("BEAM_OFFSET", np.zeros((nant, 2, 2)))
+    sub.putcol("RECEPTOR_ANGLE", np.zeros((nant, 2)))
+    sub.putcol("TIME", np.full(nant, times[0]))
+    sub.putcol("INTERVAL", np.full(nant, 1e30))
+    sub.close()
+
+    nchan = len(freqs)
+    sub = open_sub("SPECTRAL_WINDOW", 1)
+    sub.putcell("CHAN_FREQ", 0, freqs)
+    for column in ("CHAN_WIDTH", "EFFECTIVE_BW", "RESOLUTION"):
+        sub.putcell(column, 0, np.full(nchan, width))
+    sub.putcell("NUM_CHAN", 0, nchan)
+    sub.putcell("REF_FREQUENCY", 0, freqs[0])
+    sub.putcell("TOTAL_BANDWIDTH", 0, nchan * width)
+    sub.putcell("NAME", 0, "SPW0")
+    sub.close()
+
+    sub = open_sub("POLARIZATION", 1)
+    sub.putcell("NUM_CORR", 0, len(CORR_TYPES))
+    sub.putcell("CORR_TYPE", 0, np.array(CORR_TYPES))
+    sub.putcell("CORR_PRODUCT", 0, np.array([[0, 1], [0, 1]]))
+    sub.close()
+
+    sub = open_sub("DATA_DESCRIPTION", 1)
+    sub.putcell("SPECTRAL_WINDOW_ID", 0, 0)
+    sub.putcell("POLARIZATION_ID", 0, 0)
+    sub.close()
+
+    sub = open_sub("FIELD", len(fields))
+    dirs = np.radians([[[ra, dec]] for _, ra, dec, _ in fields])
+    sub.putcol("NAME", [field[0] for field in fields])
+    sub.putcol("CODE", [""] * len(fields))
+    for column in ("PHASE_DIR", "DELAY_DIR", "REFERENCE_DIR"):
+        sub.putcol(column, dirs)
+    sub.putcol("TIME", np.full(len(fields), times[0]))
+    sub.close()
+
+    sub = open_sub("OBSERVATION", 1)
+    sub.putcell("TELESCOPE_NAME", 0, "GMRT")
+    sub.putcell("TIME_RANGE", 0, np.array([times[0], times[-1]]))
+    sub.putcell("OBSERVER", 0, "gcpipe.synthms")
+    sub.close()
+
+
+def make_gmrt_ms(path, nchan=512, freq0=306e6, bandwidth=33.3e6,
+                 integration=16.0, fields=FIELDS, schedule=SCHEDULE,
+                 noise=0.5, rfi_channels=0.02, rfi_bursts=0.01,
+                 rfi_level=50.0, autocorr=True,
+                 datacolumns=("DATA",), weight_spectrum=False, seed=0,
+                 chunk_bytes=columns.CHUNK_BYTES):
+    """
+    Write a synthetic GMRT MS to path (replacing it); see the module
+    description. fields are (name, RA, Dec (degrees), [(l, m (arcmin),
+    flux (Jy))]), schedule (field index, seconds) scans. rfi_channels is
+    the fraction of channels with persistent RFI, rfi_bursts the fraction
+    of time slots with broadband RFI, both at rfi_level times the noise.
+    Every column in datacolumns gets the same visibilities. Returns the
+    number of rows.
+    """
+    import pyrap.tables as pt
+
+    rng = np.random.RandomState(seed)
+    names, enu = gmrt_layout(seed)
+    xyz = equatorial(enu)
+    nant, ncorr = len(names), len(CORR_TYPES)
+    ant1, ant2 = np.triu_indices(nant, 0 if autocorr else 1)
+    nbl = len(ant1)
+    width = bandwidth / nchan
+    freqs = freq0 + width * np.arange(nchan)
+
+    # One time slot per integration, scans back to back
+    slots = []
+    start = 4.97e9
+    for scan, (field, seconds) in enumerate(schedule):
+        for step in range(max(1, int(seconds // integration))):
+            slots.append((start + (step + 0.5) * integration, field,
+                          scan + 1))
+        start += seconds
+    times = np.array([slot[0] for slot in slots])
+    # Local sidereal time: the middle of the run transits the last field
+    lst = (np.radians(fields[-1][1]) + 2 * np.pi *
+           (times - times.mean()) / SIDEREAL_DAY)
+
+    rfi_chans = rng.rand(nchan) < rfi_channels
+    burst = rng.rand(len(slots)) < rfi_bursts
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    stored = list(datacolumns) + ["FLAG"]
+    if weight_spectrum:
+        stored.append("WEIGHT_SPECTRUM")
+    descs = [_data_desc(name, nchan, ncorr) for name in stored]
+    tab = pt.default_ms(path, pt.maketabdesc(descs))
+    nrows = len(slots) * nbl
+    try:
+        tab.addrows(nrows)
+        cell_bytes = nchan * ncorr * 8
+        slots_per_block = max(1, chunk_bytes // (cell_bytes * nbl))
+        noise_rows = min(nrows, NOISE_ROWS)
+        tile = (noise / np.sqrt(2) * (
+            rng.standard_normal((noise_rows, nchan, ncorr)) +
+            1j * rng.standard_normal((noise_rows, nchan, ncorr)))).astype(
+                np.complex64)
+        for first in range(0, len(slots), slots_per_block):
+            block = slots[first:first + slots_per_block]
+            nslot = len(block)
+            nrow = nslot * nbl
+            row0 = first * nbl
+            field = np.repeat([slot[1] for slot in block], nbl)
+            slot_times = np.repeat([slot[0] for slot in block], nbl)
+            a1, a2 = np.tile(ant1, nslot), np.tile(ant2, nslot)
+            ra = np.radians([fields[fid][1] for fid in field])
+            dec = np.radians([fields[fid][2] for fid in field])
+            hour_angle = np.repeat(lst[first:first + nslot], nbl) - ra
+            coords = uvw(xyz[a2] - xyz[a1], hour_angle, dec)
+
+            vis = np.zeros((nrow, nchan), np.complex64)
+            for fid in np.unique(field):
+                rows = field == fid
+                for l, m, flux in fields[fid][3]:
+                    l, m = np.radians(l / 60.0), np.radians(m / 60.0)
+                    n = np.sqrt(1 - l * l - m * m)
+                    delay = (coords[rows, 0] * l + coords[rows, 1] * m +
+                             coords[rows, 2] * (n - 1)) / C
+                    vis[rows] += flux * fringe(delay, freq0, width, nchan)
+            offset = rng.randint(noise_rows)
+            data = vis[:, :, None] + np.take(
+                tile, np.arange(offset, offset + nrow) % noise_rows, axis=0)
+            # RFI on the cross-correlations only
+            cross = a1 != a2
+            level = rfi_level * noise
+            if rfi_chans.any():
+                data[np.ix_(cross, rfi_chans)] += level * rng.rand(
+                    int(cross.sum()), int(rfi_chans.sum()), 1)
+            bursting = cross & np.repeat(burst[first:first + nslot], nbl)
+            data[bursting] += level
+
+            put = lambda name, values: tab.putcol(name, values, row0, nrow)
+            put("TIME", slot_times)
+            put("TIME_CENTROID", slot_times)
+            put("INTERVAL", np.full(nrow, integration))
+            put("EXPOSURE", np.full(nrow, integration))
+            put("ANTENNA1", a1)
+            put("ANTENNA2", a2)
+            put("FIELD_ID", field)
+            put("SCAN_NUMBER", np.repeat([slot[2] for slot in block], nbl))
+            put("DATA_DESC_ID", np.zeros(nrow, np.int32))
+            put("UVW", coords)
+            put("WEIGHT", np.full((nrow, ncorr), noise ** -2, np.float32))
+            put("SIGMA", np.full((nrow, ncorr), noise, np.float32))
+            put("FLAG_ROW", np.zeros(nrow, bool))
+            put("FLAG", np.zeros((nrow, nchan, ncorr), bool))
+            if weight_spectrum:
+                put("WEIGHT_SPECTRUM", np.full((nrow, nchan, ncorr),
+                                               noise ** -2, np.float32))
+            for name in datacolumns:
+                put(name, data)
+    finally:
+        tab.close()
+    _subtables(path, names, enu, fields, freqs, width, times)
+    print("%s: %d rows, %d channels, %.1f GB per data column" % (
+        os.path.basename(path), nrows, nchan, nrows * nchan * ncorr * 8 /
+        1e9))
+    return nrows
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-pass visibility diagnostics, replacing a series of `cab/casa_plotms`
+steps that each scan the whole data column for one plot.
+
+Every entry of `plots` describes one figure with plotms style parameters
+(field, spw, correlation, xaxis, avgtime, avgchannel, plotfile); yaxis is
+always amplitude. The MS is read once in row chunks and each chunk is added to
+a 2-D histogram of amplitude against the x axis for every plot that selects
+it, so memory use does not depend on the size of the MS. The histograms are
+rendered as density plots at the end.
+
+Supported x axes are phase, freq, time and uvwave (or uvdist, in metres).
+avgtime averages each baseline and channel over intervals of that many
+seconds within a scan; avgchannel averages groups of that many channels.
+Averaging assumes the MS is sorted by time, as written by the correlator.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from gcpipe import columns, graph
+from gcpipe.scheduler import forks
+
+C = 299792458.0
+
+AMP_BINS = 256
+X_BINS = 512
+
+# CASA Stokes codes of the correlations we plot
+CORR_TYPES = {
+    "RR" : 5,
+    "RL" : 6,
+    "LR" : 7,
+    "LL" : 8,
+    "XX" : 9,
+    "XY" : 10,
+    "YX" : 11,
+    "YY" : 12,
+}
+
+XLABELS = {
+    "phase"  : "Phase (deg)",
+    "freq"   : "Frequency (GHz)",
+    "time"   : "Time (hours from start)",
+    "uvwave" : "UV distance (kilo-lambda)",
+    "uvdist" : "UV distance (m)",
+}
+
+
+class AmpHistogram(object):
+    """
+    Counts of amplitude against x on a fixed x grid. The amplitude range
+    starts at [0, top) and is doubled, by merging pairs of bins, whenever a
+    larger amplitude turns up, so no first pass is needed to find it.
+    """
+
+    def __init__(self, xmin, xmax, nx, top=1.0, nbins=AMP_BINS):
+        self.xmin = xmin
+        self.xmax = xmax
+        self.top = top
+        self.counts = np.zeros((nx, nbins), np.int64)
+
+    def _grow(self):
+        nbins = self.counts.shape[1]
+        merged = self.counts[:, 0::2] + self.counts[:, 1::2]
+        self.counts = np.zeros_like(self.counts)
+        self.counts[:, :nbins // 2] = merged
+        self.top *= 2
+
+    def add(self, x, amp):
+        good = np.isfinite(amp) & np.isfinite(x)
+        x, amp = x[good], amp[good]
+        if not amp.size:
+            return
+        while amp.max() >= self.top:
+            self._grow()
+        nx, nbins = self.counts.shape
+        span = (self.xmax - self.xmin) or 1.0
+        xi = np.floor((x - self.xmin) * (nx / span)).astype(np.int64)
+        xi = np.clip(xi, 0, nx - 1)
+        yi = (amp * (nbins / self.top)).astype(np.int64)
+        self.counts += np.bincount(xi * nbins + yi,
+                                   minlength=nx * nbins).reshape(nx, nbins)
+
+    def populated(self):
+        """Counts and (xmin, xmax, 0, amplitude) limits of the used bins"""
+        used = np.nonzero(self.counts.any(axis=0))[0]
+        nbins = self.counts.shape[1]
+        top = used[-1] + 1 if used.size else nbins
+        return (self.counts[:, :top],
+                (self.xmin, self.xmax, 0, top * self.top / nbins))
+
+
+def parse_spw(spw):
+    """plotms spw selection ('0:50~435,1') to {spw: (first, last) or None}"""
+    selection = {}
+    for item in (spw or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        window, _, chans = item.partition(":")
+        chans = chans.split(";")[0]
+        if chans:
+            first, _, last = chans.partition("~")
+            selection[int(window)] = (int(first), int(last or first))
+        else:
+            selection[int(window)] = None
+    return selection
+
+
+def parse_fields(field, names):
+    """plotms field selection (ids or names) to a set of field ids"""
+    selected = set()
+    for item in str(field).split(","):
+        item = item.strip()
+        if item.isdigit():
+            selected.add(int(item))
+        elif item:
+            selected.add(names.index(item))
+    return selected
+
+
+class MSInfo(object):
+    """Subtable metadata needed to set up the plots"""
+
+    def __init__(self, ms):
+        import pyrap.tables as pt
+
+        def sub(name, column):
+            tab = pt.table(os.path.join(ms, name), ack=False)
+            try:
+                return [tab.getcell(column, i) for i in range(tab.nrows())]
+            finally:
+                tab.close()
+
+        self.fields = list(sub("FIELD", "NAME"))
+        self.freqs = sub("SPECTRAL_WINDOW", "CHAN_FREQ")
+        self.ddid_spw = sub("DATA_DESCRIPTION", "SPECTRAL_WINDOW_ID")
+        ddid_pol = sub("DATA_DESCRIPTION", "POLARIZATION_ID")
+        corr_types = sub("POLARIZATION", "CORR_TYPE")
+        self.corr_types = [list(corr_types[pol]) for pol in ddid_pol]
+        positions = np.array(sub("ANTENNA", "POSITION"))
+        self.max_baseline = max(np.linalg.norm(a - b)
+                                for a in positions for b in positions)
+
+
+class VisPlot(object):
+    """Selection, averaging and histogram of one requested figure"""
+
+    def __init__(self, spec, info, timerange):
+        self.spec = spec
+        self.xaxis = spec.get("xaxis", "time")
+        if self.xaxis not in XLABELS:
+            raise ValueError("Unsupported plotms xaxis '%s'" % self.xaxis)
+        self.plotfile = spec["plotfile"]
+        self.fields = (parse_fields(spec.get("field", ""), info.fields) or
+                       set(range(len(info.fields))))
+        self.spws = parse_spw(spec.get("spw", ""))
+        self.corrs = [name.strip() for name in
+                      spec.get("correlation", "RR,LL").split(",")]
+        self.avgtime = float(spec.get("avgtime") or 0)
+        self.avgchannel = int(spec.get("avgchannel") or 1)
+        self.info = info
+        self.t0 = timerange[0]
+        self.pending = {}
+
+        windows = self.spws or dict((spw, None)
+                                    for spw in range(len(info.freqs)))
+        freqs = np.concatenate([info.freqs[spw][self.channels(spw)]
+                                for spw in windows])
+        if self.xaxis == "phase":
+            xmin, xmax, nx = -180.0, 180.0, 360
+        elif self.xaxis == "freq":
+            nx = max(len(info.freqs[spw][self.channels(spw)])
+                     for spw in windows)
+            step = (freqs.max() - freqs.min()) / max(nx - 1, 1) or 1.0
+            xmin = (freqs.min() - step / 2) / 1e9
+            xmax = (freqs.max() + step / 2) / 1e9
+        elif self.xaxis == "time":
+            xmin, nx = 0.0, X_BINS
+            xmax = (timerange[1] - timerange[0]) / 3600.
+        else:
+            xmax = info.max_baseline
+            if self.xaxis == "uvwave":
+                xmax *= freqs.max() / C / 1e3
+            xmin, nx = 0.0, X_BINS
+        self.hist = AmpHistogram(xmin, xmax, nx)
+
+    def channels(self, spw):
+        chans = self.spws.get(spw)
+        if chans is None:
+            return slice(None)
+        return slice(chans[0], chans[1] + 1)
+
+    def add(self, chunk):
+        for ddid in np.unique(chunk["DATA_DESC_ID"]):
+            spw = self.info.ddid_spw[ddid]
+            if self.spws and spw not in self.spws:
+                continue
+            rows = (chunk["DATA_DESC_ID"] == ddid) & \
+                np.isin(chunk["FIELD_ID"], list(self.fields))
+            rows &= ~chunk["FLAG_ROW"]
+            if not rows.any():
+                continue
+            types = self.info.corr_types[ddid]
+            corrs = [types.index(CORR_TYPES[name]) for name in self.corrs
+                     if CORR_TYPES[name] in types]
+            chans = self.channels(spw)
+            data = chunk["DATA"][rows][:, chans][:, :, corrs]
+            flag = chunk["FLAG"][rows][:, chans][:, :, corrs]
+            freqs = self.info.freqs[spw][chans]
+            select = dict((key, value[rows]) for key, value in chunk.items()
+                          if key not in ("DATA", "FLAG"))
+            self._add(select, data, flag, freqs)
+        if self.avgtime:
+            self._flush(chunk["TIME"].min())
+
+    def _add(self, rows, data, flag, freqs):
+        weight = (~flag).astype(np.float32)
+        data = np.where(flag, 0, data)
+        if self.avgchannel > 1:
+            starts = np.arange(0, data.shape[1], self.avgchannel)
+            data = np.add.reduceat(data, starts, axis=1)
+            weight = np.add.reduceat(weight, starts, axis=1)
+            freqs = np.add.reduceat(freqs, starts) / \
+                np.diff(np.append(starts, len(freqs)))
+        if self.avgtime:
+            self._accumulate(rows, data, weight, freqs)
+            return
+        self._histogram(rows, data, weight, freqs)
+
+    def _histogram(self, rows, data, weight, freqs):
+        good = weight > 0
+        vis = data[good] / weight[good]
+        shape = data.shape
+        if self.xaxis == "phase":
+            x = np.degrees(np.angle(vis))
+        elif self.xaxis == "freq":
+            x = np.broadcast_to(freqs[None, :, None] / 1e9, shape)[good]
+        elif self.xaxis == "time":
+            hours = (rows["TIME"] - self.t0) / 3600.
+            x = np.broadcast_to(hours[:, None, None], shape)[good]
+        else:
+            uvdist = np.hypot(rows["UVW"][:, 0], rows["UVW"][:, 1])
+            if self.xaxis == "uvwave":
+                x = uvdist[:, None, None] * freqs[None, :, None] / C / 1e3
+            else:
+                x = uvdist[:, None, None]
+            x = np.broadcast_to(x, shape)[good]
+        self.hist.add(x, np.abs(vis))
+
+    def _accumulate(self, rows, data, weight, freqs):
+        """Sum data per (scan, time interval, baseline) into self.pending"""
+        interval = np.floor(rows["TIME"] / self.avgtime).astype(np.int64)
+        keys = np.stack([rows["SCAN_NUMBER"], interval,
+                         rows["ANTENNA1"], rows["ANTENNA2"]], axis=1)
+        keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="mergesort")
+        starts = np.searchsorted(inverse[order], np.arange(len(keys)))
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        weights = np.add.reduceat(weight[order], starts, axis=0)
+        nrows = np.diff(np.append(starts, len(order)))
+        times = np.add.reduceat(rows["TIME"][order], starts)
+        uvws = np.add.reduceat(rows["UVW"][order], starts, axis=0)
+        for i, key in enumerate(map(tuple, keys)):
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [sums[i], weights[i], times[i], uvws[i],
+                                     nrows[i], freqs]
+            else:
+                entry[0] = entry[0] + sums[i]
+                entry[1] = entry[1] + weights[i]
+                entry[2] += times[i]
+                entry[3] = entry[3] + uvws[i]
+                entry[4] += nrows[i]
+
+    def _flush(self, before=None):
+        """Histogram the averaged intervals that no later row can add to"""
+        done = [key for key in self.pending if before is None or
+                (key[1] + 1) * self.avgtime <= before]
+        for key in done:
+            data, weight, time, uvw, nrows, freqs = self.pending.pop(key)
+            rows = {"TIME" : np.array([time / nrows]),
+                    "UVW"  : uvw[None] / nrows}
+            self._histogram(rows, data[None], weight[None], freqs)
+
+    def finish(self):
+        if self.avgtime:
+            self._flush()
+        counts, extent = self.hist.populated()
+        return (self.plotfile, self.title(), XLABELS[self.xaxis],
+                counts, extent)
+
+    def title(self):
+        names = ", ".join(self.info.fields[field]
+                          for field in sorted(self.fields))
+        return "%s %s" % (names, ",".join(self.corrs))
+
+
+def _render(job):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plotfile, title, xlabel, counts, extent = job
+    image = np.ma.masked_equal(counts.T, 0)
+    fig, ax = plt.subplots(figsize=(8, 6))
+    mesh = ax.imshow(np.ma.log10(image), origin="lower", aspect="auto",
+                     extent=extent,
+                     interpolation="nearest", cmap="viridis")
+    fig.colorbar(mesh, ax=ax, label="log10(count)")
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Amplitude")
+    ax.set_title(title)
+    fig.savefig(plotfile, dpi=100)
+    plt.close(fig)
+    return plotfile
+
+
+@forks()
+def visplots(msname, plots, datacolumn="corrected", workers=1,
+             chunk_bytes=columns.CHUNK_BYTES):
+    """
+    Accumulate every figure in plots from one read of msname and render them.
+    The "residual" datacolumn is CORRECTED_DATA - MODEL_DATA.
+    """
+    import pyrap.tables as pt
+
+    names = graph.DATACOLUMNS[datacolumn]
+    info = MSInfo(msname)
+    parent = tab = pt.table(msname, ack=False)
+    try:
+        fields = set()
+        for spec in plots:
+            fields |= parse_fields(spec.get("field", ""), info.fields)
+        if fields and fields != set(range(len(info.fields))):
+            tab = parent.query("FIELD_ID IN [%s]" %
+                               ",".join(str(f) for f in sorted(fields)))
+        times = tab.getcol("TIME")
+        timerange = (times.min(), times.max()) if times.size else (0, 0)
+        todo = [VisPlot(spec, info, timerange) for spec in plots]
+        nrows = columns.rows_per_chunk(tab, names[0],
+                                       chunk_bytes // len(names))
+        for start, nrow in columns.row_blocks(tab.nrows(), nrows):
+            chunk = dict((name, tab.getcol(name, start, nrow)) for name in
+                         ("TIME", "FIELD_ID", "DATA_DESC_ID", "SCAN_NUMBER",
+                          "ANTENNA1", "ANTENNA2", "UVW", "FLAG_ROW", "FLAG"))
+            chunk["DATA"] = tab.getcol(names[0], start, nrow)
+            for name in names[1:]:
+                chunk["DATA"] -= tab.getcol(name, start, nrow)
+            for plot in todo:
+                plot.add(chunk)
+    finally:
+        if tab is not parent:
+            tab.close()
+        parent.close()
+
+    jobs = [plot.finish() for plot in todo]
+    if workers <= 1 or len(jobs) <= 1:
+        return [_render(job) for job in jobs]
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(_render, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@graph.register_io(visplots)
+def _visplots_io(step):
+    names = ["FLAG"] + graph.DATACOLUMNS[step.config.get("datacolumn",
+                                                        "corrected")]
+    plotfiles = set(("file", step.path(plot["plotfile"]))
+                    for plot in step.config["plots"])
+    return graph.columns(step, *names), plotfiles
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+import pytest
+
+from gcpipe.applycal import _gains, interpolate_times
+
+
+def test_interpolate_times_amplitude_and_phase():
+    times = np.array([0.0, 10.0])
+    values = np.array([[1.0 + 0j], [2j]])
+    flags = np.zeros(values.shape, bool)
+    targets = np.array([-5.0, 5.0, 10.0, 20.0])
+    got, bad = interpolate_times(times, values, flags, targets)
+    # Halfway: amplitude 1.5, phase 45 deg; clamped outside the solutions
+    assert np.allclose(got[:, 0], [1, 1.5 * np.exp(0.25j * np.pi), 2j, 2j])
+    assert not bad.any()
+    got, _ = interpolate_times(times, values, flags, np.array([4.0, 6.0]),
+                               mode="nearest")
+    assert np.allclose(got[:, 0], [1, 2j])
+
+
+def test_interpolate_times_skips_flagged_solutions():
+    times = np.array([0.0, 10.0, 20.0])
+    values = np.array([[1.0, 0.0, 5.0], [100.0, 1.0, 5.0], [3.0, 2.0, 5.0]])
+    flags = np.array([[False, False, True], [True, False, True],
+                      [False, False, True]])
+    got, bad = interpolate_times(times, values, flags, np.array([10.0]),
+                                 delay=True)
+    # Column 0 between its unflagged samples, column 2 all flagged
+    assert np.allclose(got[0, :2], [2.0, 1.0])
+    assert bad[0].tolist() == [False, False, True]
+
+
+def test_delay_gains_by_hand():
+    # 2 ns at 125 MHz above the reference frequency is a quarter turn
+    values = np.array([[[[2.0, -2.0]], [[0.0, 0.0]]]])
+    flags = np.zeros(values.shape, bool)
+    freqs = np.array([1.0e9, 1.125e9, 1.25e9])
+    gains, bad = _gains(("K", values, flags), np.array([0, 0]),
+                        np.array([0, 1]), freqs, 1.0e9)
+    assert gains.shape == (2, 3, 2)
+    assert np.allclose(gains[0, :, 0], [1, 1j, -1])
+    assert np.allclose(gains[0, :, 1], [1, -1j, -1])
+    assert np.allclose(gains[1], 1)
+    assert bad.shape == gains.shape and not bad.any()
+
+
+def test_applycal_delay_and_bandpass(tmpdir):
+    pt = pytest.importorskip("pyrap.tables")
+    from gcpipe.applycal import applycal
+    from gcpipe.mock import write_caltable
+    from gcpipe.synthms import make_gmrt_ms
+
+    msname = str(tmpdir.join("cal.MS"))
+    make_gmrt_ms(msname, nchan=8, schedule=((0, 32),), autocorr=False)
+    tab = pt.table(msname, readonly=False, ack=False)
+    ant1, ant2 = tab.getcol("ANTENNA1"), tab.getcol("ANTENNA2")
+    shape = tab.getcol("DATA").shape
+    tab.putcol("DATA", np.ones(shape, np.complex64))
+    tab.putcol("FLAG", np.zeros(shape, bool))
+    tab.close()
+    spw = pt.table(os.path.join(msname, "SPECTRAL_WINDOW"), ack=False)
+    freqs = spw.getcell("CHAN_FREQ", 0)
+    ref_freq = spw.getcell("REF_FREQUENCY", 0)
+    spw.close()
+    nant = max(ant1.max(), ant2.max()) + 1
+
+    rng = np.random.RandomState(3)
+    delays = rng.uniform(-5, 5, (nant, 2))
+    bandpass = (rng.uniform(0.5, 2, (nant, 8, 2)) *
+                np.exp(1j * rng.uniform(-1, 1, (nant, 8, 2))))
+    ktable, btable = str(tmpdir.join("K.cal")), str(tmpdir.join("B.cal"))
+    write_caltable(ktable, msname, "K")
+    write_caltable(btable, msname, "B")
+    for path, column, values in ((ktable, "FPARAM", delays[:, None, :]),
+                                 (btable, "CPARAM", bandpass)):
+        cal = pt.table(path, readonly=False, ack=False)
+        cal.putcol(column, values[cal.getcol("ANTENNA1")])
+        cal.close()
+
+    applycal(msname, [ktable, btable], [{"field": ""}], workers=1)
+
+    # g = exp(2 pi i tau (f - f_ref)) B per antenna and receptor (RR, LL);
+    # the corrected unit visibilities are 1 / (g1 conj(g2))
+    gain = (np.exp(2j * np.pi * 1e-9 * delays[:, None, :] *
+                   (freqs - ref_freq)[None, :, None]) * bandpass)
+    expected = 1 / (gain[ant1] * np.conj(gain[ant2]))
+    tab = pt.table(msname, ack=False)
+    try:
+        assert np.allclose(tab.getcol("CORRECTED_DATA"), expected,
+                           rtol=1e-5, atol=1e-6)
+        assert not tab.getcol("FLAG").any()
+    finally:
+        tab.close()
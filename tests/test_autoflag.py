@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+from gcpipe.autoflag import _box, sir_operator, sum_threshold
+
+
+def _sir_reference(flags, eta):
+    """Every window tried: flagged if one holding it is <= eta unflagged"""
+    out = flags.copy()
+    for first in range(len(flags)):
+        for last in range(first + 1, len(flags) + 1):
+            unflagged = (~flags[first:last]).sum()
+            if unflagged <= eta * (last - first) + 1e-9:
+                out[first:last] = True
+    return out
+
+
+def test_box_sums_clipped_windows():
+    values = np.random.RandomState(1).normal(size=(3, 17, 11))
+    for axis in (1, 2):
+        for half in (1, 3, 20):
+            moved = np.moveaxis(values, axis, -1)
+            size = moved.shape[-1]
+            expected = np.stack([
+                moved[..., max(0, i - half):i + half + 1].sum(axis=-1)
+                for i in range(size)], axis=-1)
+            assert np.allclose(np.moveaxis(_box(values, half, axis), axis,
+                                           -1), expected)
+
+
+def test_sir_operator_by_hand():
+    flags = np.array([0, 1, 1, 0, 1, 1, 0, 0], bool)
+    # Sample 3 is the one unflagged sample of [1, 5], exactly a fraction
+    # 0.2; no window holding 0, 6 or 7 is that densely flagged
+    assert sir_operator(flags, 0.2).tolist() == [0, 1, 1, 1, 1, 1, 0, 0]
+    # [0, 2] and [4, 7] are at most half unflagged
+    assert sir_operator(flags, 0.5).all()
+    assert sir_operator(flags, 0.0).tolist() == flags.tolist()
+
+
+def test_sir_operator_matches_every_window():
+    rng = np.random.RandomState(2)
+    for eta in (0.1, 0.2, 0.3, 0.5):
+        flags = rng.uniform(size=(20, 24)) < 0.4
+        got = sir_operator(flags, eta, axis=-1)
+        for row in range(len(flags)):
+            assert (got[row] == _sir_reference(flags[row], eta)).all()
+        assert (sir_operator(flags.T, eta, axis=0) == got.T).all()
+
+
+def test_sum_threshold_finds_injected_rfi():
+    # chi1 10 and rho 1.5 give thresholds 10, 6.67, 4.44 and 2.96 for
+    # windows of 1, 2, 4 and 8 samples
+    values = np.zeros(64)
+    values[20:28] = 3.0     # only the aligned 8-sample window exceeds 2.96
+    values[50] = 12.0       # above the single sample threshold only
+    flags = np.zeros(64, bool)
+    expected = np.zeros(64, bool)
+    expected[20:28] = expected[50] = True
+
+    got = sum_threshold(values, flags, 10.0, windows=(1, 2, 4, 8))
+    assert got.tolist() == expected.tolist()
+
+    # Along the other axis of a 2-d waterfall, one threshold per row
+    waterfall = np.stack([values, values / 2])
+    got = sum_threshold(waterfall.T, np.zeros((64, 2), bool),
+                        np.array([10.0, 10.0]), windows=(1, 2, 4, 8), axis=0)
+    assert got[:, 0].tolist() == expected.tolist()
+    assert not got[:, 1].any()
+
+
+def test_sum_threshold_ignores_flagged_samples():
+    values = np.zeros(64)
+    values[20:28] = 3.0
+    values[23] = 1000.0
+    flags = np.zeros(64, bool)
+    flags[23] = True
+    # The mean of the unflagged burst samples is still 3
+    got = sum_threshold(values, flags, 10.0, windows=(1, 2, 4, 8))
+    assert np.nonzero(got)[0].tolist() == list(range(20, 28))
+    assert flags.sum() == 1
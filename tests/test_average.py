@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+import pytest
+
+from gcpipe.average import average_ms, bin_starts, time_bins
+
+
+def test_time_bins_shorten_with_baseline_length():
+    # 16 s dumps, 64 s bins up to 1 km: 4 dumps at 500 m, 2 at 2 km (a
+    # 32 s bin) and 1 at 100 km (0.64 s, never less than one dump)
+    times = 16.0 * np.arange(8)
+    for length, expected in ((500.0, [0, 0, 0, 0, 1, 1, 1, 1]),
+                             (2000.0, [0, 0, 1, 1, 2, 2, 3, 3]),
+                             (1e5, list(range(8)))):
+        lengths = np.full(len(times), length)
+        assert time_bins(times, 16.0, lengths, 64.0, 1000.0).tolist() == \
+            expected
+
+
+def test_bin_starts():
+    ant = np.array([0, 0, 0, 1, 1, 1])
+    bins = np.array([0, 0, 1, 1, 1, 2])
+    assert bin_starts([ant, bins]).tolist() == [0, 2, 3, 5]
+
+
+def test_average_ms_weighted_means(tmpdir):
+    pt = pytest.importorskip("pyrap.tables")
+    from gcpipe.synthms import make_gmrt_ms
+
+    msname = str(tmpdir.join("in.MS"))
+    make_gmrt_ms(msname, nchan=8, schedule=((0, 64),), autocorr=False,
+                 datacolumns=("DATA", "CORRECTED_DATA"))
+    tab = pt.table(msname, readonly=False, ack=False)
+    time = tab.getcol("TIME")
+    dump = np.round((time - time.min()) / 16).astype(int)
+    chan = np.arange(8)[None, :, None]
+    data = (dump[:, None, None] + 10j * chan) * np.ones((1, 1, 2))
+    weight = np.ones((len(time), 2)) + dump[:, None]
+    flag = np.zeros(data.shape, bool)
+    flag[dump == 1, 0, :] = True
+    tab.putcol("DATA", data.astype(np.complex64))
+    tab.putcol("WEIGHT", weight.astype(np.float32))
+    tab.putcol("FLAG", flag)
+    tab.close()
+
+    # One 64 s bin of 4 dumps per baseline, 2 channels per output channel
+    output = str(tmpdir.join("avg.MS"))
+    average_ms(msname, output, timebin=64, chanbin=2, datacolumns=["DATA"])
+    out = pt.table(output, ack=False)
+    try:
+        # Data columns that were not averaged are left out
+        assert "CORRECTED_DATA" not in out.colnames()
+        assert out.nrows() == len(time) // 4
+        got = out.getcol("DATA")
+        got_flag = out.getcol("FLAG")
+        got_weight = out.getcol("WEIGHT")
+    finally:
+        out.close()
+
+    # Input weight 1 + dump; output channel 0 is input channels 0 (dump 1
+    # flagged) and 1 (all dumps)
+    w0 = np.array([1, 0, 3, 4])
+    w1 = np.array([1, 2, 3, 4])
+    expected = ((w0 * np.arange(4)).sum() + (w1 * np.arange(4)).sum() +
+                10j * (w1 * 1).sum()) / (w0.sum() + w1.sum())
+    assert np.allclose(got[:, 0, :], expected)
+    # Channels 2k, 2k + 1 unflagged: the mean dump, plus the mean channel
+    mean_dump = (w1 * np.arange(4)).sum() / w1.sum()
+    for k in range(1, 4):
+        assert np.allclose(got[:, k, :], mean_dump + 10j * (2 * k + 0.5))
+    assert not got_flag.any()
+    # Summed unflagged weights, averaged over the output channels
+    assert np.allclose(got_weight, (w0.sum() + 7 * w1.sum()) / 4)
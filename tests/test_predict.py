@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, print_function
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from gcpipe.predict import Components, lmn, model_vis
+from gcpipe.skymodel import DTYPE
+from gcpipe.visstats import C
+
+RA0, DEC0 = 1.0, 0.5
+
+# RR, LL
+CORRS = [5, 8]
+
+
+def _sources(*rows):
+    """Components (dra, ddec, I, V, spi, freq0, ex, ey, pa) near RA0, DEC0"""
+    sources = np.zeros(len(rows), DTYPE)
+    for source, row in zip(sources, rows):
+        dra, ddec, stokes_i, stokes_v, spi, freq0, ex, ey, pa = row
+        source["ra"], source["dec"] = RA0 + dra, DEC0 + ddec
+        source["I"], source["V"] = stokes_i, stokes_v
+        source["spi"], source["freq0"] = spi, freq0
+        source["ex"], source["ey"], source["pa"] = ex, ey, pa
+    return sources
+
+
+def _uvw(nrow=50, seed=4):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(-20e3, 20e3, (nrow, 3)) * [1, 1, 0.1]
+
+
+def test_lmn_at_phase_centre():
+    assert np.allclose(lmn(RA0, DEC0, RA0, DEC0), 0)
+    l, m, n1 = lmn(RA0, DEC0 + 0.01, RA0, DEC0)
+    assert np.allclose([l, m, n1], [0, np.sin(0.01), np.cos(0.01) - 1])
+
+
+def test_point_sources_match_the_analytic_visibility():
+    sources = _sources((2e-3, -1e-3, 3.0, 0.5, 0.0, 0.0, 0, 0, 0),
+                       (-4e-3, 3e-3, 1.0, 0.0, -0.7, 300e6, 0, 0, 0))
+    uvw = _uvw()
+    # 70 evenly spaced channels (advanced between exact evaluations) and
+    # an uneven set
+    for freqs in (np.linspace(300e6, 330e6, 70),
+                  np.array([300e6, 301e6, 305e6, 320e6])):
+        expected = np.zeros((len(uvw), len(freqs), 2), complex)
+        for source in sources:
+            l, m, n1 = lmn(source["ra"], source["dec"], RA0, DEC0)
+            phase = -2j * np.pi * uvw.dot([l, m, n1])[:, None] * freqs / C
+            flux = source["I"] * (freqs / (source["freq0"] or 1)) ** \
+                source["spi"]
+            for corr, sign in ((0, 1), (1, -1)):
+                expected[:, :, corr] += ((flux + sign * source["V"]) *
+                                         np.exp(phase))
+        comps = Components(sources, RA0, DEC0, CORRS)
+        assert np.allclose(model_vis(uvw, freqs, comps), expected,
+                           rtol=1e-9, atol=1e-9)
+        pool = ThreadPool(3)
+        try:
+            assert np.allclose(model_vis(uvw, freqs, comps, pool, 3),
+                               expected, rtol=1e-9, atol=1e-9)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def test_gaussian_sources_match_the_analytic_visibility():
+    fwhm = 2e-5
+    sigma = fwhm / np.sqrt(8 * np.log(2))
+    # At the phase centre: a circular Gaussian, and one twice as long from
+    # north to south (position angle 0) as from east to west
+    sources = _sources((0, 0, 2.0, 0, 0, 0, fwhm, fwhm, 0),
+                       (0, 0, 1.0, 0, 0, 0, 2 * fwhm, fwhm, 0))
+    uvw = _uvw()
+    freqs = np.linspace(300e6, 330e6, 40)
+    u, v = uvw[:, 0:1] * freqs / C, uvw[:, 1:2] * freqs / C
+    expected = (2.0 * np.exp(-2 * np.pi ** 2 * sigma ** 2 * (u ** 2 +
+                                                             v ** 2)) +
+                np.exp(-2 * np.pi ** 2 * sigma ** 2 * ((2 * v) ** 2 +
+                                                       u ** 2)))
+    got = model_vis(uvw, freqs, Components(sources, RA0, DEC0, CORRS))
+    assert np.allclose(got[:, :, 0], expected, rtol=1e-7, atol=1e-9)
+    assert np.allclose(got[:, :, 1], expected, rtol=1e-7, atol=1e-9)
+    # Zero spacing sees the total flux
+    zero = model_vis(np.zeros((1, 3)), freqs,
+                     Components(sources, RA0, DEC0, CORRS))
+    assert np.allclose(zero, 3.0)